@@ -1,10 +1,28 @@
+import io
+
+from django.conf import settings
 from django.contrib import admin
-from django.shortcuts import redirect
-from django.urls import reverse
 from django.contrib import messages
+from django.contrib.admin import helpers
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.html import format_html, format_html_join
 
 # Register your models here.
-from .models import Category, Product, Customer, Order, OrderItem, Cart, CartItem
+from .models import Category, Product, Customer, Order, OrderEvent, OrderItem, Cart, CartItem, EmailOutbox, DailyOrderStats
+from .analytics import sales_summary
+from .exports import EXPORT_FORMATS, export_lines
+from .forms import TrackingImportForm
+from .pagination import EstimatedCountPaginator
+from .refunds import REFUNDABLE_STATUSES, bulk_refund_orders, request_refunds
+from .tracking import TrackingImportResult, import_tracking, manifest_format_for, parse_manifest
+from .transitions import transition_orders
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -16,6 +34,7 @@ class ProductAdmin(admin.ModelAdmin):
     list_display = ['name', 'category', 'price', 'stock', 'active', 'created_at']
     list_filter = ['active', 'created_at', 'category']
     list_editable = ['price', 'stock', 'active']
+    list_select_related = ['category']
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ['name', 'description']
 
@@ -23,67 +42,151 @@ class OrderItemInline(admin.TabularInline):
     model = OrderItem
     raw_id_fields = ['product']
 
-def refund_order_action(modeladmin, request, queryset):
-    """Admin action to refund selected orders"""
-    refunded_count = 0
+class OrderEventInline(admin.TabularInline):
+    """Read-only status history of the order"""
+    model = OrderEvent
+    extra = 0
+    can_delete = False
+    fields = ['created_at', 'field', 'from_value', 'to_value', 'source']
+    readonly_fields = fields
     
-    for order in queryset:
-        if order.payment_status == 'completed':
-            # Redirect to refund view for processing
-            return redirect(reverse('shop:refund_order', args=[order.id]))
-        elif order.payment_status == 'refunded':
-            messages.warning(request, f'Order #{order.id} is already refunded.')
-        else:
-            messages.error(request, f'Order #{order.id} cannot be refunded (status: {order.get_payment_status_display()}).')
+    def has_add_permission(self, request, obj=None):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+def _order_id_list(order_ids, limit=20):
+    """Format order ids for an admin message, truncating long selections"""
+    formatted = ', '.join(f'#{order_id}' for order_id in order_ids[:limit])
+    if len(order_ids) > limit:
+        formatted += f' and {len(order_ids) - limit} more'
+    return formatted
+
+
+# Failed refunds reported one message each; the rest are counted
+REFUND_FAILURES_SHOWN = 20
+
+
+def _refund_summary(queryset):
+    """Order count and total per payment status of the selection, in one query"""
+    rows = queryset.order_by().values('payment_status').annotate(count=Count('id'), total=Sum('total_amount'))
+    refundable = [row for row in rows if row['payment_status'] in REFUNDABLE_STATUSES]
+    return {
+        'refundable_count': sum(row['count'] for row in refundable),
+        'refundable_total': sum(row['total'] or 0 for row in refundable),
+        'refunded_count': sum(row['count'] for row in rows if row['payment_status'] == 'refunded'),
+        'other_count': sum(
+            row['count'] for row in rows
+            if row['payment_status'] not in REFUNDABLE_STATUSES and row['payment_status'] != 'refunded'
+        ),
+    }
+
+
+def _report_refunds(modeladmin, request, result):
+    if result.refunded:
+        modeladmin.message_user(request, f'Refunded {_order_id_list([order.id for order in result.refunded])}. Customers will receive confirmation emails.', messages.SUCCESS)
+    if result.queued:
+        modeladmin.message_user(request, f'{len(result.queued)} order(s) queued for refund and marked as Refund Requested: {_order_id_list([order.id for order in result.queued])}. They are refunded by `python manage.py processrefunds`.', messages.SUCCESS)
+    if result.already_refunded:
+        modeladmin.message_user(request, f'Already refunded: {_order_id_list([order.id for order in result.already_refunded])}.', messages.WARNING)
+    if result.not_refundable:
+        modeladmin.message_user(request, f'Cannot be refunded (payment not completed): {_order_id_list([order.id for order in result.not_refundable])}.', messages.ERROR)
+    for order, error in result.failed[:REFUND_FAILURES_SHOWN]:
+        modeladmin.message_user(request, f'Refund failed for order #{order.id}: {error}', messages.ERROR)
+    if len(result.failed) > REFUND_FAILURES_SHOWN:
+        modeladmin.message_user(request, f'{len(result.failed) - REFUND_FAILURES_SHOWN} more refund(s) failed (see logs).', messages.ERROR)
+
+
+def refund_order_action(modeladmin, request, queryset):
+    """
+    Admin action to refund selected orders, after a confirmation page
+
+    Up to REFUND_ADMIN_INLINE_LIMIT refundable orders are refunded right
+    away; larger selections are queued for the processrefunds command so
+    the request does not time out halfway through.
+    """
+    summary = _refund_summary(queryset)
+    if request.POST.get('post') != 'yes':
+        context = {
+            **modeladmin.admin_site.each_context(request),
+            'opts': modeladmin.model._meta,
+            'title': 'Refund orders',
+            'summary': summary,
+            'queue': summary['refundable_count'] > settings.REFUND_ADMIN_INLINE_LIMIT,
+            'selected_ids': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'select_across': request.POST.get('select_across') == '1',
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }
+        return TemplateResponse(request, 'admin/shop/order/refund_confirmation.html', context)
     
-    if refunded_count > 0:
-        messages.success(request, f'{refunded_count} order(s) refunded successfully.')
+    if summary['refundable_count'] > settings.REFUND_ADMIN_INLINE_LIMIT:
+        result = request_refunds(queryset)
+    else:
+        result = bulk_refund_orders(queryset, request)
+    _report_refunds(modeladmin, request, result)
+
+refund_order_action.short_description = "Process Refund for Selected Orders"
+
 
-refund_order_action.short_description = "Process Refund for Selected Order"
+def _report_transition(request, result, label):
+    if result.skipped_ids:
+        messages.warning(request, f'{len(result.skipped_ids)} order(s) cannot be marked as {label} from their current status: {_order_id_list(result.skipped_ids)}.')
+    if result.updated_ids:
+        messages.success(request, f'{len(result.updated_ids)} order(s) marked as {label}. Customers will receive email notifications.')
 
 
 def mark_as_shipped(modeladmin, request, queryset):
     """Admin action to mark orders as shipped"""
-    updated = 0
-    for order in queryset:
-        if order.status in ['pending', 'processing']:
-            order.status = 'shipped'
-            order.save()
-            updated += 1
-        else:
-            messages.warning(request, f'Order #{order.id} cannot be marked as shipped (current status: {order.get_status_display()}).')
-    
-    if updated > 0:
-        messages.success(request, f'{updated} order(s) marked as shipped. Customers will receive email notifications.')
+    result = transition_orders(queryset, 'shipped', request=request)
+    _report_transition(request, result, 'shipped')
 
 mark_as_shipped.short_description = "Mark as Shipped (Send Email)"
 
 
 def mark_as_delivered(modeladmin, request, queryset):
     """Admin action to mark orders as delivered"""
-    updated = 0
-    for order in queryset:
-        if order.status == 'shipped':
-            order.status = 'delivered'
-            order.save()
-            updated += 1
-        else:
-            messages.warning(request, f'Order #{order.id} cannot be marked as delivered (current status: {order.get_status_display()}).')
-    
-    if updated > 0:
-        messages.success(request, f'{updated} order(s) marked as delivered. Customers will receive email notifications.')
+    result = transition_orders(queryset, 'delivered', request=request)
+    _report_transition(request, result, 'delivered')
 
 mark_as_delivered.short_description = "Mark as Delivered (Send Email)"
 
 
+def _export_response(queryset, export_format):
+    _, content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(export_lines(queryset, export_format), content_type=content_type)
+    filename = f"orders-{timezone.localtime().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def export_orders_csv(modeladmin, request, queryset):
+    """Admin action to download the selected orders as CSV, one row per line item"""
+    return _export_response(queryset, 'csv')
+
+export_orders_csv.short_description = "Export Selected Orders (CSV)"
+
+
+def export_orders_ndjson(modeladmin, request, queryset):
+    """Admin action to download the selected orders as NDJSON, one order per line"""
+    return _export_response(queryset, 'ndjson')
+
+export_orders_ndjson.short_description = "Export Selected Orders (NDJSON)"
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['id', 'customer_name', 'status', 'payment_status', 'tracking_number', 'total_amount', 'created_at']
     list_filter = ['status', 'payment_status', 'created_at']
+    list_select_related = ['customer__user']
     readonly_fields = ['payment_intent_id', 'stripe_charge_id', 'created_at', 'updated_at']
-    inlines = [OrderItemInline]
-    actions = [mark_as_shipped, mark_as_delivered, refund_order_action]
-    search_fields = ['id', 'customer__user__username', 'customer__user__email', 'tracking_number']
+    raw_id_fields = ['customer']
+    inlines = [OrderItemInline, OrderEventInline]
+    actions = [mark_as_shipped, mark_as_delivered, refund_order_action, export_orders_csv, export_orders_ndjson]
+    # Exact and prefix matches only: a '%term%' LIKE cannot use an index
+    search_fields = ['=id', '^customer__user__username', '=customer__user__email', '=tracking_number']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     
     def customer_name(self, obj):
         """Display customer username in the list"""
@@ -91,6 +194,51 @@ class OrderAdmin(admin.ModelAdmin):
     customer_name.short_description = 'Customer'
     customer_name.admin_order_field = 'customer__user__username'
     
+    def save_model(self, request, obj, form, change):
+        obj.change_source = 'admin'
+        super().save_model(request, obj, form, change)
+    
+    def get_urls(self):
+        urls = [
+            path('import-tracking/', self.admin_site.admin_view(self.import_tracking_view), name='shop_order_import_tracking'),
+        ]
+        return urls + super().get_urls()
+    
+    def import_tracking_view(self, request):
+        """Upload a carrier manifest to add tracking numbers and mark orders as shipped"""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = TrackingImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['manifest']
+            manifest_format = form.cleaned_data['format'] or manifest_format_for(upload.name)
+            result = TrackingImportResult()
+            lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            import_tracking(parse_manifest(lines, manifest_format, result.errors), request=request, result=result)
+            
+            summary = f'Tracking stored for {len(result.updated_ids)} order(s); {len(result.shipped_ids)} marked as shipped.'
+            if result.shipped_ids:
+                summary += ' Customers will receive email notifications.'
+            messages.success(request, summary)
+            if result.unknown_ids:
+                messages.warning(request, f'Unknown orders: {_order_id_list(result.unknown_ids)}.')
+            if result.cancelled_ids:
+                messages.warning(request, f'Cancelled orders were skipped: {_order_id_list(result.cancelled_ids)}.')
+            if result.errors:
+                errors = '; '.join(f'line {line}: {message}' for line, message in result.errors[:20])
+                if len(result.errors) > 20:
+                    errors += f'; and {len(result.errors) - 20} more'
+                messages.error(request, f'{len(result.errors)} row(s) could not be read: {errors}')
+            return redirect('admin:shop_order_changelist')
+        
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import tracking numbers',
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/shop/order/import_tracking.html', context)
+    
     fieldsets = (
         ('Order Information', {
             'fields': ('customer', 'status', 'total_amount', 'shipping_address')
@@ -107,27 +255,58 @@ class OrderAdmin(admin.ModelAdmin):
         }),
     )
 
-class CustomerOrderInline(admin.TabularInline):
-    """Show all orders for this customer"""
-    model = Order
-    extra = 0
-    can_delete = False
-    fields = ['id', 'status', 'payment_status', 'total_amount', 'created_at']
-    readonly_fields = ['id', 'status', 'payment_status', 'total_amount', 'created_at']
-    
-    def has_add_permission(self, request, obj=None):
-        return False
+# Orders shown on the customer page; the rest are one click away
+RECENT_ORDERS_LIMIT = 10
 
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
     list_display = ['user', 'phone', 'city', 'created_at']
-    inlines = [CustomerOrderInline]
+    list_select_related = ['user']
+    raw_id_fields = ['user']
+    search_fields = ['^user__username', '=user__email']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def recent_orders(self, obj):
+        """The customer's latest orders with a link to all of them"""
+        if obj.pk is None:
+            return '-'
+        orders = list(
+            Order.objects.filter(customer=obj)
+            .order_by('-created_at')
+            .only('id', 'status', 'payment_status', 'total_amount', 'created_at')[:RECENT_ORDERS_LIMIT + 1]
+        )
+        if not orders:
+            return 'No orders yet'
+        rows = format_html_join(
+            '',
+            '<tr><td><a href="{}">#{}</a></td><td>{}</td><td>{}</td><td>${}</td><td>{}</td></tr>',
+            (
+                (
+                    reverse('admin:shop_order_change', args=[order.id]), order.id,
+                    order.get_status_display(), order.get_payment_status_display(),
+                    order.total_amount, timezone.localtime(order.created_at).strftime('%Y-%m-%d %H:%M'),
+                )
+                for order in orders[:RECENT_ORDERS_LIMIT]
+            ),
+        )
+        all_orders_url = f"{reverse('admin:shop_order_changelist')}?customer__id__exact={obj.pk}"
+        more = 'View all orders' if len(orders) > RECENT_ORDERS_LIMIT else 'Open in order list'
+        return format_html(
+            '<table><thead><tr><th>Order</th><th>Status</th><th>Payment</th><th>Total</th><th>Placed</th></tr></thead>'
+            '<tbody>{}</tbody></table><p><a href="{}">{}</a></p>',
+            rows, all_orders_url, more,
+        )
+    recent_orders.short_description = 'Recent orders'
     
     fieldsets = (
         ('User Information', {
             'fields': ('user',)
         }),
+        ('Orders', {
+            'fields': ('recent_orders',)
+        }),
         ('Contact Information', {
             'fields': ('phone', 'address', 'city', 'postal_code', 'country')
         }),
@@ -136,12 +315,85 @@ class CustomerAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
-    readonly_fields = ['created_at']
+    readonly_fields = ['created_at', 'recent_orders']
 
 class CartItemInline(admin.TabularInline):
     model = CartItem
+    raw_id_fields = ['product']
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ['session_key', 'created_at', 'get_total_items']
+    list_display = ['session_key', 'created_at', 'total_items']
     inlines = [CartItemInline]
+    search_fields = ['=session_key']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def get_queryset(self, request):
+        # A correlated subquery is evaluated for the displayed page only,
+        # unlike a JOIN + GROUP BY over every cart
+        item_totals = (
+            CartItem.objects.filter(cart=OuterRef('pk'))
+            .order_by()
+            .values('cart')
+            .annotate(total=Sum('quantity'))
+            .values('total')
+        )
+        return super().get_queryset(request).annotate(
+            _total_items=Coalesce(Subquery(item_totals), 0)
+        )
+    
+    def total_items(self, obj):
+        return obj._total_items
+    total_items.short_description = 'Total items'
+    total_items.admin_order_field = '_total_items'
+
+
+def retry_emails(modeladmin, request, queryset):
+    """Admin action to send dead or pending emails again"""
+    updated = queryset.exclude(status='sent').update(
+        status='pending', attempts=0, next_attempt_at=timezone.now(), last_error=''
+    )
+    messages.success(request, f'{updated} email(s) queued for another delivery attempt.')
+
+retry_emails.short_description = "Retry Selected Emails"
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'order', 'status', 'attempts', 'next_attempt_at', 'created_at', 'sent_at']
+    list_filter = ['status', 'kind']
+    list_select_related = ['order__customer__user']
+    readonly_fields = ['order', 'kind', 'site_url', 'attempts', 'last_error', 'created_at', 'sent_at']
+    raw_id_fields = ['order']
+    actions = [retry_emails]
+    search_fields = ['=order__id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(DailyOrderStats)
+class SalesDashboardAdmin(admin.ModelAdmin):
+    """
+    Sales dashboard built from the daily rollups only (see shop/analytics.py)
+    """
+    list_display = ['day', 'status', 'order_count', 'item_count', 'revenue']
+    list_filter = ['status']
+    date_hierarchy = 'day'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            # Figures follow the date and status filters of the list
+            context['summary'] = sales_summary(context['cl'].queryset)
+        return response
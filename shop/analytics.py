@@ -0,0 +1,146 @@
+"""
+Daily sales rollups
+
+``DailyOrderStats`` and ``DailyProductSales`` hold per-day totals so reports
+never aggregate over the live Order and OrderItem tables. ``rollupsales``
+keeps them current: it finds the days whose orders changed since its
+watermark (``Order.updated_at``) and recomputes those days in full, which
+makes each run idempotent.
+"""
+from datetime import datetime, time, timedelta
+import logging
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Max, Min, Sum
+from django.utils import timezone
+
+from .models import DailyOrderStats, DailyProductSales, Order, OrderItem, Watermark
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_WATERMARK = 'sales_rollup'
+
+# Orders committed slightly out of updated_at order (long transactions) are
+# caught by re-reading this much before the watermark; rebuilding a day twice
+# is harmless.
+ROLLUP_OVERLAP = timedelta(minutes=5)
+
+
+def _day_range(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def rebuild_day(day):
+    """Replace the rollup rows of one day with fresh totals"""
+    start, end = _day_range(day)
+    orders = Order.objects.filter(created_at__gte=start, created_at__lt=end).order_by()
+    items = OrderItem.objects.filter(order__created_at__gte=start, order__created_at__lt=end).order_by()
+
+    item_counts = dict(items.values_list('order__status').annotate(Sum('quantity')))
+    order_stats = [
+        DailyOrderStats(
+            day=day,
+            status=row['status'],
+            order_count=row['order_count'],
+            item_count=item_counts.get(row['status']) or 0,
+            revenue=row['revenue'] or 0,
+        )
+        for row in orders.values('status').annotate(order_count=Count('id'), revenue=Sum('total_amount'))
+    ]
+    product_sales = [
+        DailyProductSales(
+            day=day,
+            product_id=row['product_id'],
+            category_id=row['product__category_id'],
+            size=row['size'],
+            status=row['order__status'],
+            order_count=row['order_count'],
+            quantity=row['quantity'],
+            revenue=row['revenue'] or 0,
+        )
+        for row in items.values('product_id', 'product__category_id', 'size', 'order__status').annotate(
+            # Before the quantity annotation, which would shadow the field
+            revenue=Sum(F('quantity') * F('price'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+            order_count=Count('order_id', distinct=True),
+            quantity=Sum('quantity'),
+        )
+    ]
+
+    with transaction.atomic():
+        DailyOrderStats.objects.filter(day=day).delete()
+        DailyProductSales.objects.filter(day=day).delete()
+        DailyOrderStats.objects.bulk_create(order_stats)
+        DailyProductSales.objects.bulk_create(product_sales, batch_size=1000)
+
+
+def refresh_sales_rollups(rebuild_since=None):
+    """
+    Bring the rollups up to date
+
+    Args:
+        rebuild_since: Date to recompute every day from, regardless of the
+            watermark (e.g. after orders were deleted or data was fixed by hand)
+
+    Returns:
+        list: the days that were recomputed
+    """
+    watermark, _ = Watermark.objects.get_or_create(name=ROLLUP_WATERMARK)
+    # Read the high-water mark first: orders changed while we work are left
+    # for the next run
+    until = Order.objects.aggregate(Max('updated_at'))['updated_at__max']
+
+    if rebuild_since:
+        start, _ = _day_range(rebuild_since)
+        days = set(Order.objects.filter(created_at__gte=start).dates('created_at', 'day'))
+        # Days whose orders have all gone still need their rows cleared
+        days.update(DailyOrderStats.objects.filter(day__gte=rebuild_since).dates('day', 'day'))
+    elif until is None:
+        days = set()
+    else:
+        changed = Order.objects.filter(updated_at__lte=until)
+        if watermark.timestamp:
+            changed = changed.filter(updated_at__gte=watermark.timestamp - ROLLUP_OVERLAP)
+        days = set(changed.dates('created_at', 'day'))
+
+    days = sorted(days)
+    for day in days:
+        rebuild_day(day)
+
+    if until and (watermark.timestamp is None or until > watermark.timestamp):
+        watermark.timestamp = until
+        watermark.save()
+    logger.info(f"Sales rollups refreshed for {len(days)} day(s) up to {until}")
+    return days
+
+
+def sales_summary(order_stats):
+    """
+    Dashboard figures for a DailyOrderStats queryset
+
+    Product, category and size breakdowns come from DailyProductSales for
+    the same days and statuses. Only rollup tables are read.
+    """
+    order_stats = order_stats.order_by()
+    bounds = order_stats.aggregate(first_day=Min('day'), last_day=Max('day'))
+    if bounds['first_day'] is None:
+        return bounds
+    statuses = sorted(set(order_stats.values_list('status', flat=True)))
+    product_sales = DailyProductSales.objects.filter(
+        day__gte=bounds['first_day'], day__lte=bounds['last_day'], status__in=statuses,
+    ).order_by()
+    totals = {'order_count': Sum('order_count'), 'revenue': Sum('revenue')}
+    product_totals = {'quantity': Sum('quantity'), 'revenue': Sum('revenue')}
+
+    return {
+        'first_day': bounds['first_day'],
+        'last_day': bounds['last_day'],
+        'totals': order_stats.aggregate(**totals, item_count=Sum('item_count')),
+        # Cancelled orders were refunded or never paid
+        'net_revenue': order_stats.exclude(status='cancelled').aggregate(revenue=Sum('revenue'))['revenue'] or 0,
+        'by_day': order_stats.values('day').annotate(**totals).order_by('-day')[:31],
+        'by_status': order_stats.values('status').annotate(**totals).order_by('-revenue'),
+        'by_category': product_sales.values('category__name').annotate(**product_totals).order_by('-revenue'),
+        'by_size': product_sales.values('size').annotate(**product_totals).order_by('-quantity'),
+        'top_products': product_sales.values('product__name').annotate(**product_totals).order_by('-revenue')[:10],
+    }
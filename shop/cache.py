@@ -0,0 +1,314 @@
+"""
+Two-tier cache backend: a per-process LRU in front of a shared cache
+
+Reads are served from a bounded in-process LRU when possible and fall back
+to the shared cache (Redis in production, see CACHES in settings); values
+found there are copied into the LRU for at most LOCAL_TIMEOUT seconds.
+
+Keys are grouped by the part before the first colon ("catalog:index" is in
+group "catalog"). For each group the shared cache holds:
+
+- a namespace token, prefixed to the group's keys in the shared cache;
+  ``invalidate(group)`` replaces it, which drops every key of the group in
+  both tiers at once
+- an invalidation log: a sequence number plus one message per changed key.
+  Writes (set, delete, incr, ...) append the key they changed; fills
+  (``add``, and therefore ``get_or_set``) do not.
+
+Each process re-reads the namespace and sequence of the groups it uses at
+most every SYNC_INTERVAL seconds and drops its local copies of the keys
+logged since its last look (or the whole group, if it fell too far behind),
+so a change made by one process reaches the others within that interval.
+
+Hit, miss and eviction counters are kept per process; see ``stats()``.
+"""
+from collections import Counter, OrderedDict
+import pickle
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from .metrics import record_cache_event
+
+# Shared-cache keys of a group's namespace token, log sequence and log messages
+NAMESPACE_KEY = 'twotier:{}:namespace'
+SEQUENCE_KEY = 'twotier:{}:sequence'
+MESSAGE_KEY = 'twotier:{}:message:{}'
+
+# Seconds log messages are kept; a process that falls further behind than
+# MAX_PENDING_MESSAGES (or finds messages expired) drops the whole group
+MESSAGE_TIMEOUT = 300
+MAX_PENDING_MESSAGES = 100
+
+_MISSING = object()
+
+# Local tiers and counters are per process (and per LOCATION), like LocMemCache
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+
+def key_group(key):
+    """Invalidation group of a cache key"""
+    return key.split(':', 1)[0] if ':' in key else ''
+
+
+def invalidate_group(group, using='default'):
+    """
+    Drop every cached key of ``group`` in all processes
+
+    Backends without groups are cleared instead.
+    """
+    cache = caches[using]
+    if isinstance(cache, TwoTierCache):
+        cache.invalidate(group)
+    else:
+        cache.clear()
+
+
+class GroupState:
+    """What a process last read of a group's namespace and log"""
+
+    def __init__(self, namespace, sequence, checked_at):
+        self.namespace = namespace
+        self.sequence = sequence
+        self.checked_at = checked_at
+
+
+class LocalTier:
+    """Thread-safe LRU of pickled values with expiry"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (pickled, expires_at, group)
+        self.groups = {}  # group -> GroupState
+        self.counts = Counter()
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.counts[event] += n
+        record_cache_event(event, n)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                self.counts['expirations'] += 1
+                return _MISSING
+            self.entries.move_to_end(key)
+            pickled = entry[0]
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout, group):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.entries[key] = (pickled, time.monotonic() + timeout, group)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    def drop(self, keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.counts['invalidations'] += 1
+
+    def drop_group(self, group):
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry[2] == group]
+            for key in keys:
+                del self.entries[key]
+            self.counts['invalidations'] += len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+
+
+class TwoTierCache(BaseCache):
+    """
+    Cache backend; configure with OPTIONS:
+
+    - SHARED: alias of the shared cache (default "shared")
+    - LOCAL_MAX_ENTRIES: size of the in-process LRU (default 1000)
+    - LOCAL_TIMEOUT: longest a value is kept in-process, in seconds (default 30)
+    - SYNC_INTERVAL: how often a group's log is re-read, in seconds (default 1)
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = options.get('SHARED', 'shared')
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 30)
+        self.sync_interval = options.get('SYNC_INTERVAL', 1)
+        with _local_tiers_lock:
+            self._local = _local_tiers.setdefault(
+                (location, self.shared_alias), LocalTier(options.get('LOCAL_MAX_ENTRIES', 1000)),
+            )
+
+    @property
+    def _shared(self):
+        return caches[self.shared_alias]
+
+    def _sync(self, group):
+        """Apply the group's logged invalidations; returns its namespace"""
+        now = time.monotonic()
+        state = self._local.groups.get(group)
+        if state is not None and now - state.checked_at < self.sync_interval:
+            return state.namespace
+
+        namespace_key, sequence_key = NAMESPACE_KEY.format(group), SEQUENCE_KEY.format(group)
+        found = self._shared.get_many([namespace_key, sequence_key])
+        namespace, sequence = found.get(namespace_key), found.get(sequence_key, 0)
+        if namespace is None:
+            # Never set, or evicted: start a namespace no old key can be in
+            self._shared.add(namespace_key, uuid.uuid4().hex, None)
+            namespace = self._shared.get(namespace_key)
+
+        if state is not None:
+            behind = sequence - state.sequence
+            if namespace != state.namespace or behind < 0 or behind > MAX_PENDING_MESSAGES:
+                self._local.drop_group(group)
+            elif behind:
+                message_keys = [MESSAGE_KEY.format(group, n) for n in range(state.sequence + 1, sequence + 1)]
+                messages = self._shared.get_many(message_keys)
+                if len(messages) < len(message_keys):
+                    self._local.drop_group(group)
+                else:
+                    self._local.drop(set(messages.values()))
+        self._local.groups[group] = GroupState(namespace, sequence, now)
+        return namespace
+
+    def _shared_key(self, key):
+        return f'{self._sync(key_group(key))}:{key}'
+
+    def _publish(self, key, version):
+        """Log a changed key so every process drops its local copy"""
+        group, local_key = key_group(key), self.make_and_validate_key(key, version)
+        sequence_key = SEQUENCE_KEY.format(group)
+        try:
+            sequence = self._shared.incr(sequence_key)
+        except ValueError:
+            self._shared.add(sequence_key, 0, None)
+            sequence = self._shared.incr(sequence_key)
+        self._shared.set(MESSAGE_KEY.format(group, sequence), local_key, MESSAGE_TIMEOUT)
+        self._local.drop([local_key])
+        state = self._local.groups.get(group)
+        if state is not None and state.sequence == sequence - 1:
+            # Our own message: nothing else to drop at the next sync
+            state.sequence = sequence
+
+    def invalidate(self, group):
+        """Drop every key of ``group`` in both tiers (see the module docstring)"""
+        namespace = uuid.uuid4().hex
+        self._shared.set(NAMESPACE_KEY.format(group), namespace, None)
+        self._local.drop_group(group)
+        state = self._local.groups.get(group)
+        if state is not None:
+            state.namespace = namespace
+        self._local.count('group_invalidations')
+
+    def _keep_locally(self, key, value, timeout, version):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        timeout = self.local_timeout if timeout is None else min(timeout, self.local_timeout)
+        if timeout > 0:
+            self._local.set(self.make_and_validate_key(key, version), value, timeout, key_group(key))
+
+    def get(self, key, default=None, version=None):
+        shared_key = self._shared_key(key)
+        value = self._local.get(self.make_and_validate_key(key, version))
+        if value is not _MISSING:
+            self._local.count('local_hits')
+            return value
+        value = self._shared.get(shared_key, _MISSING, version)
+        if value is _MISSING:
+            self._local.count('misses')
+            return default
+        self._local.count('shared_hits')
+        self._keep_locally(key, value, DEFAULT_TIMEOUT, version)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        remote = {}
+        for key in keys:
+            shared_key = self._shared_key(key)
+            value = self._local.get(self.make_and_validate_key(key, version))
+            if value is _MISSING:
+                remote[shared_key] = key
+            else:
+                found[key] = value
+        self._local.count('local_hits', len(found))
+        if remote:
+            shared_found = self._shared.get_many(remote, version)
+            self._local.count('shared_hits', len(shared_found))
+            self._local.count('misses', len(remote) - len(shared_found))
+            for shared_key, value in shared_found.items():
+                found[remote[shared_key]] = value
+                self._keep_locally(remote[shared_key], value, DEFAULT_TIMEOUT, version)
+        return found
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version) is not _MISSING
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self._shared.add(self._shared_key(key), value, timeout, version)
+        if added:
+            self._keep_locally(key, value, timeout, version)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._shared.set(self._shared_key(key), value, timeout, version)
+        self._publish(key, version)
+        self._keep_locally(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        shared_keys = {key: self._shared_key(key) for key in data}
+        failed = set(self._shared.set_many(
+            {shared_keys[key]: value for key, value in data.items()}, timeout, version,
+        ))
+        for key, value in data.items():
+            self._publish(key, version)
+            if shared_keys[key] not in failed:
+                self._keep_locally(key, value, timeout, version)
+        return [key for key in data if shared_keys[key] in failed]
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._shared.touch(self._shared_key(key), timeout, version)
+
+    def delete(self, key, version=None):
+        deleted = self._shared.delete(self._shared_key(key), version)
+        self._publish(key, version)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self.delete(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self._shared.incr(self._shared_key(key), delta, version)
+        self._publish(key, version)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        return self.incr(key, -delta, version)
+
+    def clear(self):
+        self._shared.clear()
+        self._local.clear()
+
+    def stats(self):
+        """This process's counters, plus the number of entries held locally"""
+        with self._local.lock:
+            counts = dict(self._local.counts)
+            counts['local_entries'] = len(self._local.entries)
+        return counts
@@ -0,0 +1,133 @@
+"""
+Response compression negotiated from Accept-Encoding
+
+Brotli is offered when the optional ``brotli`` package is installed, gzip
+always; when a client accepts both equally, brotli wins since it compresses
+HTML and JSON noticeably smaller. Only text-like content types are
+compressed, and a regular response only when its body is at least
+COMPRESSION_MIN_SIZE bytes, below which the saving does not pay for the
+CPU. Streaming responses are compressed as one stream, and the compressor
+decides when to emit data; only pages rendered progressively (sent with
+``X-Accel-Buffering: no``, like My Orders) are flushed after every chunk,
+so the browser gets each part as soon as it is rendered. Flushing costs
+compression: a stream of small chunks (e.g. one CSV row each) would come
+out about twice as large.
+
+As in Django's GZipMiddleware, gzip output carries random padding in its
+header against BREACH-style attacks on secrets in compressed pages. Brotli
+output has no place for such padding, so responses that set the CSRF
+cookie (i.e. whose page includes a CSRF token) are sent as gzip.
+"""
+from gzip import GzipFile
+import re
+import secrets
+
+from django.conf import settings
+from django.utils.crypto import get_random_string
+from django.utils.text import StreamingBuffer, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing (prefixes of the media type)
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'application/xhtml+xml', 'image/svg+xml',
+)
+
+# Most random bytes added to gzip headers (see module docstring)
+GZIP_MAX_RANDOM_BYTES = 100
+
+ACCEPT_ENCODING_RE = re.compile(r'^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def available_encodings():
+    """Encodings this process can produce, most preferred first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encoding, allow_brotli=True):
+    """
+    Pick the encoding for a response from the request's Accept-Encoding
+
+    Args:
+        accept_encoding: the Accept-Encoding header value
+        allow_brotli: False for responses that carry a secret (see the
+            module docstring)
+
+    Returns:
+        str: 'br' or 'gzip', or None to send the response uncompressed
+    """
+    weights = {}
+    for part in accept_encoding.split(','):
+        match = ACCEPT_ENCODING_RE.match(part)
+        if not match:
+            continue
+        try:
+            weights[match.group(1).lower()] = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+
+    best, best_weight = None, 0
+    for encoding in available_encodings():
+        if encoding == 'br' and not allow_brotli:
+            continue
+        weight = weights.get(encoding, weights.get('*', 0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def is_compressible(content_type):
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress_content(content, encoding):
+    """Compress a whole response body"""
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    return compress_string(content, max_random_bytes=GZIP_MAX_RANDOM_BYTES)
+
+
+def _gzip_sequence(chunks, flush):
+    # As django.utils.text.compress_sequence, plus flushing on request
+    buffer = StreamingBuffer()
+    filename = get_random_string(secrets.randbelow(GZIP_MAX_RANDOM_BYTES) + 1)
+    with GzipFile(filename=filename, mode='wb', compresslevel=6, fileobj=buffer, mtime=0) as gzip_file:
+        for chunk in chunks:
+            gzip_file.write(chunk)
+            if flush:
+                gzip_file.flush()
+            data = buffer.read()
+            if data:
+                yield data
+    yield buffer.read()
+
+
+def _brotli_sequence(chunks, flush):
+    compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if flush:
+            data += compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_stream(chunks, encoding, flush=False):
+    """
+    Compress a streaming response body
+
+    Args:
+        chunks: the response's byte chunks
+        encoding: 'br' or 'gzip'
+        flush: send each chunk's compressed data before reading the next
+            (progressive pages), at the cost of a larger body
+    """
+    if encoding == 'br':
+        return _brotli_sequence(chunks, flush)
+    return _gzip_sequence(chunks, flush)
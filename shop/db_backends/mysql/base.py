@@ -0,0 +1,12 @@
+"""
+MySQL backend with connection reuse metrics (see shop/dbconnections.py)
+
+Use it as ENGINE "shop.db_backends.mysql".
+"""
+from django.db.backends.mysql import base
+
+from shop.dbconnections import InstrumentedConnectionMixin
+
+
+class DatabaseWrapper(InstrumentedConnectionMixin, base.DatabaseWrapper):
+    pass
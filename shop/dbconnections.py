@@ -0,0 +1,98 @@
+"""
+Database connection reuse metrics
+
+Connections are persistent (CONN_MAX_AGE) and health-checked before reuse
+(CONN_HEALTH_CHECKS); see DATABASES in settings. The backend in
+shop/db_backends wraps Django's connection handling to count, per
+database alias and per process:
+
+- opens: new connections, and the seconds spent establishing them
+- reuses: requests or jobs served by a connection that was already open
+- health_check_failures: reused connections found dead and replaced
+- recycled: connections closed for reaching CONN_MAX_AGE
+- discarded: connections closed after errors or a broken transaction state
+"""
+from collections import Counter, defaultdict
+import threading
+import time
+
+
+class ConnectionMetrics:
+    """Thread-safe counters of connection events, by database alias"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(Counter)
+        self._connect_seconds = defaultdict(float)
+
+    def increment(self, alias, event):
+        with self._lock:
+            self._counts[alias][event] += 1
+
+    def record_open(self, alias, seconds):
+        with self._lock:
+            self._counts[alias]['opens'] += 1
+            self._connect_seconds[alias] += seconds
+
+    def snapshot(self):
+        """Current counters as {alias: {event: count, ...}}"""
+        with self._lock:
+            stats = {}
+            for alias, counts in self._counts.items():
+                opens, reuses = counts['opens'], counts['reuses']
+                stats[alias] = {
+                    'opens': opens,
+                    'reuses': reuses,
+                    'health_check_failures': counts['health_check_failures'],
+                    'recycled': counts['recycled'],
+                    'discarded': counts['discarded'],
+                    'connect_seconds_total': round(self._connect_seconds[alias], 6),
+                    'connect_seconds_avg': round(self._connect_seconds[alias] / opens, 6) if opens else None,
+                    'reuse_ratio': round(reuses / (opens + reuses), 4) if opens + reuses else None,
+                }
+            return stats
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._connect_seconds.clear()
+
+
+connection_metrics = ConnectionMetrics()
+
+
+class InstrumentedConnectionMixin:
+    """
+    DatabaseWrapper mixin feeding connection_metrics
+
+    Django checks connections at the start and end of every request
+    (close_if_unusable_or_obsolete) and health-checks a kept connection on
+    its first use afterwards (close_if_health_check_failed); both are
+    extended here to record what happened.
+    """
+    _reuse_pending = False
+
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        connection_metrics.record_open(self.alias, time.monotonic() - started)
+        self._reuse_pending = False
+
+    def close_if_unusable_or_obsolete(self):
+        was_open = self.connection is not None
+        expired = was_open and self.close_at is not None and time.monotonic() >= self.close_at
+        super().close_if_unusable_or_obsolete()
+        if self.connection is not None:
+            self._reuse_pending = True
+        elif was_open:
+            connection_metrics.increment(self.alias, 'recycled' if expired else 'discarded')
+
+    def close_if_health_check_failed(self):
+        checking = self.connection is not None and self.health_check_enabled and not self.health_check_done
+        super().close_if_health_check_failed()
+        if checking and self.connection is None:
+            connection_metrics.increment(self.alias, 'health_check_failures')
+        if self._reuse_pending:
+            self._reuse_pending = False
+            if self.connection is not None:
+                connection_metrics.increment(self.alias, 'reuses')
@@ -1,239 +1,221 @@
 """
 Email utility functions for sending order and refund notifications
+
+All order emails go through one rendering engine: the order graph (customer,
+user, line items and products) is loaded once, shared by the plain-text and
+HTML renders, and batches of orders are loaded with a constant number of
+queries. Templates are loaded through the configured template engine, whose
+cached loader keeps them compiled (and picks up edits when DEBUG is on).
 """
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.db.models import prefetch_related_objects
 from django.conf import settings
-from django.contrib.sites.shortcuts import get_current_site
 import logging
 
+from .metrics import external_call
+from .outbox import get_site_url
+
 logger = logging.getLogger(__name__)
 
 
-def send_order_confirmation_email(order, request=None):
+# Subject and template base name for each kind of order email
+ORDER_EMAILS = {
+    'order_confirmation': {
+        'subject': 'Order Confirmation - Order #{order_id}',
+        'template': 'shop/emails/order_confirmation',
+        'label': 'Order confirmation',
+    },
+    'refund_confirmation': {
+        'subject': 'Refund Processed - Order #{order_id}',
+        'template': 'shop/emails/refund_confirmation',
+        'label': 'Refund confirmation',
+    },
+    'order_shipped': {
+        'subject': 'Your Order Has Shipped - Order #{order_id}',
+        'template': 'shop/emails/order_shipped',
+        'label': 'Order shipped',
+    },
+    'order_delivered': {
+        'subject': 'Your Order Has Been Delivered - Order #{order_id}',
+        'template': 'shop/emails/order_delivered',
+        'label': 'Order delivered',
+    },
+}
+
+def prefetch_order_graph(orders):
     """
-    Send order confirmation email to customer
-    
-    Args:
-        order: Order instance
-        request: HttpRequest instance (optional, for site URL)
-    
-    Returns:
-        bool: True if email sent successfully, False otherwise
+    Load everything the email templates touch for a list of orders
+
+    Relations already loaded (e.g. via select_related) are not fetched again,
+    so this costs at most four queries however many orders are passed.
     """
-    try:
-        # Get recipient email
-        recipient_email = order.customer.user.email
-        
-        if not recipient_email:
-            logger.warning(f"No email address for order #{order.id}")
-            return False
-        
-        # Get site URL
-        if request:
-            site_url = request.build_absolute_uri('/')[:-1]
-        else:
-            site_url = 'http://localhost:8000'
-        
-        # Prepare context
-        context = {
-            'order': order,
-            'site_url': site_url,
-        }
-        
-        # Render email templates
-        subject = f'Order Confirmation - Order #{order.id}'
-        text_content = render_to_string('shop/emails/order_confirmation.txt', context)
-        html_content = render_to_string('shop/emails/order_confirmation.html', context)
-        
-        # Create email message
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[recipient_email],
-        )
-        email.attach_alternative(html_content, "text/html")
-        
-        # Send email
-        email.send()
-        
-        logger.info(f"Order confirmation email sent for order #{order.id} to {recipient_email}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send order confirmation email for order #{order.id}: {str(e)}")
-        return False
+    prefetch_related_objects(list(orders), 'customer__user', 'items__product')
 
 
-def send_refund_confirmation_email(order, request=None):
+def _email_context(kind, order, site_url, tracking_number=None, tracking_url=None):
+    context = {
+        'order': order,
+        'site_url': site_url,
+    }
+    if kind == 'order_shipped':
+        context['tracking_number'] = tracking_number or order.tracking_number
+        context['tracking_url'] = tracking_url or order.tracking_url
+    elif kind == 'order_delivered':
+        context['support_email'] = settings.DEFAULT_FROM_EMAIL
+    return context
+
+
+def build_order_email(kind, order, site_url=None, connection=None, **extra):
     """
-    Send refund confirmation email to customer
-    
+    Render one order email without sending it
+
     Args:
-        order: Order instance
-        request: HttpRequest instance (optional, for site URL)
-    
+        kind: Key of ORDER_EMAILS
+        order: Order instance, ideally passed through prefetch_order_graph
+        site_url: Base URL for links (optional)
+        connection: Mail backend connection the message will use (optional)
+        **extra: tracking_number / tracking_url overrides for shipped emails
+
     Returns:
-        bool: True if email sent successfully, False otherwise
+        EmailMultiAlternatives, or None if the customer has no email address
     """
-    try:
-        # Get recipient email
-        recipient_email = order.customer.user.email
-        
-        if not recipient_email:
-            logger.warning(f"No email address for order #{order.id}")
-            return False
-        
-        # Get site URL
-        if request:
-            site_url = request.build_absolute_uri('/')[:-1]
-        else:
-            site_url = 'http://localhost:8000'
-        
-        # Prepare context
-        context = {
-            'order': order,
-            'site_url': site_url,
-        }
-        
-        # Render email templates
-        subject = f'Refund Processed - Order #{order.id}'
-        text_content = render_to_string('shop/emails/refund_confirmation.txt', context)
-        html_content = render_to_string('shop/emails/refund_confirmation.html', context)
-        
-        # Create email message
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[recipient_email],
-        )
-        email.attach_alternative(html_content, "text/html")
-        
-        # Send email
-        email.send()
-        
-        logger.info(f"Refund confirmation email sent for order #{order.id} to {recipient_email}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send refund confirmation email for order #{order.id}: {str(e)}")
-        return False
+    spec = ORDER_EMAILS[kind]
+    recipient_email = order.customer.user.email
+    if not recipient_email:
+        logger.warning(f"No email address for order #{order.id}")
+        return None
+
+    context = _email_context(kind, order, site_url or get_site_url(), **extra)
+    text_content = get_template(f"{spec['template']}.txt").render(context)
+    html_content = get_template(f"{spec['template']}.html").render(context)
 
+    email = EmailMultiAlternatives(
+        subject=spec['subject'].format(order_id=order.id),
+        body=text_content,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[recipient_email],
+        connection=connection,
+    )
+    email.attach_alternative(html_content, "text/html")
+    return email
 
-def send_order_shipped_email(order, request=None, tracking_number=None, tracking_url=None):
+
+def send_order_email(kind, order, request=None, site_url=None, connection=None, fail_silently=True, **extra):
     """
-    Send order shipped notification email to customer
-    
+    Render and send one order email
+
     Args:
+        kind: Key of ORDER_EMAILS
         order: Order instance
         request: HttpRequest instance (optional, for site URL)
-        tracking_number: Tracking number string (optional)
-        tracking_url: URL to track shipment (optional)
-    
+        site_url: Base URL for links (optional, overrides request)
+        connection: Open mail backend connection to reuse (optional)
+        fail_silently: Log delivery errors instead of raising them
+        **extra: tracking_number / tracking_url overrides for shipped emails
+
     Returns:
         bool: True if email sent successfully, False otherwise
     """
+    label = ORDER_EMAILS[kind]['label']
     try:
-        # Get recipient email
-        recipient_email = order.customer.user.email
-        
-        if not recipient_email:
-            logger.warning(f"No email address for order #{order.id}")
+        prefetch_order_graph([order])
+        email = build_order_email(kind, order, site_url or get_site_url(request), connection, **extra)
+        if email is None:
             return False
-        
-        # Get site URL
-        if request:
-            site_url = request.build_absolute_uri('/')[:-1]
-        else:
-            site_url = 'http://localhost:8000'
-        
-        # Prepare context
-        context = {
-            'order': order,
-            'site_url': site_url,
-            'tracking_number': tracking_number,
-            'tracking_url': tracking_url,
-        }
-        
-        # Render email templates
-        subject = f'Your Order Has Shipped - Order #{order.id}'
-        text_content = render_to_string('shop/emails/order_shipped.txt', context)
-        html_content = render_to_string('shop/emails/order_shipped.html', context)
-        
-        # Create email message
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[recipient_email],
-        )
-        email.attach_alternative(html_content, "text/html")
-        
-        # Send email
-        email.send()
-        
-        logger.info(f"Order shipped email sent for order #{order.id} to {recipient_email}")
+        with external_call('smtp', 'send'):
+            email.send()
+        logger.info(f"{label} email sent for order #{order.id} to {email.to[0]}")
         return True
-        
+
     except Exception as e:
-        logger.error(f"Failed to send order shipped email for order #{order.id}: {str(e)}")
+        logger.error(f"Failed to send {label.lower()} email for order #{order.id}: {str(e)}")
+        if not fail_silently:
+            raise
         return False
 
 
-def send_order_delivered_email(order, request=None):
+def send_order_confirmation_email(order, request=None, site_url=None, connection=None, fail_silently=True):
+    """Send order confirmation email to customer (see send_order_email)"""
+    return send_order_email('order_confirmation', order, request, site_url, connection, fail_silently)
+
+
+def send_refund_confirmation_email(order, request=None, site_url=None, connection=None, fail_silently=True):
+    """Send refund confirmation email to customer (see send_order_email)"""
+    return send_order_email('refund_confirmation', order, request, site_url, connection, fail_silently)
+
+
+def send_order_shipped_email(order, request=None, tracking_number=None, tracking_url=None, site_url=None, connection=None, fail_silently=True):
+    """Send order shipped notification email to customer (see send_order_email)"""
+    return send_order_email(
+        'order_shipped', order, request, site_url, connection, fail_silently,
+        tracking_number=tracking_number, tracking_url=tracking_url,
+    )
+
+
+def send_order_delivered_email(order, request=None, site_url=None, connection=None, fail_silently=True):
+    """Send order delivered notification email to customer (see send_order_email)"""
+    return send_order_email('order_delivered', order, request, site_url, connection, fail_silently)
+
+
+def send_order_email_batch(emails, batch_size=None, on_result=None):
     """
-    Send order delivered notification email to customer
-    
+    Send many order emails over one reused mail connection
+
+    The order graph for the whole list is loaded up front with a constant
+    number of queries. A connection (for SMTP: one TCP connection and TLS
+    handshake) is opened per ``batch_size`` messages instead of per message.
+    A failed message does not abort the batch; the connection is reopened for
+    the next one.
+
     Args:
-        order: Order instance
-        request: HttpRequest instance (optional, for site URL)
-    
+        emails: List of (kind, order, site_url) tuples
+        batch_size: Messages per connection (default: settings.EMAIL_BATCH_SIZE)
+        on_result: Called with (index, result) as soon as each email's
+            result is known, e.g. to record it before the next one is sent
+
     Returns:
-        bool: True if email sent successfully, False otherwise
+        list: One result per email, in order: True if sent, False if the
+        customer has no email address, or the exception that was raised
     """
-    try:
-        # Get recipient email
-        recipient_email = order.customer.user.email
-        
-        if not recipient_email:
-            logger.warning(f"No email address for order #{order.id}")
-            return False
-        
-        # Get site URL
-        if request:
-            site_url = request.build_absolute_uri('/')[:-1]
-        else:
-            site_url = 'http://localhost:8000'
-        
-        # Prepare context
-        context = {
-            'order': order,
-            'site_url': site_url,
-            'support_email': settings.DEFAULT_FROM_EMAIL,
-        }
-        
-        # Render email templates
-        subject = f'Your Order Has Been Delivered - Order #{order.id}'
-        text_content = render_to_string('shop/emails/order_delivered.txt', context)
-        html_content = render_to_string('shop/emails/order_delivered.html', context)
-        
-        # Create email message
-        email = EmailMultiAlternatives(
-            subject=subject,
-            body=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[recipient_email],
-        )
-        email.attach_alternative(html_content, "text/html")
-        
-        # Send email
-        email.send()
-        
-        logger.info(f"Order delivered email sent for order #{order.id} to {recipient_email}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send order delivered email for order #{order.id}: {str(e)}")
-        return False
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    prefetch_order_graph(order for _, order, _ in emails)
+    results = []
+
+    def record(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(len(results) - 1, result)
+
+    for start in range(0, len(emails), batch_size):
+        connection = get_connection(fail_silently=False)
+        try:
+            with external_call('smtp', 'connect'):
+                connection.open()
+            for kind, order, site_url in emails[start:start + batch_size]:
+                label = ORDER_EMAILS[kind]['label']
+                try:
+                    email = build_order_email(kind, order, site_url, connection)
+                    if email is not None:
+                        with external_call('smtp', 'send'):
+                            email.send()
+                        logger.info(f"{label} email sent for order #{order.id} to {email.to[0]}")
+                except Exception as e:
+                    logger.error(f"Failed to send {label.lower()} email for order #{order.id}: {str(e)}")
+                    record(e)
+                    # The connection may be unusable after an SMTP error
+                    connection.close()
+                    with external_call('smtp', 'connect'):
+                        connection.open()
+                else:
+                    # False: no recipient. Outside the try, so a failing
+                    # on_result is not taken for a failed send
+                    record(email is not None)
+        except Exception as e:
+            # Could not (re)connect: fail the rest of this batch
+            for _ in range(min(start + batch_size, len(emails)) - len(results)):
+                record(e)
+        finally:
+            connection.close()
+
+    return results
@@ -0,0 +1,150 @@
+"""
+Streaming order export for fulfilment and accounting
+
+Orders are read in primary-key order, one batch at a time, with customers
+joined and line items prefetched per batch. Only one batch is held in memory
+however many orders are exported. Batches are addressed by key (id > last
+id) rather than a long-lived cursor, because MySQL's client library buffers a
+whole result set even for ``QuerySet.iterator()``.
+"""
+import csv
+import json
+
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+
+EXPORT_CHUNK_SIZE = 1000
+
+# One CSV row per line item, with the order and customer repeated
+CSV_COLUMNS = [
+    'order_id', 'created_at', 'status', 'payment_status', 'total_amount',
+    'customer_username', 'customer_email', 'customer_name', 'customer_phone',
+    'shipping_address', 'tracking_number', 'tracking_url',
+    'product_id', 'product_name', 'size', 'quantity', 'unit_price', 'line_total',
+]
+
+# Free-text CSV columns (customer or admin input). Values starting with one
+# of FORMULA_PREFIXES are prefixed with a quote so spreadsheets show them as
+# text instead of running them as formulas.
+CSV_TEXT_COLUMNS = {
+    'customer_username', 'customer_email', 'customer_name', 'customer_phone',
+    'shipping_address', 'tracking_number', 'tracking_url', 'product_name', 'size',
+}
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def filter_orders(queryset, since=None, until=None, statuses=None):
+    """Restrict an Order queryset to a created-time range and statuses"""
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    return queryset
+
+
+def iter_orders(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield every order in ``queryset`` with its customer and line items loaded
+
+    Args:
+        queryset: Order queryset (its ordering is replaced by id)
+        chunk_size: Orders fetched per batch
+
+    Yields:
+        Order instances in id order
+    """
+    queryset = queryset.select_related('customer__user').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not batch:
+            return
+        prefetch_related_objects(batch, 'items__product')
+        yield from batch
+        last_id = batch[-1].id
+
+
+def _customer_fields(order):
+    user = order.customer.user
+    return {
+        'customer_username': user.username,
+        'customer_email': user.email,
+        'customer_name': user.get_full_name(),
+        'customer_phone': order.customer.phone,
+    }
+
+
+def _order_fields(order):
+    return {
+        'order_id': order.id,
+        'created_at': timezone.localtime(order.created_at).isoformat(),
+        'status': order.status,
+        'payment_status': order.payment_status,
+        'total_amount': str(order.total_amount),
+        **_customer_fields(order),
+        'shipping_address': order.shipping_address,
+        'tracking_number': order.tracking_number or '',
+        'tracking_url': order.tracking_url or '',
+    }
+
+
+def _item_fields(item):
+    return {
+        'product_id': item.product_id,
+        'product_name': item.product.name,
+        'size': item.size,
+        'quantity': item.quantity,
+        'unit_price': str(item.price),
+        'line_total': str(item.get_total_price()),
+    }
+
+
+def _csv_text(value):
+    if value and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class _Echo:
+    """File-like object whose write() returns the line instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(orders):
+    """Yield the export as CSV text, header first"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    empty_item = dict.fromkeys(CSV_COLUMNS[CSV_COLUMNS.index('product_id'):], '')
+    for order in orders:
+        order_fields = _order_fields(order)
+        items = [_item_fields(item) for item in order.items.all()] or [empty_item]
+        for item_fields in items:
+            row = {**order_fields, **item_fields}
+            yield writer.writerow([
+                _csv_text(row[column]) if column in CSV_TEXT_COLUMNS else row[column]
+                for column in CSV_COLUMNS
+            ])
+
+
+def ndjson_lines(orders):
+    """Yield the export as newline-delimited JSON, one order per line"""
+    for order in orders:
+        record = _order_fields(order)
+        record['items'] = [_item_fields(item) for item in order.items.all()]
+        yield json.dumps(record) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+}
+
+
+def export_lines(queryset, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield ``queryset`` exported in ``export_format`` ('csv' or 'ndjson')"""
+    render, _ = EXPORT_FORMATS[export_format]
+    return render(iter_orders(queryset, chunk_size))
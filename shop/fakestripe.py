@@ -0,0 +1,481 @@
+"""
+Offline stand-in for the Stripe API, used for checkout benchmarking and tests
+
+The real ``stripe`` client is pointed at this server through the
+``STRIPE_API_BASE`` setting, so views exercise the same code paths they use in
+production. Only the endpoints the shop relies on are implemented:
+
+    POST /v1/payment_intents                create
+    GET  /v1/payment_intents                list
+    GET  /v1/payment_intents/<id>           retrieve
+    POST /v1/payment_intents/<id>           modify
+    POST /v1/payment_intents/<id>/confirm   confirm (succeeds unless declined)
+    POST /v1/refunds                        create
+    GET  /v1/refunds                        list
+    GET  /v1/charges/<id>                   retrieve
+
+Successful confirmations and refunds are delivered as signed webhook events to
+``webhook_url`` when one is configured. Latency and failures can be injected to
+approximate a slow or unreliable upstream. POSTs sent with an
+``Idempotency-Key`` header are answered once and replayed for retries, as
+Stripe does.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+def _new_id(prefix):
+    return f"{prefix}_{secrets.token_hex(12)}"
+
+
+def _parse_form(body):
+    """
+    Decode a Stripe form-encoded body into a dict
+
+    Bracketed keys such as ``metadata[user_id]`` are folded into nested dicts
+    and ``expand[]`` style keys into lists.
+    """
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        if key.endswith('[]'):
+            params.setdefault(key[:-2], []).append(value)
+        elif '[' in key and key.endswith(']'):
+            outer, inner = key[:-1].split('[', 1)
+            params.setdefault(outer, {})[inner] = value
+        else:
+            params[key] = value
+    return params
+
+
+def _int_param(params, name, default=None):
+    """An integer parameter, answered with Stripe's 400 error when malformed"""
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise StripeStubError(
+            400, 'invalid_request_error', f"Invalid integer: {value}",
+            code='parameter_invalid_integer', param=name,
+        )
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Build a ``Stripe-Signature`` header value for a webhook payload"""
+    timestamp = int(timestamp or time.time())
+    signed = f"{timestamp}.{payload}".encode('utf-8')
+    signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+class StripeStubError(Exception):
+    """An error the stub answers with a Stripe-shaped error body"""
+
+    def __init__(self, status, error_type, message, code=None, param=None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.code = code
+        self.param = param
+
+    def to_dict(self):
+        error = {'type': self.error_type, 'message': str(self)}
+        if self.code:
+            error['code'] = self.code
+        if self.param:
+            error['param'] = self.param
+        return {'error': error}
+
+
+class FakeStripeState:
+    """
+    In-memory Stripe account: payment intents, charges, refunds, idempotent
+    responses and injected faults
+
+    Args:
+        latency_ms: Base delay added to every API call
+        jitter_ms: Random extra delay, uniformly distributed in [0, jitter_ms]
+        failure_rate: Fraction of API calls answered with a 500 api_error
+        decline_rate: Fraction of confirmations declined with a card_error
+        webhook_url: Endpoint to receive signed events (optional)
+        webhook_secret: Secret used to sign delivered events
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0,
+                 decline_rate=0.0, webhook_url='', webhook_secret=''):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.payment_intents = {}
+        self.charges = {}
+        self.refunds = {}
+        # (Idempotency-Key, path) -> (params, status, body), or None while in flight
+        self.idempotent_responses = {}
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def delay(self):
+        delay_ms = self.latency_ms
+        if self.jitter_ms:
+            delay_ms += self.random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+
+    def maybe_fail(self):
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise StripeStubError(500, 'api_error', 'Injected upstream failure')
+
+    def get_intent(self, intent_id):
+        intent = self.payment_intents.get(intent_id)
+        if intent is None:
+            raise StripeStubError(
+                404, 'invalid_request_error',
+                f"No such payment_intent: '{intent_id}'", code='resource_missing',
+            )
+        return intent
+
+    def get_charge(self, charge_id):
+        charge = self.charges.get(charge_id)
+        if charge is None:
+            raise StripeStubError(
+                404, 'invalid_request_error',
+                f"No such charge: '{charge_id}'", code='resource_missing',
+            )
+        return charge
+
+    def begin_idempotent(self, key, path, params):
+        """
+        Look up an earlier response for an Idempotency-Key
+
+        Returns:
+            tuple: (status, body) to replay, or None when the request is new
+            and should be handled (and then passed to ``end_idempotent``)
+        """
+        with self.lock:
+            if (key, path) not in self.idempotent_responses:
+                self.idempotent_responses[(key, path)] = None
+                return None
+            saved = self.idempotent_responses[(key, path)]
+        if saved is None:
+            raise StripeStubError(
+                409, 'idempotency_error',
+                'There is currently another in-progress request using this Idempotency-Key.',
+            )
+        saved_params, status, body = saved
+        if saved_params != params:
+            raise StripeStubError(
+                400, 'idempotency_error',
+                f"Keys for idempotent requests can only be used with the same parameters "
+                f"they were first used with. Try using a key other than '{key}'.",
+            )
+        return status, body
+
+    def end_idempotent(self, key, path, params, status, body):
+        with self.lock:
+            if status >= 500:
+                # Like Stripe, server errors are not saved, so the retry runs again
+                del self.idempotent_responses[(key, path)]
+            else:
+                # Saved as sent, so later changes to the object do not leak into replays
+                self.idempotent_responses[(key, path)] = (params, status, json.loads(json.dumps(body)))
+
+    def create_payment_intent(self, params):
+        amount = _int_param(params, 'amount', 0)
+        if amount <= 0:
+            raise StripeStubError(400, 'invalid_request_error', 'Invalid positive integer', code='parameter_invalid_integer')
+        intent_id = _new_id('pi')
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': amount,
+            'amount_received': 0,
+            'currency': params.get('currency', 'usd'),
+            'client_secret': f"{intent_id}_secret_{secrets.token_hex(8)}",
+            'created': int(time.time()),
+            'latest_charge': None,
+            'charges': {'object': 'list', 'data': []},
+            'livemode': False,
+            'metadata': params.get('metadata', {}),
+            'status': 'requires_payment_method',
+        }
+        with self.lock:
+            self.payment_intents[intent_id] = intent
+        return intent
+
+    def modify_payment_intent(self, intent_id, params):
+        with self.lock:
+            intent = self.get_intent(intent_id)
+            if 'amount' in params:
+                intent['amount'] = _int_param(params, 'amount')
+            if 'metadata' in params:
+                intent['metadata'].update(params['metadata'])
+            return intent
+
+    def confirm_payment_intent(self, intent_id):
+        with self.lock:
+            intent = self.get_intent(intent_id)
+            if intent['status'] == 'succeeded':
+                return intent, None
+            if self.decline_rate and self.random.random() < self.decline_rate:
+                intent['status'] = 'requires_payment_method'
+                event_type = 'payment_intent.payment_failed'
+            else:
+                charge = {
+                    'id': _new_id('ch'),
+                    'object': 'charge',
+                    'amount': intent['amount'],
+                    'payment_intent': intent_id,
+                    'amount_refunded': 0,
+                    'currency': intent['currency'],
+                    'paid': True,
+                    'refunded': False,
+                }
+                self.charges[charge['id']] = charge
+                intent['status'] = 'succeeded'
+                intent['amount_received'] = intent['amount']
+                intent['latest_charge'] = charge['id']
+                intent['charges']['data'] = [charge]
+                event_type = 'payment_intent.succeeded'
+        return intent, event_type
+
+    def create_refund(self, params):
+        """Refund a PaymentIntent's charge; returns (refund, updated charge)"""
+        intent_id = params.get('payment_intent')
+        requested = _int_param(params, 'amount')
+        with self.lock:
+            intent = self.get_intent(intent_id)
+            if intent['status'] != 'succeeded':
+                raise StripeStubError(
+                    400, 'invalid_request_error',
+                    f"PaymentIntent {intent_id} does not have a successful charge to refund.",
+                    code='charge_not_refundable',
+                )
+            charge = self.charges[intent['latest_charge']]
+            refunded = charge['amount_refunded']
+            amount = charge['amount'] - refunded if requested is None else requested
+            if amount <= 0 or refunded + amount > charge['amount']:
+                raise StripeStubError(
+                    400, 'invalid_request_error',
+                    f"Charge for {intent_id} has already been refunded.",
+                    code='charge_already_refunded',
+                )
+            refund = {
+                'id': _new_id('re'),
+                'object': 'refund',
+                'amount': amount,
+                'charge': intent['latest_charge'],
+                'created': int(time.time()),
+                'currency': intent['currency'],
+                'metadata': params.get('metadata', {}),
+                'payment_intent': intent_id,
+                'reason': params.get('reason'),
+                'status': 'succeeded',
+            }
+            self.refunds[refund['id']] = refund
+            charge['amount_refunded'] += amount
+            charge['refunded'] = charge['amount_refunded'] >= charge['amount']
+            charge = dict(charge)
+        return refund, charge
+
+    def list_objects(self, objects, params):
+        """
+        Page through objects newest first, honouring ``created`` range filters,
+        ``limit`` and ``starting_after`` like the real list endpoints
+        """
+        created = params.get('created', {})
+        if not isinstance(created, dict):
+            created = {'eq': created}
+        bounds = {op: _int_param(created, op) for op in created}
+        limit = min(_int_param(params, 'limit') or 10, 100)
+
+        with self.lock:
+            matching = [
+                obj for obj in objects.values()
+                if ('gte' not in bounds or obj['created'] >= bounds['gte'])
+                and ('gt' not in bounds or obj['created'] > bounds['gt'])
+                and ('lte' not in bounds or obj['created'] <= bounds['lte'])
+                and ('lt' not in bounds or obj['created'] < bounds['lt'])
+                and ('eq' not in bounds or obj['created'] == bounds['eq'])
+            ]
+        matching.sort(key=lambda obj: (obj['created'], obj['id']), reverse=True)
+
+        starting_after = params.get('starting_after')
+        if starting_after:
+            ids = [obj['id'] for obj in matching]
+            if starting_after in ids:
+                matching = matching[ids.index(starting_after) + 1:]
+        page = matching[:limit]
+        return {
+            'object': 'list',
+            'data': page,
+            'has_more': len(matching) > limit,
+            'url': params.get('_url', ''),
+        }
+
+    def deliver_event(self, event_type, obj):
+        """Send a signed webhook event in the background"""
+        if not self.webhook_url:
+            return
+        event = {
+            'id': _new_id('evt'),
+            'object': 'event',
+            'api_version': '2023-10-16',
+            'created': int(time.time()),
+            'data': {'object': obj},
+            'livemode': False,
+            'type': event_type,
+        }
+        payload = json.dumps(event)
+        thread = threading.Thread(target=self._post_event, args=(payload,), daemon=True)
+        thread.start()
+
+    def _post_event(self, payload):
+        request = urllib.request.Request(
+            self.webhook_url,
+            data=payload.encode('utf-8'),
+            headers={
+                'Content-Type': 'application/json',
+                'Stripe-Signature': sign_payload(payload, self.webhook_secret),
+            },
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                logger.info(f"Delivered webhook to {self.webhook_url}: {response.status}")
+        except Exception as e:
+            logger.error(f"Webhook delivery to {self.webhook_url} failed: {str(e)}")
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeStripe/1.0'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', _new_id('req'))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        return _parse_form(body)
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = self._read_params() if method == 'POST' else _parse_form(url.query)
+        key = self.headers.get('Idempotency-Key') if method == 'POST' else None
+        try:
+            self.state.delay()
+            replay = self.state.begin_idempotent(key, url.path, params) if key else None
+            if replay:
+                status, body = replay
+            else:
+                try:
+                    self.state.maybe_fail()
+                    status, body = self.route(method, parts, params)
+                except StripeStubError as e:
+                    status, body = e.status, e.to_dict()
+                except Exception as e:
+                    logger.exception(f"Fake Stripe failed on {method} {self.path}")
+                    status, body = 500, StripeStubError(500, 'api_error', str(e)).to_dict()
+                if key:
+                    self.state.end_idempotent(key, url.path, params, status, body)
+        except StripeStubError as e:
+            status, body = e.status, e.to_dict()
+        self._send_json(status, body)
+
+    def route(self, method, parts, params):
+        if parts[:2] == ['v1', 'payment_intents']:
+            if len(parts) == 2 and method == 'POST':
+                return 200, self.state.create_payment_intent(params)
+            if len(parts) == 2 and method == 'GET':
+                params['_url'] = '/v1/payment_intents'
+                return 200, self.state.list_objects(self.state.payment_intents, params)
+            if len(parts) == 3 and method == 'GET':
+                return 200, self.state.get_intent(parts[2])
+            if len(parts) == 3 and method == 'POST':
+                return 200, self.state.modify_payment_intent(parts[2], params)
+            if len(parts) == 4 and parts[3] == 'confirm' and method == 'POST':
+                intent, event_type = self.state.confirm_payment_intent(parts[2])
+                if event_type:
+                    self.state.deliver_event(event_type, intent)
+                if event_type == 'payment_intent.payment_failed':
+                    raise StripeStubError(402, 'card_error', 'Your card was declined.', code='card_declined')
+                return 200, intent
+        if parts[:2] == ['v1', 'refunds'] and len(parts) == 2 and method == 'POST':
+            refund, charge = self.state.create_refund(params)
+            self.state.deliver_event('charge.refunded', charge)
+            return 200, refund
+        if parts[:2] == ['v1', 'refunds'] and len(parts) == 2 and method == 'GET':
+            params['_url'] = '/v1/refunds'
+            return 200, self.state.list_objects(self.state.refunds, params)
+        if parts[:2] == ['v1', 'charges'] and len(parts) == 3 and method == 'GET':
+            with self.state.lock:
+                return 200, dict(self.state.get_charge(parts[2]))
+        raise StripeStubError(
+            404, 'invalid_request_error',
+            f"Unrecognized request URL ({method}: {self.path})",
+        )
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server hosting a FakeStripeState
+
+    Use ``start()`` to serve from a daemon thread (handy in tests and
+    benchmarks) or ``serve_forever()`` to block.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 12111), state=None):
+        super().__init__(address, FakeStripeHandler)
+        self.state = state or FakeStripeState()
+        self._thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
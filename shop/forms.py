@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from django.db.models.functions import Lower
 
 
 class SignUpForm(UserCreationForm):
@@ -12,7 +13,8 @@ class SignUpForm(UserCreationForm):
 
     def clean_email(self):
         email = self.cleaned_data["email"].strip().lower()
-        if User.objects.filter(email__iexact=email).exists():
+        # Compare on LOWER(email) so the shop_user_email_lower_idx index is used
+        if User.objects.annotate(email_lower=Lower("email")).filter(email_lower=email).exists():
             raise forms.ValidationError("A user with that email already exists.")
         return email
 
@@ -22,3 +24,11 @@ class SignUpForm(UserCreationForm):
         if commit:
             user.save()
         return user
+
+
+class TrackingImportForm(forms.Form):
+    manifest = forms.FileField(help_text="CSV with order_id, tracking_number and tracking_url columns, or JSON lines with the same keys.")
+    format = forms.ChoiceField(
+        choices=[("", "From file extension"), ("csv", "CSV"), ("jsonl", "JSON lines")],
+        required=False,
+    )
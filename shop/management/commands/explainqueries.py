@@ -0,0 +1,81 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from shop.models import Cart, EmailOutbox, Order, OrderEvent, Product
+
+# The shop's hot queries, as the views, webhook, forms and admin issue them.
+# Parameter values are placeholders: plans depend on the indexes and table
+# statistics, not on whether a row matches.
+CANONICAL_QUERIES = [
+    ('cart by session', lambda: Cart.objects.filter(session_key='x' * 32)),
+    ('order by payment intent (webhook, refunds)', lambda: Order.objects.filter(payment_intent_id='pi_x')),
+    ('my orders page', lambda: Order.objects.filter(customer__user_id=1).order_by('-created_at', '-id')[:21]),
+    ('customer admin orders', lambda: Order.objects.filter(customer_id=1).order_by('-created_at')[:10]),
+    ('admin status filter', lambda: Order.objects.filter(status='pending').order_by('-created_at')[:100]),
+    ('signup email check', lambda: User.objects.annotate(email_lower=Lower('email')).filter(email_lower='x@example.com')[:1]),
+    ('home page products', lambda: Product.objects.filter(active=True)[:12]),
+    ('product detail', lambda: Product.objects.filter(slug='x')),
+    ('due outbox emails', lambda: EmailOutbox.objects.filter(status__in=['pending', 'sending'], next_attempt_at__lte=timezone.now()).order_by('next_attempt_at', 'id')[:50]),
+    ('order history', lambda: OrderEvent.objects.filter(order_id=1)),
+]
+
+
+def _full_scans(vendor, columns, rows):
+    """Tables read in full according to one EXPLAIN result"""
+    if vendor == 'mysql':
+        # Traditional EXPLAIN: access type ALL is a table scan
+        row_dicts = [dict(zip(columns, row)) for row in rows]
+        return [row['table'] for row in row_dicts if row.get('type') == 'ALL']
+    if vendor == 'postgresql':
+        lines = [row[0] for row in rows]
+        return [line.split(' on ', 1)[1].split()[0] for line in lines if 'Seq Scan on ' in line]
+    if vendor == 'sqlite':
+        # EXPLAIN QUERY PLAN: "SCAN t" without an index is a table scan
+        details = [row[-1] for row in rows]
+        return [detail.split()[1] for detail in details if detail.startswith('SCAN ') and ' INDEX ' not in detail]
+    return []
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the shop's canonical queries and flag full table scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database alias to explain against')
+        parser.add_argument('--fail-on-scan', action='store_true', help='Exit with an error if any query scans a full table')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        vendor = connection.vendor
+        prefix = {'sqlite': 'EXPLAIN QUERY PLAN '}.get(vendor, 'EXPLAIN ')
+        if vendor not in ('mysql', 'postgresql', 'sqlite'):
+            self.stdout.write(self.style.WARNING(f'Full-scan detection is not supported on {vendor}; showing plans only.'))
+
+        flagged = []
+        for name, build in CANONICAL_QUERIES:
+            sql, params = build().using(options['database']).query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                columns = [col[0] for col in cursor.description]
+                rows = cursor.fetchall()
+
+            scans = _full_scans(vendor, columns, rows)
+            if scans:
+                flagged.append(name)
+                self.stdout.write(self.style.WARNING(f"FULL SCAN  {name}: {', '.join(scans)}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'ok         {name}'))
+            if options['verbosity'] > 1 or scans:
+                for row in rows:
+                    self.stdout.write('    ' + ' | '.join('' if value is None else str(value) for value in row))
+
+        self.stdout.write(f'\n{len(flagged)} of {len(CANONICAL_QUERIES)} queries scan a full table.')
+        if flagged:
+            self.stdout.write(
+                'Note: planners prefer scans on small tables; run this against a '
+                'database with production-sized data before adding indexes.'
+            )
+            if options['fail_on_scan']:
+                raise CommandError(f"Full table scans in: {', '.join(flagged)}")
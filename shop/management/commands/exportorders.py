@@ -0,0 +1,50 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from shop.exports import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_lines, filter_orders
+from shop.models import Order
+
+
+def _parse_day(value, option):
+    day = parse_date(value)
+    if day is None:
+        raise CommandError(f'Invalid {option}: {value!r} (expected YYYY-MM-DD)')
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class Command(BaseCommand):
+    help = 'Stream orders with line items and customer details as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv', help='Output format')
+        parser.add_argument('--since', type=str, help='Only orders placed on or after this date')
+        parser.add_argument('--until', type=str, help='Only orders placed before this date')
+        parser.add_argument('--status', type=str, action='append', help='Order status to include (repeatable; default: all)')
+        parser.add_argument('--output', type=str, help='File to write (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Orders read per query')
+
+    def handle(self, *args, **options):
+        valid_statuses = {value for value, _ in Order.STATUS_CHOICES}
+        for status in options['status'] or []:
+            if status not in valid_statuses:
+                raise CommandError(f"Unknown status {status!r} (choose from {', '.join(sorted(valid_statuses))})")
+
+        queryset = filter_orders(
+            Order.objects.all(),
+            since=_parse_day(options['since'], '--since') if options['since'] else None,
+            until=_parse_day(options['until'], '--until') if options['until'] else None,
+            statuses=options['status'],
+        )
+        lines = export_lines(queryset, options['format'], max(1, options['chunk_size']))
+
+        if options['output']:
+            # newline='' keeps the csv module's \r\n line endings intact
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                output.writelines(lines)
+            self.stderr.write(self.style.SUCCESS(f"Exported orders to {options['output']}"))
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
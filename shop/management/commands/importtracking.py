@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.tracking import IMPORT_CHUNK_SIZE, TrackingImportResult, import_tracking, manifest_format_for, parse_manifest
+
+
+class Command(BaseCommand):
+    help = 'Import carrier tracking numbers from a CSV or JSONL manifest and mark the orders as shipped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', type=str, help='Path to the manifest file')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Manifest format (default: from the file extension)')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Orders updated per transaction')
+
+    def handle(self, *args, **options):
+        manifest_format = options['format'] or manifest_format_for(options['manifest'])
+        result = TrackingImportResult()
+        started = time.monotonic()
+        try:
+            with open(options['manifest'], newline='', encoding='utf-8-sig') as manifest:
+                rows = parse_manifest(manifest, manifest_format, result.errors)
+                import_tracking(rows, chunk_size=max(1, options['chunk_size']), result=result)
+        except OSError as e:
+            raise CommandError(f'Cannot read manifest: {e}')
+
+        for line, message in result.errors[:50]:
+            self.stdout.write(self.style.WARNING(f'  line {line}: {message}'))
+        if len(result.errors) > 50:
+            self.stdout.write(self.style.WARNING(f'  ... and {len(result.errors) - 50} more invalid rows'))
+        if result.unknown_ids:
+            self.stdout.write(self.style.WARNING(f'Unknown orders: {len(result.unknown_ids)}'))
+        if result.cancelled_ids:
+            self.stdout.write(self.style.WARNING(f'Cancelled orders skipped: {len(result.cancelled_ids)}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Tracking stored for {len(result.updated_ids)} order(s), {len(result.shipped_ids)} marked as shipped '
+            f'in {time.monotonic() - started:.1f}s.'
+        ))
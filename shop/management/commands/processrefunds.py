@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop.refunds import process_requested_refunds
+
+
+class Command(BaseCommand):
+    help = 'Refund the orders queued as Refund Requested by the bulk refund admin action'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Orders refunded per batch')
+        parser.add_argument('--workers', type=int, default=settings.REFUND_MAX_WORKERS, help='Concurrent Stripe refund calls')
+
+    def handle(self, *args, **options):
+        self.done = 0
+        result = process_requested_refunds(
+            batch_size=max(1, options['batch_size']),
+            max_workers=max(1, options['workers']),
+            progress=self._progress,
+        )
+        for order, error in result.failed:
+            self.stdout.write(self.style.ERROR(f'  order #{order.id}: {error}'))
+        summary = (
+            f'Refunded {len(result.refunded)}, failed {len(result.failed)} (left queued), '
+            f'skipped {len(result.already_refunded) + len(result.not_refundable)}.'
+        )
+        self.stdout.write(self.style.WARNING(summary) if result.failed else self.style.SUCCESS(summary))
+
+    def _progress(self, result):
+        self.done += result.total
+        self.stdout.write(f'{self.done} queued order(s) processed...')
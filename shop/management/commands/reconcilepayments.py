@@ -0,0 +1,264 @@
+import json
+from collections import Counter
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from shop.models import Order, OrderEvent
+from shop.payments import configure_stripe
+
+PHASES = ('payment_intents', 'refunds')
+
+
+def _parse_when(value, option):
+    """Accept an ISO date or datetime; naive values are taken as UTC"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f'Invalid {option}: {value!r} (expected YYYY-MM-DD or ISO datetime)')
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def _to_cents(amount):
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+class Command(BaseCommand):
+    help = (
+        'Reconcile orders against Stripe PaymentIntents and Refunds created in a '
+        'time range, reporting (and optionally fixing) mismatches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=str, help='Start of the created-time range (default: 7 days ago)')
+        parser.add_argument('--until', type=str, help='End of the created-time range (default: now)')
+        parser.add_argument('--window-hours', type=int, default=24, help='Size of each created-time window')
+        parser.add_argument('--page-size', type=int, default=100, help='Stripe list page size (max 100)')
+        parser.add_argument('--fix', action='store_true', help='Update orders to match Stripe')
+        parser.add_argument('--checkpoint', type=str, help='JSON file recording progress after every page')
+        parser.add_argument('--resume', action='store_true', help='Continue from the --checkpoint file')
+
+    def handle(self, *args, **options):
+        self.stripe = configure_stripe()
+        self.fix = options['fix']
+        self.page_size = max(1, min(options['page_size'], 100))
+        self.checkpoint_path = Path(options['checkpoint']) if options['checkpoint'] else None
+        window = timedelta(hours=max(1, options['window_hours']))
+
+        state = None
+        if options['resume']:
+            if not self.checkpoint_path:
+                raise CommandError('--resume requires --checkpoint')
+            if self.checkpoint_path.exists():
+                state = json.loads(self.checkpoint_path.read_text())
+                self.stdout.write(
+                    f"Resuming {state['phase']} from window starting "
+                    f"{datetime.fromtimestamp(state['window_start'], tz=dt_timezone.utc).isoformat()}"
+                )
+
+        if state is None:
+            # Windows are half-open, so by default reach one second past now
+            until = (
+                _parse_when(options['until'], '--until') if options['until']
+                else timezone.now() + timedelta(seconds=1)
+            )
+            since = _parse_when(options['since'], '--since') if options['since'] else until - timedelta(days=7)
+            if since >= until:
+                raise CommandError('--since must be before --until')
+            state = {
+                'since': int(since.timestamp()),
+                'until': int(until.timestamp()),
+                'phase': PHASES[0],
+                'window_start': int(since.timestamp()),
+                'starting_after': None,
+                'counts': {},
+            }
+
+        self.counts = Counter(state['counts'])
+        # Charges already reported as partially refunded, so each is reported once
+        self.partial_charges = set()
+        window_seconds = int(window.total_seconds())
+
+        for phase in PHASES[PHASES.index(state['phase']):]:
+            if phase != state['phase']:
+                state.update(phase=phase, window_start=state['since'], starting_after=None)
+            self.stdout.write(f'Scanning {phase}...')
+            while state['window_start'] < state['until']:
+                window_end = min(state['window_start'] + window_seconds, state['until'])
+                self._scan_window(phase, state, window_end)
+                state.update(window_start=window_end, starting_after=None)
+                self._save_checkpoint(state)
+
+        self._report_summary()
+        if self.checkpoint_path and self.checkpoint_path.exists():
+            self.checkpoint_path.unlink()
+
+    def _scan_window(self, phase, state, window_end):
+        """Page through one created-time window, newest first"""
+        resource = self.stripe.PaymentIntent if phase == 'payment_intents' else self.stripe.Refund
+        while True:
+            params = {
+                'created': {'gte': state['window_start'], 'lt': window_end},
+                'limit': self.page_size,
+            }
+            if state['starting_after']:
+                params['starting_after'] = state['starting_after']
+            page = resource.list(**params)
+            if not page.data:
+                return
+
+            if phase == 'payment_intents':
+                self._reconcile_intents(page.data)
+            else:
+                self._reconcile_refunds(page.data)
+
+            state['starting_after'] = page.data[-1].id
+            state['counts'] = dict(self.counts)
+            self._save_checkpoint(state)
+            if not page.has_more:
+                return
+
+    def _load_orders(self, intent_ids):
+        orders = Order.objects.filter(payment_intent_id__in=intent_ids).only(
+            'id', 'payment_intent_id', 'payment_status', 'status', 'total_amount', 'updated_at'
+        )
+        return {order.payment_intent_id: order for order in orders}
+
+    def _reconcile_intents(self, intents):
+        self.counts['payment_intents'] += len(intents)
+        orders = self._load_orders([intent.id for intent in intents])
+        to_update = []
+
+        for intent in intents:
+            order = orders.get(intent.id)
+            if intent.status == 'succeeded':
+                if order is None:
+                    self._mismatch('missing_order', intent.id, f'amount={intent.amount_received}')
+                    continue
+                received = intent.get('amount_received') or intent.amount
+                if _to_cents(order.total_amount) != received:
+                    self._mismatch(
+                        'amount_mismatch', intent.id,
+                        f'order=#{order.id} order_cents={_to_cents(order.total_amount)} stripe_cents={received}',
+                    )
+                if order.payment_status in ('pending', 'failed'):
+                    self._mismatch(
+                        'payment_not_recorded', intent.id,
+                        f'order=#{order.id} payment_status={order.payment_status}',
+                    )
+                    order.payment_status = 'completed'
+                    if order.status == 'pending':
+                        order.status = 'processing'
+                    to_update.append(order)
+            elif order is not None and intent.status in ('canceled', 'requires_payment_method'):
+                if order.payment_status == 'completed':
+                    self._mismatch(
+                        'payment_not_captured', intent.id,
+                        f'order=#{order.id} stripe_status={intent.status}',
+                    )
+                    order.payment_status = 'failed'
+                    to_update.append(order)
+
+        self._apply(to_update)
+
+    def _refunded_cents(self, refund, charges):
+        """
+        Total refunded so far on the refund's charge, and the charge amount
+
+        Several partial refunds can add up to a full one, so the charge's
+        amount_refunded is used rather than the single refund's amount.
+        """
+        if not refund.get('charge'):
+            return refund.amount, None
+        if refund.charge not in charges:
+            charges[refund.charge] = self.stripe.Charge.retrieve(refund.charge)
+        charge = charges[refund.charge]
+        return charge.amount_refunded, charge.amount
+
+    def _reconcile_refunds(self, refunds):
+        self.counts['refunds'] += len(refunds)
+        succeeded = [refund for refund in refunds if refund.status == 'succeeded' and refund.payment_intent]
+        orders = self._load_orders({refund.payment_intent for refund in succeeded})
+        to_update = {}
+        charges = {}
+
+        for refund in succeeded:
+            order = orders.get(refund.payment_intent)
+            if order is None:
+                self._mismatch('refund_without_order', refund.payment_intent, f'refund={refund.id}')
+                continue
+            if order.payment_status == 'refunded' or order.id in to_update:
+                continue
+            refunded, charged = self._refunded_cents(refund, charges)
+            if refunded < (charged or _to_cents(order.total_amount)):
+                if (refund.charge or refund.id) not in self.partial_charges:
+                    self.partial_charges.add(refund.charge or refund.id)
+                    self._mismatch(
+                        'partial_refund', refund.payment_intent,
+                        f'order=#{order.id} refund={refund.id} refunded_cents={refunded}',
+                    )
+                continue
+            self._mismatch(
+                'refund_not_recorded', refund.payment_intent,
+                f'order=#{order.id} refund={refund.id} refunded_cents={refunded} '
+                f'payment_status={order.payment_status}',
+            )
+            order.payment_status = 'refunded'
+            order.status = 'cancelled'
+            to_update[order.id] = order
+
+        self._apply(list(to_update.values()))
+
+    def _apply(self, orders):
+        if not self.fix or not orders:
+            return
+        now = timezone.now()
+        changes = [
+            (order.id, field, old_value, getattr(order, field))
+            for order in orders
+            for field, old_value in order.get_dirty_fields().items()
+        ]
+        for order in orders:
+            order.updated_at = now
+        with transaction.atomic():
+            Order.objects.bulk_update(orders, ['payment_status', 'status', 'updated_at'])
+            OrderEvent.objects.record_changes(changes, source='reconciliation', at=now)
+        self.counts['fixed'] += len(orders)
+
+    def _mismatch(self, kind, intent_id, detail):
+        self.counts[kind] += 1
+        self.stdout.write(f'  {kind}: intent={intent_id} {detail}')
+
+    def _save_checkpoint(self, state):
+        if not self.checkpoint_path:
+            return
+        state['counts'] = dict(self.counts)
+        tmp_path = self.checkpoint_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(state))
+        tmp_path.replace(self.checkpoint_path)
+
+    def _report_summary(self):
+        self.stdout.write('\n=== RECONCILIATION SUMMARY ===')
+        self.stdout.write(f"PaymentIntents scanned: {self.counts['payment_intents']}")
+        self.stdout.write(f"Refunds scanned: {self.counts['refunds']}")
+        mismatches = {
+            kind: count for kind, count in sorted(self.counts.items())
+            if kind not in ('payment_intents', 'refunds', 'fixed')
+        }
+        for kind, count in mismatches.items():
+            self.stdout.write(f'  {kind}: {count}')
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('No mismatches found.'))
+        elif self.fix:
+            self.stdout.write(self.style.SUCCESS(f"Orders updated: {self.counts['fixed']}"))
+        else:
+            self.stdout.write(self.style.WARNING('Run again with --fix to update the orders above.'))
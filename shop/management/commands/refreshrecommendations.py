@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Watermark
+from shop.recommendations import ORDER_BATCH_SIZE, RECOMMENDATION_WATERMARK, refresh_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Count orders placed since the last run into the "customers also bought" recommendations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=ORDER_BATCH_SIZE, help='Orders counted per transaction')
+        parser.add_argument('--rebuild', action='store_true', help='Discard the counts and recount every order')
+
+    def handle(self, *args, **options):
+        covered = refresh_recommendations(max(1, options['batch_size']), rebuild=options['rebuild'])
+        last_id = Watermark.objects.get(name=RECOMMENDATION_WATERMARK).last_id
+        if covered:
+            self.stdout.write(self.style.SUCCESS(f'Counted {covered} order id(s); recommendations are current up to order #{last_id}.'))
+        else:
+            self.stdout.write('Recommendations are up to date.')
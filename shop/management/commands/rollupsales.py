@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from shop.analytics import refresh_sales_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Update the daily sales rollups for orders changed since the last run. '
+        'Schedule it (e.g. every 5 minutes) so that runs do not overlap.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-since', type=str, help='Recompute every day from this date (YYYY-MM-DD) regardless of the watermark')
+
+    def handle(self, *args, **options):
+        rebuild_since = None
+        if options['rebuild_since']:
+            rebuild_since = parse_date(options['rebuild_since'])
+            if rebuild_since is None:
+                raise CommandError(f"Invalid --rebuild-since: {options['rebuild_since']!r} (expected YYYY-MM-DD)")
+
+        days = refresh_sales_rollups(rebuild_since)
+        if days:
+            self.stdout.write(self.style.SUCCESS(f'Recomputed {len(days)} day(s): {days[0]} to {days[-1]}.'))
+        else:
+            self.stdout.write('Sales rollups are up to date.')
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop.fakestripe import FakeStripeServer, FakeStripeState
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the Stripe API (set STRIPE_API_BASE to its address)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to bind')
+        parser.add_argument('--port', type=int, default=12111, help='Port to listen on')
+        parser.add_argument('--latency-ms', type=float, default=0, help='Base latency added to every call')
+        parser.add_argument('--jitter-ms', type=float, default=0, help='Random extra latency per call')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of calls answered with a 500')
+        parser.add_argument('--decline-rate', type=float, default=0.0, help='Fraction of confirmations declined')
+        parser.add_argument('--webhook-url', type=str, default='', help='URL to deliver signed webhook events to')
+
+    def handle(self, *args, **options):
+        state = FakeStripeState(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            decline_rate=options['decline_rate'],
+            webhook_url=options['webhook_url'],
+            webhook_secret=settings.STRIPE_WEBHOOK_SECRET,
+        )
+        server = FakeStripeServer((options['host'], options['port']), state=state)
+
+        self.stdout.write(self.style.SUCCESS(f'Fake Stripe API listening on {server.api_base}'))
+        self.stdout.write(f'Set STRIPE_API_BASE={server.api_base} to route payments here.')
+        if options['webhook_url']:
+            self.stdout.write(f"Delivering webhooks to {options['webhook_url']}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('\nShutting down.')
+        finally:
+            server.server_close()
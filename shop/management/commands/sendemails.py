@@ -0,0 +1,71 @@
+from collections import Counter
+import logging
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+
+from shop.outbox import claim_jobs, deliver_jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued customer emails from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.EMAIL_OUTBOX_CONCURRENCY, help='Number of sender threads')
+        parser.add_argument('--batch-size', type=int, default=settings.EMAIL_BATCH_SIZE, help='Jobs claimed and sent over one connection by a thread at a time')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are due instead of polling')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        concurrency = max(1, options['concurrency'])
+        threads = [
+            threading.Thread(target=self._work, name=f'sendemails-{i}', daemon=True)
+            for i in range(concurrency)
+        ]
+        self.stdout.write(f'Draining email outbox with {concurrency} thread(s)...')
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            self.stdout.write('\nStopping after in-flight emails...')
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {self.counts['sent']}, retrying {self.counts['pending']}, dead {self.counts['dead']}."
+        ))
+
+    def _work(self):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    jobs = claim_jobs(self.options['batch_size'])
+                except DatabaseError as e:
+                    # Lock contention or a dropped connection; back off and retry
+                    logger.warning(f"Could not claim outbox jobs: {str(e)}")
+                    connection.close()
+                    self.stopping.wait(self.options['poll_interval'])
+                    continue
+                if not jobs:
+                    if self.options['once']:
+                        return
+                    self.stopping.wait(self.options['poll_interval'])
+                    continue
+                statuses = deliver_jobs(jobs)
+                with self.lock:
+                    self.counts.update(statuses)
+        finally:
+            connection.close()
@@ -0,0 +1,130 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules that should not be loaded by start-up alone (see shop/payments.py, shop/outbox.py)
+LAZY_MODULES = ('stripe', 'requests', 'shop.emails', 'django.core.mail.backends.smtp')
+
+# Run in a fresh interpreter per measurement; prints one JSON line
+CHILD_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+eagerly_loaded = [name for name in LAZY_MODULES if name in sys.modules]
+from django.urls import resolve
+resolve(PATH)
+urls_done = time.perf_counter()
+from django.test import Client
+client = Client(HTTP_HOST=HOST)
+status = client.get(PATH).status_code
+first_done = time.perf_counter()
+client.get(PATH)
+second_done = time.perf_counter()
+print(json.dumps({
+    'setup_seconds': setup_done - started,
+    'urlconf_seconds': urls_done - setup_done,
+    'first_request_seconds': first_done - urls_done,
+    'warm_request_seconds': second_done - first_done,
+    'time_to_first_request_seconds': first_done - started,
+    'modules': len(sys.modules),
+    'eagerly_loaded': eagerly_loaded,
+    'status': status,
+}))
+'''
+
+TIMINGS = (
+    'process_seconds', 'setup_seconds', 'urlconf_seconds', 'first_request_seconds',
+    'warm_request_seconds', 'time_to_first_request_seconds',
+)
+
+
+def _request_host():
+    for host in settings.ALLOWED_HOSTS:
+        if host and not host.startswith(('.', '*')):
+            return host
+    return 'localhost'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure worker cold start (django.setup(), URLconf and time to first request) '
+        'in fresh interpreters, optionally against a saved baseline'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh processes to measure (medians are reported)')
+        parser.add_argument('--path', type=str, default='/', help='Path of the first request')
+        parser.add_argument('--save', type=str, help='Write the results to this JSON file')
+        parser.add_argument('--baseline', type=str, help='Compare with results saved by --save')
+        parser.add_argument(
+            '--max-regression', type=float,
+            help='With --baseline: fail if time to first request is this many percent slower',
+        )
+
+    def handle(self, *args, **options):
+        if options['max_regression'] is not None and not options['baseline']:
+            raise CommandError('--max-regression requires --baseline')
+        script = (
+            f"LAZY_MODULES = {LAZY_MODULES!r}\nPATH = {options['path']!r}\nHOST = {_request_host()!r}\n"
+            + CHILD_SCRIPT
+        )
+        runs = []
+        for _ in range(max(1, options['runs'])):
+            started = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, '-c', script], cwd=settings.BASE_DIR, env=os.environ.copy(),
+                capture_output=True, text=True,
+            )
+            if completed.returncode:
+                raise CommandError(f'Benchmark process failed:\n{completed.stderr}')
+            run = json.loads(completed.stdout.strip().splitlines()[-1])
+            run['process_seconds'] = time.perf_counter() - started
+            runs.append(run)
+
+        results = {name: statistics.median(run[name] for run in runs) for name in TIMINGS}
+        results['modules'] = runs[-1]['modules']
+        results['eagerly_loaded'] = runs[-1]['eagerly_loaded']
+        results['status'] = runs[-1]['status']
+
+        self.stdout.write(f"=== STARTUP ({len(runs)} run(s), medians, first request GET {options['path']}) ===")
+        for name in TIMINGS:
+            self.stdout.write(f'{name}: {results[name] * 1000:.1f} ms')
+        self.stdout.write(f"modules loaded: {results['modules']}, first response: {results['status']}")
+        if results['eagerly_loaded']:
+            self.stdout.write(self.style.WARNING(
+                f"Loaded by start-up although only needed on use: {', '.join(results['eagerly_loaded'])}"
+            ))
+
+        if options['save']:
+            with open(options['save'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+        if options['baseline']:
+            self._compare(results, options['baseline'], options['max_regression'])
+
+    def _compare(self, results, baseline_path, max_regression):
+        try:
+            with open(baseline_path) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read baseline {baseline_path}: {e}')
+
+        self.stdout.write(f'\n=== COMPARED WITH {baseline_path} ===')
+        for name in TIMINGS:
+            if baseline.get(name):
+                change = (results[name] - baseline[name]) / baseline[name] * 100
+                self.stdout.write(f'{name}: {baseline[name] * 1000:.1f} -> {results[name] * 1000:.1f} ms ({change:+.0f}%)')
+
+        key = 'time_to_first_request_seconds'
+        if max_regression is not None and baseline.get(key):
+            change = (results[key] - baseline[key]) / baseline[key] * 100
+            if change > max_regression:
+                raise CommandError(f'Time to first request regressed by {change:.0f}% (limit {max_regression:g}%)')
@@ -0,0 +1,41 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from shop.models import Order, OrderEvent
+
+
+def _parse_day(value, option):
+    day = parse_date(value)
+    if day is None:
+        raise CommandError(f'Invalid {option}: {value!r} (expected YYYY-MM-DD)')
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class Command(BaseCommand):
+    help = 'Report how long orders spent in each status, from the order event log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=str, help='Only count entries into a status on or after this date')
+        parser.add_argument('--until', type=str, help='Only count entries into a status before this date')
+        parser.add_argument('--status', type=str, action='append', help='Status to report (repeatable; default: all)')
+
+    def handle(self, *args, **options):
+        events = OrderEvent.objects.all()
+        if options['since']:
+            events = events.filter(created_at__gte=_parse_day(options['since'], '--since'))
+        if options['until']:
+            events = events.filter(created_at__lt=_parse_day(options['until'], '--until'))
+
+        statuses = options['status'] or [value for value, _ in Order.STATUS_CHOICES]
+        self.stdout.write('=== TIME IN STATUS ===')
+        for status in statuses:
+            stats = events.time_in_status(status)
+            if not stats['count']:
+                self.stdout.write(f'{status}: no completed stays')
+                continue
+            self.stdout.write(
+                f"{status}: {stats['count']} stay(s), average {stats['average']}, longest {stats['longest']}"
+            )
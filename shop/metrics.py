@@ -0,0 +1,270 @@
+"""
+In-process request metrics, exposed in the Prometheus text format
+
+With METRICS_ENABLED, shop.middleware.MetricsMiddleware records per URL
+name: a latency histogram, database query count and time, cache hits and
+misses (shop/cache.py) and time spent calling Stripe and SMTP
+(``external_call``). The counters live in the worker process and are
+served by the ``metrics`` view, together with the database connection
+(shop/dbconnections.py) and cache counters. With METRICS_ENABLED off the
+middleware removes itself and ``external_call`` does nothing.
+
+Each worker process has its own registry; scrape every worker (or run
+one worker per scrape target) to see all traffic.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .dbconnections import connection_metrics
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    # In full: '{:g}' keeps 6 significant digits, and a counter past a
+    # million would only move in steps of thousands
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class CounterMetric:
+    """Monotonic counter per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = defaultdict(float)
+
+    def inc(self, labels, amount=1):
+        self.values[labels] += amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+
+
+class HistogramMetric:
+    """Cumulative histogram per label combination"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}'
+
+
+class Registry:
+    """The process's metrics; one lock serialises updates and rendering"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def counter(self, name, documentation, label_names=()):
+        metric = CounterMetric(name, documentation, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = HistogramMetric(name, documentation, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, extra_metrics=()):
+        lines = []
+        with self.lock:
+            for metric in list(self.metrics) + list(extra_metrics):
+                lines.append(f'# HELP {metric.name} {metric.documentation}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+                lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_DURATION = registry.histogram(
+    'shop_http_request_duration_seconds', 'Time to produce a response, by URL name',
+    ('view', 'method', 'status'),
+)
+REQUEST_QUERIES = registry.counter(
+    'shop_http_db_queries_total', 'Database queries run while serving requests', ('view',),
+)
+REQUEST_QUERY_SECONDS = registry.counter(
+    'shop_http_db_query_seconds_total', 'Time spent in database queries while serving requests', ('view',),
+)
+REQUEST_CACHE_EVENTS = registry.counter(
+    'shop_http_cache_events_total', 'Cache hits and misses while serving requests', ('view', 'event'),
+)
+REQUEST_EXTERNAL_SECONDS = registry.counter(
+    'shop_http_external_seconds_total', 'Time spent calling Stripe or SMTP while serving requests',
+    ('view', 'service'),
+)
+EXTERNAL_CALL_DURATION = registry.histogram(
+    'shop_external_call_duration_seconds', 'Duration of Stripe and SMTP calls', ('service', 'operation', 'outcome'),
+)
+
+
+class RequestStats:
+    """What one request spent, filled in while it is served"""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.cache_events = defaultdict(int)
+        self.external_seconds = defaultdict(float)
+
+    def record_query(self, execute, sql, params, many, context):
+        """Execute wrapper timing every query of the request"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+_request_stats = ContextVar('shop_request_metrics', default=None)
+
+
+@contextmanager
+def collect_request_metrics(stats):
+    """
+    Count cache events and external calls made inside the block against
+    ``stats`` (RequestStats); queries are counted by its ``record_query``
+    execute wrapper
+    """
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+def finish_request_metrics(stats, view, method, status, duration):
+    """Add a served request to the registry"""
+    labels = (view,)
+    with registry.lock:
+        REQUEST_DURATION.observe((view, method, str(status)), duration)
+        REQUEST_QUERIES.inc(labels, stats.queries)
+        REQUEST_QUERY_SECONDS.inc(labels, stats.query_seconds)
+        for event, count in stats.cache_events.items():
+            REQUEST_CACHE_EVENTS.inc((view, event), count)
+        for service, seconds in stats.external_seconds.items():
+            REQUEST_EXTERNAL_SECONDS.inc((view, service), seconds)
+
+
+def record_cache_event(event, count=1):
+    """Count a cache event against the request being served, if any"""
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.cache_events[event] += count
+
+
+@contextmanager
+def _timed_external_call(service, operation):
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        duration = time.perf_counter() - started
+        with registry.lock:
+            EXTERNAL_CALL_DURATION.observe((service, operation, outcome), duration)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.external_seconds[service] += duration
+
+
+def external_call(service, operation):
+    """
+    Context manager timing a call to an external service
+
+    Args:
+        service: 'stripe' or 'smtp'
+        operation: What is called, e.g. 'payment_intent.create'
+    """
+    if not settings.METRICS_ENABLED:
+        return nullcontext()
+    return _timed_external_call(service, operation)
+
+
+class _Snapshot:
+    """Counters read from another module's stats at render time"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names, rows):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.rows = rows
+
+    def samples(self):
+        for labels, value in self.rows:
+            yield f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+
+
+def render_metrics():
+    """All metrics of this process in the Prometheus text format"""
+    connection_rows = [
+        ((alias, event), value)
+        for alias, stats in sorted(connection_metrics.snapshot().items())
+        for event, value in stats.items()
+        if event in ('opens', 'reuses', 'health_check_failures', 'recycled', 'discarded', 'connect_seconds_total')
+    ]
+    cache_rows = [
+        ((alias, event), value)
+        for alias in settings.CACHES
+        if hasattr(caches[alias], 'stats')
+        for event, value in sorted(caches[alias].stats().items())
+        if event != 'local_entries'
+    ]
+    return registry.render([
+        _Snapshot('shop_db_connection_events_total', 'Database connection events', ('alias', 'event'), connection_rows),
+        _Snapshot('shop_cache_events_total', 'Two-tier cache events', ('cache', 'event'), cache_rows),
+    ])
@@ -0,0 +1,330 @@
+"""
+Request middleware for the shop
+"""
+from contextlib import ExitStack, contextmanager
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+
+from .compression import choose_encoding, compress_content, compress_stream, is_compressible
+from .metrics import RequestStats, collect_request_metrics, finish_request_metrics
+from .profiling import finish_profile, start_profile
+from .ratelimit import check_limits
+from .routers import (
+    current_request_routing, end_request_routing, record_writes, resume_request_routing, start_request_routing,
+)
+
+# Cookie holding the time until which a browser reads from the primary
+PIN_COOKIE_NAME = 'db_primary_until'
+
+# Response header naming the profile stored for a staff-requested profile
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+# Bodies of rate-limited responses; JSON for the cart and checkout scripts
+RATE_LIMITED_TEXT = b'Too many requests, please wait a moment and try again.'
+RATE_LIMITED_JSON = b'{"success": false, "message": "Too many requests, please wait a moment and try again."}'
+
+
+class StreamWithin:
+    """
+    Streaming content that produces each chunk inside ``context()`` and
+    calls ``on_close()`` once, when the stream ends or is closed
+
+    A StreamingHttpResponse is consumed after the middleware has returned;
+    this keeps what the middleware set up for the request (replica routing,
+    metrics, profiling) in place for the queries the stream still runs.
+    """
+
+    def __init__(self, content, context, on_close=None):
+        self.content = content
+        self.iterator = iter(content)
+        self.context = context
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        with self.context():
+            try:
+                return next(self.iterator)
+            except StopIteration:
+                self.close()
+                raise
+
+    def close(self):
+        # Called by the response (see HttpResponseBase.close) even when the
+        # stream was never read
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+def stream_within(response, context, on_close=None):
+    """
+    Wrap a sync streaming response's content in StreamWithin
+
+    Returns:
+        bool: whether the response was wrapped
+    """
+    if not response.streaming or getattr(response, 'is_async', False):
+        return False
+    response.streaming_content = StreamWithin(response.streaming_content, context, on_close)
+    return True
+
+
+class ReplicaPinningMiddleware:
+    """
+    Route a request's reads to replicas unless its browser wrote recently
+
+    When a request writes to the primary, the browser gets a short-lived
+    cookie that keeps its reads on the primary for REPLICA_PIN_SECONDS, long
+    enough for the replicas to catch up, so users always see their own
+    changes. Streaming responses keep the request's routing while they are
+    consumed; writes made by the stream itself come too late to pin.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'DATABASE_REPLICAS', []):
+            return self.get_response(request)
+
+        try:
+            pinned = float(request.COOKIES.get(PIN_COOKIE_NAME, 0)) > time.time()
+        except ValueError:
+            pinned = False
+
+        token = start_request_routing(pinned)
+        state = current_request_routing()
+        try:
+            with connections[DEFAULT_DB_ALIAS].execute_wrapper(record_writes):
+                response = self.get_response(request)
+        finally:
+            wrote = end_request_routing(token)
+        stream_within(response, lambda: self._routing(state))
+
+        if wrote:
+            pin_seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(
+                PIN_COOKIE_NAME, str(int(time.time()) + pin_seconds),
+                max_age=pin_seconds, httponly=True, samesite='Lax',
+                secure=request.is_secure(),
+            )
+        return response
+
+    @staticmethod
+    @contextmanager
+    def _routing(state):
+        with resume_request_routing(state), connections[DEFAULT_DB_ALIAS].execute_wrapper(record_writes):
+            yield
+
+
+class MetricsMiddleware:
+    """
+    Record latency, queries, cache and external calls per URL name
+
+    See shop/metrics.py; removed from the stack unless METRICS_ENABLED. A
+    streaming response is recorded once it has been sent, with the queries
+    it ran while streaming.
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        started = time.perf_counter()
+        response = None
+
+        def finish():
+            match = request.resolver_match
+            finish_request_metrics(
+                stats,
+                view=match.view_name if match else '<unresolved>',
+                method=request.method,
+                status=response.status_code if response is not None else 500,
+                duration=time.perf_counter() - started,
+            )
+
+        try:
+            with self._collecting(stats):
+                response = self.get_response(request)
+        finally:
+            if response is None or not stream_within(response, lambda: self._collecting(stats), finish):
+                finish()
+        return response
+
+    @staticmethod
+    @contextmanager
+    def _collecting(stats):
+        with collect_request_metrics(stats), ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(stats.record_query))
+            yield
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests asked for by staff (PROFILE_HEADER) or sampled at random
+
+    See shop/profiling.py. Staff get the stored profile's id back in the
+    X-Profile-Id response header, except for streaming responses: those are
+    profiled until they have been sent, after their headers went out. Must
+    come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILE_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reason = self._trigger(request)
+        profile = start_profile() if reason else None
+        if profile is None:
+            return self.get_response(request)
+
+        response = None
+        try:
+            with self._recording(profile):
+                response = self.get_response(request)
+        finally:
+            if response is None:
+                finish_profile(profile, request, 500, reason)
+        if stream_within(
+            response, lambda: self._recording(profile),
+            lambda: finish_profile(profile, request, response.status_code, reason),
+        ):
+            return response
+        profile_id = finish_profile(profile, request, response.status_code, reason)
+        if profile_id and reason == 'header':
+            response[PROFILE_ID_HEADER] = profile_id
+        return response
+
+    @staticmethod
+    @contextmanager
+    def _recording(profile):
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(profile.record_query))
+            yield
+
+    def _trigger(self, request):
+        if request.headers.get(settings.PROFILE_HEADER) and request.user.is_staff:
+            return 'header'
+        if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            return 'sample'
+        return None
+
+
+class RateLimitMiddleware:
+    """
+    Answer 429 to requests over the RATE_LIMITS of their URL name
+
+    See shop/ratelimit.py. Limited requests are answered before the rest of
+    the middleware runs, so they never save a session (sessions are saved on
+    every request) and build the response without templates or database
+    access; 'user' limits only read the session to find the user.
+    """
+
+    def __init__(self, get_response):
+        if not settings.RATELIMIT_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.limits = None
+
+    def __call__(self, request):
+        if self.limits is None:
+            # Imported on first use so the URLconf is not loaded with the middleware
+            from . import urls
+            self.limits = {f'{urls.app_name}:{name}': limits for name, limits in urls.RATE_LIMITS.items()}
+
+        try:
+            view_name = resolve(request.path_info).view_name
+        except Resolver404:
+            return self.get_response(request)
+        limits = self.limits.get(view_name)
+        wait = check_limits(request, view_name, limits) if limits else 0
+        if not wait:
+            return self.get_response(request)
+
+        if request.content_type == 'application/json':
+            response = HttpResponse(RATE_LIMITED_JSON, status=429, content_type='application/json')
+        else:
+            response = HttpResponse(RATE_LIMITED_TEXT, status=429, content_type='text/plain; charset=utf-8')
+        response['Retry-After'] = str(math.ceil(wait))
+        return response
+
+
+class CompressionMiddleware:
+    """
+    Compress text, HTML and JSON responses with brotli or gzip
+
+    See shop/compression.py. Must come before any middleware that reads or
+    changes the response body.
+    """
+
+    def __init__(self, get_response):
+        if not settings.COMPRESSION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or not is_compressible(response.get('Content-Type', '')):
+            return response
+        if getattr(response, 'is_async', False):
+            # Async iterators would need an async compressor; served as is
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        # A page that set the CSRF cookie contains the token; see shop/compression.py
+        encoding = choose_encoding(
+            request.headers.get('Accept-Encoding', ''),
+            allow_brotli=settings.CSRF_COOKIE_NAME not in response.cookies,
+        )
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_stream(
+                response.streaming_content, encoding,
+                # Progressive pages (see the my_orders view) flush per chunk
+                flush=response.get('X-Accel-Buffering') == 'no',
+            )
+            del response.headers['Content-Length']
+        else:
+            if len(response.content) < settings.COMPRESSION_MIN_SIZE:
+                return response
+            compressed = compress_content(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The compressed body differs byte for byte from what a strong ETag named
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,45 @@
+"""
+Migration operations that avoid blocking writes on large tables
+
+On MySQL, ``CREATE INDEX`` may fall back to copying the table under a lock
+when an in-place build is not possible. The operations here ask for
+``ALGORITHM=INPLACE, LOCK=NONE`` explicitly, so the migration either builds
+the index while reads and writes continue or fails straight away instead of
+quietly locking the table. Other databases use Django's default DDL.
+"""
+from django.db.migrations.operations import AddIndex
+
+ONLINE_DDL_SUFFIX = ' ALGORITHM=INPLACE LOCK=NONE'
+
+
+def add_index_online(schema_editor, model, index):
+    """Create ``index`` on ``model``'s table, online where the database allows"""
+    if schema_editor.connection.vendor != 'mysql':
+        schema_editor.add_index(model, index)
+        return
+    schema_editor.execute(str(index.create_sql(model, schema_editor)) + ONLINE_DDL_SUFFIX)
+
+
+def remove_index_online(schema_editor, model, index):
+    """Drop ``index`` from ``model``'s table, online where the database allows"""
+    if schema_editor.connection.vendor != 'mysql':
+        schema_editor.remove_index(model, index)
+        return
+    schema_editor.execute(str(index.remove_sql(model, schema_editor)) + ONLINE_DDL_SUFFIX)
+
+
+class AddIndexOnline(AddIndex):
+    """AddIndex that builds the index without locking the table on MySQL"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            add_index_online(schema_editor, model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            remove_index_online(schema_editor, model, self.index)
+
+    def describe(self):
+        return super().describe() + ' (online)'
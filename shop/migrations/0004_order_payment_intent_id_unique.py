@@ -0,0 +1,63 @@
+# Generated by Django 5.2 on 2026-10-19 13:51
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def blank_payment_intents_to_null(apps, schema_editor):
+    # Empty strings would collide under the unique index; NULLs do not.
+    Order = apps.get_model("shop", "Order")
+    Order.objects.filter(payment_intent_id="").update(payment_intent_id=None)
+
+
+def check_duplicate_payment_intents(apps, schema_editor):
+    # Orders placed twice for one PaymentIntent (double-submitted checkouts)
+    # would make the unique index fail half way. Which of them to keep, and
+    # whether the customer was charged twice, needs a person: stop and list
+    # them instead of picking one.
+    Order = apps.get_model("shop", "Order")
+    duplicated = (
+        Order.objects.filter(payment_intent_id__isnull=False)
+        .values("payment_intent_id")
+        .annotate(orders=Count("id"))
+        .filter(orders__gt=1)
+        .values_list("payment_intent_id", flat=True)
+    )
+    groups = {}
+    for intent_id, order_id in (
+        Order.objects.filter(payment_intent_id__in=list(duplicated))
+        .order_by("payment_intent_id", "created_at", "id")
+        .values_list("payment_intent_id", "id")
+    ):
+        groups.setdefault(intent_id, []).append(order_id)
+    if groups:
+        lines = "\n".join(
+            f"  {intent_id}: orders {', '.join(f'#{order_id}' for order_id in order_ids)}"
+            for intent_id, order_ids in sorted(groups.items())
+        )
+        raise RuntimeError(
+            f"{len(groups)} PaymentIntent(s) have more than one order; cancel or "
+            f"refund the extra orders and clear their payment_intent_id, keeping "
+            f"the earliest, then migrate again:\n{lines}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0003_order_tracking_number_order_tracking_url"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            blank_payment_intents_to_null, migrations.RunPython.noop
+        ),
+        migrations.RunPython(
+            check_duplicate_payment_intents, migrations.RunPython.noop
+        ),
+        migrations.AlterField(
+            model_name="order",
+            name="payment_intent_id",
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
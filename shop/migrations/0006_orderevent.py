@@ -0,0 +1,66 @@
+# Generated by Django 5.2 on 2026-10-19 14:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0005_emailoutbox"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "field",
+                    models.CharField(
+                        choices=[
+                            ("status", "Status"),
+                            ("payment_status", "Payment Status"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("from_value", models.CharField(blank=True, max_length=20)),
+                ("to_value", models.CharField(max_length=20)),
+                ("source", models.CharField(blank=True, max_length=50)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="events",
+                        to="shop.order",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["created_at", "id"],
+                "indexes": [
+                    models.Index(
+                        fields=["order", "created_at"], name="shop_orderevent_order_idx"
+                    ),
+                    models.Index(
+                        fields=["field", "to_value", "created_at"],
+                        name="shop_orderevent_status_idx",
+                    ),
+                    models.Index(
+                        fields=["created_at"], name="shop_orderevent_created_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
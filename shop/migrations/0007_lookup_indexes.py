@@ -0,0 +1,61 @@
+# Generated by Django 5.2 on 2026-10-19 14:03
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+from shop.migration_operations import (
+    AddIndexOnline,
+    add_index_online,
+    remove_index_online,
+)
+
+# auth.User belongs to another app, so this index cannot live in a model's
+# Meta; SignUpForm.clean_email filters on LOWER(email) to use it.
+USER_EMAIL_INDEX = models.Index(Lower("email"), name="shop_user_email_lower_idx")
+
+
+def add_user_email_index(apps, schema_editor):
+    # Functional indexes need MySQL 8.0.13+ (not MariaDB)
+    if schema_editor.connection.features.supports_expression_indexes:
+        add_index_online(
+            schema_editor, apps.get_model("auth", "User"), USER_EMAIL_INDEX
+        )
+
+
+def remove_user_email_index(apps, schema_editor):
+    if schema_editor.connection.features.supports_expression_indexes:
+        remove_index_online(
+            schema_editor, apps.get_model("auth", "User"), USER_EMAIL_INDEX
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("shop", "0006_orderevent"),
+    ]
+
+    # MySQL cannot run DDL inside a transaction anyway, and keeping each index
+    # build separate means a failure leaves the earlier ones in place
+    atomic = False
+
+    operations = [
+        AddIndexOnline(
+            model_name="cart",
+            index=models.Index(fields=["session_key"], name="shop_cart_session_idx"),
+        ),
+        AddIndexOnline(
+            model_name="order",
+            index=models.Index(
+                fields=["customer", "created_at"], name="shop_order_customer_idx"
+            ),
+        ),
+        AddIndexOnline(
+            model_name="order",
+            index=models.Index(
+                fields=["status", "created_at"], name="shop_order_status_idx"
+            ),
+        ),
+        migrations.RunPython(add_user_email_index, remove_user_email_index),
+    ]
@@ -0,0 +1,151 @@
+# Generated by Django 5.2 on 2026-10-19 14:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from shop.migration_operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0007_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyOrderStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("processing", "Processing"),
+                            ("shipped", "Shipped"),
+                            ("delivered", "Delivered"),
+                            ("cancelled", "Cancelled"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("order_count", models.PositiveIntegerField(default=0)),
+                ("item_count", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+            ],
+            options={
+                "verbose_name": "daily sales",
+                "verbose_name_plural": "daily sales",
+                "ordering": ["-day", "status"],
+            },
+        ),
+        migrations.CreateModel(
+            name="DailyProductSales",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("size", models.CharField(max_length=10)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("processing", "Processing"),
+                            ("shipped", "Shipped"),
+                            ("delivered", "Delivered"),
+                            ("cancelled", "Cancelled"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("order_count", models.PositiveIntegerField(default=0)),
+                ("quantity", models.PositiveIntegerField(default=0)),
+                (
+                    "revenue",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+            ],
+            options={
+                "ordering": ["-day", "product", "size", "status"],
+            },
+        ),
+        migrations.CreateModel(
+            name="Watermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50, unique=True)),
+                ("timestamp", models.DateTimeField(blank=True, null=True)),
+                ("last_id", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        AddIndexOnline(
+            model_name="order",
+            index=models.Index(fields=["created_at"], name="shop_order_created_idx"),
+        ),
+        AddIndexOnline(
+            model_name="order",
+            index=models.Index(fields=["updated_at"], name="shop_order_updated_idx"),
+        ),
+        migrations.AlterUniqueTogether(
+            name="dailyorderstats",
+            unique_together={("day", "status")},
+        ),
+        migrations.AddField(
+            model_name="dailyproductsales",
+            name="category",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="shop.category",
+            ),
+        ),
+        migrations.AddField(
+            model_name="dailyproductsales",
+            name="product",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="shop.product",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="dailyproductsales",
+            index=models.Index(
+                fields=["day", "category"], name="shop_dailysales_category_idx"
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="dailyproductsales",
+            unique_together={("day", "product", "size", "status")},
+        ),
+    ]
@@ -1,7 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
 
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -63,7 +64,69 @@ class Customer(models.Model):
             return f"{self.user.first_name} {self.user.last_name}"
         return self.user.username
 
-class Order(models.Model):
+class DirtyFieldsMixin:
+    """
+    Remember the database values of ``tracked_fields`` as the instance is
+    loaded, so changes can be detected without re-reading the row.
+    
+    The snapshot is taken in from_db() and refreshed after every save(); in
+    post_save receivers it still holds the values from before the save.
+    """
+    tracked_fields = ()
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+    
+    def _snapshot_tracked_fields(self, fields=None):
+        # Deferred fields are not in __dict__ and are left out of the snapshot
+        fields = self.tracked_fields if fields is None else [f for f in fields if f in self.tracked_fields]
+        loaded = getattr(self, '_loaded_values', {}) if fields is not self.tracked_fields else {}
+        self._loaded_values = {
+            **loaded,
+            **{field: self.__dict__[field] for field in fields if field in self.__dict__},
+        }
+    
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # Loading a deferred field only adds that field to the snapshot
+        self._snapshot_tracked_fields(fields)
+    
+    def get_loaded_value(self, field):
+        """Value of ``field`` when the instance was loaded or last saved"""
+        return getattr(self, '_loaded_values', {}).get(field)
+    
+    def has_changed(self, field):
+        return getattr(self, field) != self.get_loaded_value(field)
+    
+    def get_dirty_fields(self):
+        """Map of tracked fields that changed since load to their old values"""
+        return {
+            field: self.get_loaded_value(field)
+            for field in self.tracked_fields
+            if self.has_changed(field)
+        }
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self._load_untracked_values()
+        super().save(*args, **kwargs)
+        self._snapshot_tracked_fields()
+    
+    def _load_untracked_values(self):
+        """Fetch old values of tracked fields that were deferred at load time"""
+        loaded = getattr(self, '_loaded_values', {})
+        missing = [field for field in self.tracked_fields if field not in loaded]
+        if not missing or self.pk is None:
+            return
+        row = type(self)._base_manager.filter(pk=self.pk).values(*missing).first()
+        if row:
+            self._loaded_values = {**loaded, **row}
+
+
+class Order(DirtyFieldsMixin, models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('processing', 'Processing'),
@@ -75,6 +138,7 @@ class Order(models.Model):
     PAYMENT_STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('completed', 'Completed'),
+        ('refund_requested', 'Refund Requested'),
         ('failed', 'Failed'),
         ('refunded', 'Refunded'),
     ]
@@ -88,7 +152,7 @@ class Order(models.Model):
     
     # Payment fields
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
-    payment_intent_id = models.CharField(max_length=255, blank=True, null=True)
+    payment_intent_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     stripe_charge_id = models.CharField(max_length=255, blank=True, null=True)
     payment_method = models.CharField(max_length=50, default='card')
     
@@ -96,11 +160,124 @@ class Order(models.Model):
     tracking_number = models.CharField(max_length=255, blank=True, null=True)
     tracking_url = models.URLField(blank=True, null=True)
     
+    tracked_fields = ('status', 'payment_status')
+    
+    # What is changing the order, recorded on its OrderEvents; callers may
+    # set it on the instance before save()
+    change_source = 'app'
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # A customer's orders, newest first (My Orders, customer admin)
+            models.Index(fields=['customer', 'created_at'], name='shop_order_customer_idx'),
+            # Admin status filter, newest first
+            models.Index(fields=['status', 'created_at'], name='shop_order_status_idx'),
+            # Day ranges recomputed by the sales rollups
+            models.Index(fields=['created_at'], name='shop_order_created_idx'),
+            # Orders changed since the sales rollup watermark
+            models.Index(fields=['updated_at'], name='shop_order_updated_idx'),
+        ]
     
     def __str__(self):
         return f"Order #{self.id} - {self.customer.user.username}"
+    
+    def save(self, *args, **kwargs):
+        # post_save receivers record events and queue outbox emails; keep
+        # them in the same transaction as the row change.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+class OrderEventQuerySet(models.QuerySet):
+    def record_changes(self, changes, source, at=None):
+        """
+        Append events for a batch of changes with one INSERT
+        
+        Args:
+            changes: Iterable of (order_id, field, from_value, to_value)
+            source: Short label of what made the change
+            at: Event time (default: now)
+        """
+        at = at or timezone.now()
+        return self.bulk_create([
+            OrderEvent(
+                order_id=order_id,
+                field=field,
+                from_value=from_value or '',
+                to_value=to_value,
+                source=source,
+                created_at=at,
+            )
+            for order_id, field, from_value, to_value in changes
+        ], batch_size=1000)
+    
+    def status_durations(self, status, field='status'):
+        """
+        Entries into ``status`` annotated with when the order left it again
+        (``left_at``, NULL if it still has that status) and ``duration``
+        """
+        next_change = OrderEvent.objects.filter(
+            order_id=models.OuterRef('order_id'),
+            field=field,
+            created_at__gt=models.OuterRef('created_at'),
+        ).order_by('created_at').values('created_at')[:1]
+        return self.filter(field=field, to_value=status).annotate(
+            left_at=models.Subquery(next_change),
+        ).annotate(
+            duration=models.ExpressionWrapper(
+                models.F('left_at') - models.F('created_at'),
+                output_field=models.DurationField(),
+            ),
+        )
+    
+    def time_in_status(self, status, field='status'):
+        """Count, average and maximum time spent in ``status`` by orders that left it"""
+        return self.status_durations(status, field).filter(left_at__isnull=False).aggregate(
+            count=models.Count('id'),
+            average=models.Avg('duration'),
+            longest=models.Max('duration'),
+        )
+
+
+class OrderEvent(models.Model):
+    """
+    Append-only history of Order status and payment status changes.
+    
+    Events are written in the same transaction as the change itself.
+    """
+    FIELD_CHOICES = [
+        ('status', 'Status'),
+        ('payment_status', 'Payment Status'),
+    ]
+    
+    order = models.ForeignKey(Order, related_name='events', on_delete=models.CASCADE)
+    field = models.CharField(max_length=20, choices=FIELD_CHOICES)
+    from_value = models.CharField(max_length=20, blank=True)
+    to_value = models.CharField(max_length=20)
+    source = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    objects = OrderEventQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            # Per-order timeline
+            models.Index(fields=['order', 'created_at'], name='shop_orderevent_order_idx'),
+            # "Which orders entered status X between A and B"
+            models.Index(fields=['field', 'to_value', 'created_at'], name='shop_orderevent_status_idx'),
+            # Time-range scans
+            models.Index(fields=['created_at'], name='shop_orderevent_created_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.field} {self.from_value or '-'} -> {self.to_value}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Order events are append-only and cannot be changed.")
+        super().save(*args, **kwargs)
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
@@ -120,6 +297,12 @@ class Cart(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Looked up on every cart request
+            models.Index(fields=['session_key'], name='shop_cart_session_idx'),
+        ]
+    
     def __str__(self):
         return f"Cart {self.session_key}"
     
@@ -142,4 +325,143 @@ class CartItem(models.Model):
         return f"{self.quantity}x {self.product.name} ({self.size})"
     
     def get_total_price(self):
-        return self.quantity * self.product.price
\ No newline at end of file
+        return self.quantity * self.product.price
+
+class EmailOutbox(models.Model):
+    """
+    Customer email waiting to be delivered by the `sendemails` worker.
+
+    Jobs are written in the same transaction as the order change that
+    triggers them, so an email is queued exactly when the change commits.
+    """
+    KIND_CHOICES = [
+        ('order_confirmation', 'Order Confirmation'),
+        ('refund_confirmation', 'Refund Confirmation'),
+        ('order_shipped', 'Order Shipped'),
+        ('order_delivered', 'Order Delivered'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('dead', 'Dead'),
+    ]
+    
+    order = models.ForeignKey(Order, related_name='emails', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    site_url = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'outbox email'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='shop_outbox_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} for Order #{self.order_id} ({self.status})"
+
+
+class Watermark(models.Model):
+    """
+    How far an incremental background job has got, by name.
+
+    Jobs keep either a timestamp (e.g. the last ``updated_at`` processed) or
+    the last id processed, whichever suits their input.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    timestamp = models.DateTimeField(blank=True, null=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return self.name
+
+
+class DailyOrderStats(models.Model):
+    """
+    Orders placed per day and current status, maintained by `rollupsales`.
+    """
+    day = models.DateField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    order_count = models.PositiveIntegerField(default=0)
+    item_count = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        ordering = ['-day', 'status']
+        unique_together = ['day', 'status']
+        verbose_name = 'daily sales'
+        verbose_name_plural = 'daily sales'
+    
+    def __str__(self):
+        return f"{self.day} {self.status}: {self.order_count} orders"
+
+
+class DailyProductSales(models.Model):
+    """
+    Line items sold per day, product, size and order status, maintained by
+    `rollupsales`. The product's category is copied in so category totals
+    need no join.
+    """
+    day = models.DateField()
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, related_name='+', on_delete=models.CASCADE)
+    size = models.CharField(max_length=10)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    order_count = models.PositiveIntegerField(default=0)
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        ordering = ['-day', 'product', 'size', 'status']
+        unique_together = ['day', 'product', 'size', 'status']
+        indexes = [
+            models.Index(fields=['day', 'category'], name='shop_dailysales_category_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.product_id} {self.size} {self.status}: {self.quantity}"
+
+
+class ProductPairCount(models.Model):
+    """
+    Number of orders that contained both products, stored in both directions
+    so the neighbours of a product are one index range. Maintained by
+    `refreshrecommendations`.
+    """
+    product = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    other = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['product', 'other']
+    
+    def __str__(self):
+        return f"{self.product_id} + {self.other_id}: {self.count}"
+
+
+class ProductRecommendation(models.Model):
+    """
+    Top co-purchased products per product ("customers also bought"),
+    rebuilt from ProductPairCount for every product it changes.
+    """
+    product = models.ForeignKey(Product, related_name='recommendations', on_delete=models.CASCADE)
+    recommended = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.PositiveIntegerField()
+    
+    class Meta:
+        ordering = ['product', 'rank']
+        # Also the index the product page reads through
+        unique_together = ['product', 'rank']
+    
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} (#{self.rank})"
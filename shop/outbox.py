@@ -0,0 +1,155 @@
+"""
+Transactional email outbox
+
+Views, signals and admin actions record email jobs with ``enqueue_email``
+inside the transaction that changes the order. The ``sendemails`` management
+command drains the outbox in the background, retrying failed deliveries with
+exponential backoff until they are sent or moved to the dead-letter state.
+"""
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EmailOutbox, Order
+
+logger = logging.getLogger(__name__)
+
+# How long a claimed job may stay in 'sending' before another worker retries
+# it, at least; see claim_lease()
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+def get_site_url(request=None):
+    """Base URL used for links in emails"""
+    if request:
+        return request.build_absolute_uri('/')[:-1]
+    return 'http://localhost:8000'
+
+
+def enqueue_email(kind, order, request=None):
+    """
+    Queue an email for an order
+
+    Call this inside the transaction that makes the triggering change so the
+    job is committed (or rolled back) together with it.
+
+    Args:
+        kind: One of EmailOutbox.KIND_CHOICES
+        order: Order instance
+        request: HttpRequest instance (optional, for site URL)
+
+    Returns:
+        EmailOutbox: the queued job
+    """
+    return EmailOutbox.objects.create(order=order, kind=kind, site_url=get_site_url(request))
+
+
+def enqueue_emails(kind, order_ids, request=None):
+    """Queue the same kind of email for many orders in one INSERT"""
+    site_url = get_site_url(request)
+    return EmailOutbox.objects.bulk_create(
+        [EmailOutbox(order_id=order_id, kind=kind, site_url=site_url) for order_id in order_ids],
+        batch_size=1000,
+    )
+
+
+def claim_lease(limit):
+    """
+    How long ``limit`` claimed jobs are leased for
+
+    Long enough for the slowest batch: each message may wait EMAIL_TIMEOUT
+    to connect, to send and to reconnect after a failure.
+    """
+    return max(CLAIM_LEASE, timedelta(seconds=3 * settings.EMAIL_TIMEOUT * limit))
+
+
+def claim_jobs(limit):
+    """
+    Atomically take up to ``limit`` due jobs for this worker
+
+    Rows locked by other workers are skipped. Claimed jobs are leased: if the
+    worker dies, they become due again once the lease (``claim_lease``) has
+    passed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status__in=['pending', 'sending'], next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:limit]
+        )
+        if not jobs:
+            return []
+        EmailOutbox.objects.filter(id__in=[job.id for job in jobs]).update(
+            status='sending', next_attempt_at=now + claim_lease(limit)
+        )
+    return jobs
+
+
+def retry_delay(attempts):
+    """Exponential backoff for the given number of failed attempts"""
+    delay = settings.EMAIL_OUTBOX_RETRY_SECONDS * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_MAX_RETRY_SECONDS))
+
+
+def deliver_jobs(jobs):
+    """
+    Send a list of claimed jobs over one reused mail connection, recording
+    each outcome as soon as it is known
+
+    A job is marked sent right after its message went out, so a worker that
+    dies mid-batch only leaves the unsent jobs to be retried.
+
+    Returns:
+        list: the new status of each job
+    """
+    # Imported here so processes that only queue emails never load the
+    # rendering and mail stack
+    from .emails import send_order_email_batch
+
+    orders = Order.objects.select_related('customer__user').in_bulk(
+        {job.order_id for job in jobs}
+    )
+    statuses = {}
+    for job in jobs:
+        if job.order_id not in orders:
+            # Deleted since the job was claimed
+            statuses[job.pk] = _finish(job, 'dead', job.attempts + 1, error='Order no longer exists')
+    deliverable = [job for job in jobs if job.order_id in orders]
+
+    def record(index, result):
+        job = deliverable[index]
+        statuses[job.pk] = _record_result(job, result)
+
+    send_order_email_batch(
+        [(job.kind, orders[job.order_id], job.site_url) for job in deliverable],
+        on_result=record,
+    )
+    return [statuses[job.pk] for job in jobs]
+
+
+def _record_result(job, result):
+    attempts = job.attempts + 1
+    if result is True:
+        return _finish(job, 'sent', attempts, sent_at=timezone.now())
+    if result is False:
+        # Nothing to retry: the customer has no email address
+        return _finish(job, 'dead', attempts, error='No recipient email address')
+    if attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"Giving up on {job.kind} email for order #{job.order_id} after {attempts} attempts: {str(result)}")
+        return _finish(job, 'dead', attempts, error=str(result))
+    logger.warning(f"Retrying {job.kind} email for order #{job.order_id} (attempt {attempts}): {str(result)}")
+    return _finish(job, 'pending', attempts, error=str(result), retry_at=timezone.now() + retry_delay(attempts))
+
+
+def _finish(job, status, attempts, error='', retry_at=None, sent_at=None):
+    fields = {'status': status, 'attempts': attempts, 'last_error': error}
+    if retry_at:
+        fields['next_attempt_at'] = retry_at
+    if sent_at:
+        fields['sent_at'] = sent_at
+    EmailOutbox.objects.filter(pk=job.pk).update(**fields)
+    return status
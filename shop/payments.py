@@ -0,0 +1,23 @@
+"""
+Stripe client configuration shared by views and management commands
+
+The stripe package (and requests, which it loads) takes a noticeable part
+of process start-up, so it is only imported by the first configure_stripe()
+call; code that talks to Stripe gets the module from there.
+"""
+from django.conf import settings
+
+
+def configure_stripe():
+    """
+    Import the Stripe client and apply the Stripe settings to it
+
+    Returns:
+        module: the configured ``stripe`` module
+    """
+    import stripe
+
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    if settings.STRIPE_API_BASE:
+        stripe.api_base = settings.STRIPE_API_BASE
+    return stripe
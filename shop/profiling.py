@@ -0,0 +1,196 @@
+"""
+On-demand sampling profiler for production requests
+
+A request is profiled when a staff user sends the PROFILE_HEADER header,
+or at random for a PROFILE_SAMPLE_RATE fraction of requests (see
+shop.middleware.ProfilingMiddleware). While it is served, a background
+thread reads the request thread's stack every PROFILE_INTERVAL_MS through
+``sys._current_frames()``, and every SQL statement is timed. Two files are
+written to PROFILE_DIR per profile:
+
+- <id>.folded: one "frame;frame;frame count" line per distinct stack, the
+  input format of flamegraph.pl, speedscope and inferno
+- <id>.sql: request details, then each statement with its duration (query
+  parameters are not recorded)
+
+At most PROFILE_MAX_CONCURRENT requests are profiled at once, and only the
+newest PROFILE_MAX_FILES profiles younger than PROFILE_MAX_AGE_DAYS are
+kept. Profiler failures are logged and never affect the response.
+"""
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Deepest stack recorded per sample, and most statements recorded per profile
+MAX_STACK_DEPTH = 200
+MAX_QUERIES = 2000
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def _acquire_slot():
+    """Reserve one of PROFILE_MAX_CONCURRENT profiling slots, without waiting"""
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(settings.PROFILE_MAX_CONCURRENT)
+    return _slots.acquire(blocking=False)
+
+
+def _frame_name(code, roots):
+    """'path/relative/to/sys.path/module.py:function' for a code object"""
+    filename = code.co_filename
+    for root in roots:
+        if filename.startswith(root + os.sep):
+            filename = filename[len(root) + 1:]
+            break
+    # ';' separates frames and ' ' the count in the folded format
+    return f'{filename}:{code.co_name}'.replace(';', ':').replace(' ', '_')
+
+
+def folded_stacks(stacks):
+    """
+    Folded-format lines for a Counter of stacks (tuples of code objects,
+    outermost first), most frequent first
+
+    Names are worked out here rather than while sampling, once per code
+    object and only for the duration of the call.
+    """
+    roots = sorted((p for p in sys.path if p), key=len, reverse=True)
+    names = {}
+    for stack, count in stacks.most_common():
+        for code in stack:
+            if code not in names:
+                names[code] = _frame_name(code, roots)
+        yield f"{';'.join(names[code] for code in stack)} {count}\n"
+
+
+class RequestProfile:
+    """Samples one thread's stack and records its SQL until ``stop()``"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.queries = []
+        self.dropped_queries = 0
+        self.started = time.perf_counter()
+        self.duration = None
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def record_query(self, execute, sql, params, many, context):
+        """Execute wrapper timing each statement"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if len(self.queries) < MAX_QUERIES:
+                self.queries.append((context['connection'].alias, time.perf_counter() - started, sql, many))
+            else:
+                self.dropped_queries += 1
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        self._stopped.set()
+        self._sampler.join()
+
+    def write(self, directory, request, status, reason):
+        """Write the .folded and .sql files; returns the profile id"""
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        now = datetime.now(dt_timezone.utc)
+        profile_id = f"{now:%Y%m%dT%H%M%S}-{re.sub(r'[^A-Za-z0-9_]+', '_', view)}-{secrets.token_hex(3)}"
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, f'{profile_id}.folded'), 'w') as folded:
+            folded.writelines(folded_stacks(self.stacks))
+
+        with open(os.path.join(directory, f'{profile_id}.sql'), 'w') as sql_file:
+            user = getattr(request, 'user', None)
+            sql_file.write(
+                f'-- {request.method} {request.path} ({view}) -> {status}\n'
+                f'-- at {now.isoformat()}, trigger: {reason}, user: {user.pk if user and user.is_authenticated else "-"}\n'
+                f'-- duration: {self.duration * 1000:.1f} ms, samples: {sum(self.stacks.values())} '
+                f'every {self.interval * 1000:g} ms\n'
+                f'-- queries: {len(self.queries) + self.dropped_queries}, '
+                f'{sum(query[1] for query in self.queries) * 1000:.1f} ms\n\n'
+            )
+            for alias, seconds, sql, many in self.queries:
+                sql_file.write(f"-- {seconds * 1000:.2f} ms on {alias}{' (executemany)' if many else ''}\n{sql};\n\n")
+            if self.dropped_queries:
+                sql_file.write(f'-- {self.dropped_queries} more statement(s) not recorded\n')
+        return profile_id
+
+
+def start_profile():
+    """Start profiling the calling thread, or return None if no slot is free"""
+    if not _acquire_slot():
+        return None
+    try:
+        return RequestProfile(threading.get_ident(), settings.PROFILE_INTERVAL_MS / 1000)
+    except Exception:
+        _slots.release()
+        raise
+
+
+def finish_profile(profile, request, status, reason):
+    """Stop the profile, store it and apply retention; returns the id or None"""
+    try:
+        profile.stop()
+        profile_id = profile.write(settings.PROFILE_DIR, request, status, reason)
+        prune_profiles(settings.PROFILE_DIR)
+        return profile_id
+    except Exception as e:
+        logger.error(f"Could not store request profile: {str(e)}")
+        return None
+    finally:
+        _slots.release()
+
+
+def list_profiles(directory):
+    """Stored profile ids, newest first"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted((name[:-len('.folded')] for name in names if name.endswith('.folded')), reverse=True)
+
+
+def prune_profiles(directory):
+    """Delete profiles beyond PROFILE_MAX_FILES or older than PROFILE_MAX_AGE_DAYS"""
+    cutoff = time.time() - settings.PROFILE_MAX_AGE_DAYS * 86400
+    for index, profile_id in enumerate(list_profiles(directory)):
+        folded_path = os.path.join(directory, f'{profile_id}.folded')
+        try:
+            expired = index >= settings.PROFILE_MAX_FILES or os.path.getmtime(folded_path) < cutoff
+        except FileNotFoundError:
+            continue
+        if expired:
+            for suffix in ('.folded', '.sql'):
+                try:
+                    os.remove(os.path.join(directory, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,168 @@
+"""
+Token-bucket rate limiting for the cart, payment and signup endpoints
+
+Limits are declared per URL name in ``RATE_LIMITS`` in shop/urls.py and
+enforced by shop.middleware.RateLimitMiddleware, which resolves the URL
+itself and answers over-limit requests before the session middleware, the
+view or anything else that writes to the database runs. Each limit keeps one bucket
+per client, identified by:
+
+- 'ip': the client address (REMOTE_ADDR, or the last address of
+  RATELIMIT_IP_HEADER behind a proxy that appends it)
+- 'user': the logged-in user. Anonymous clients are not limited by it: a
+  client can drop or replace its session cookie at will, so an anonymous
+  session is no identity, and keying on the address instead would make
+  everyone behind one NAT share the tight per-user burst. Their 'ip'
+  limits apply. The session is read (one query, only for requests a
+  'user' limit applies to) just to find the user id.
+
+A bucket holds up to ``burst`` tokens and refills at the limit's rate;
+each request takes one token, and a request finding the bucket empty is
+answered 429 with Retry-After. Buckets live in process memory
+(RATELIMIT_BACKEND = 'memory') or in the shared cache ('cache'), so that
+limits hold across worker processes.
+"""
+from collections import OrderedDict
+from importlib import import_module
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+
+RATE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Most buckets kept by the in-memory backend; the least recently used go first
+MEMORY_MAX_BUCKETS = 100000
+
+
+class RateLimit:
+    """
+    A token-bucket limit
+
+    Args:
+        rate: "<requests>/<unit>" with unit s, m, h or d, e.g. "30/m"
+        key: 'ip' or 'user'
+        burst: Bucket size (defaults to the number of requests in ``rate``)
+        methods: HTTP methods the limit applies to
+    """
+
+    def __init__(self, rate, key='ip', burst=None, methods=('POST',)):
+        count, _, unit = rate.partition('/')
+        if key not in ('ip', 'user') or unit not in RATE_UNITS or not count.isdigit():
+            raise ValueError(f'Invalid rate limit {rate!r} (key {key!r})')
+        self.rate = rate
+        self.key = key
+        self.per_second = int(count) / RATE_UNITS[unit]
+        self.burst = burst or int(count)
+        self.methods = set(methods)
+
+    def __repr__(self):
+        return f'RateLimit({self.rate!r}, key={self.key!r}, burst={self.burst})'
+
+
+def client_ip(request):
+    header = settings.RATELIMIT_IP_HEADER
+    if header:
+        forwarded = request.headers.get(header, '')
+        if forwarded:
+            return forwarded.split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def session_user_id(request):
+    """Id of the user logged in to the request's session, without loading the user"""
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not session_key:
+        return None
+    return import_module(settings.SESSION_ENGINE).SessionStore(session_key).get(SESSION_KEY)
+
+
+def client_key(request, limit):
+    """Bucket key of the client for ``limit``, or None if the limit does not apply"""
+    if limit.key == 'user':
+        user_id = session_user_id(request)
+        return f'user:{user_id}' if user_id is not None else None
+    return f'ip:{client_ip(request)}'
+
+
+def _take(state, limit, now):
+    """Refill and take a token; returns (new state, seconds to wait or 0)"""
+    tokens, updated = state if state else (limit.burst, now)
+    tokens = min(limit.burst, tokens + max(0.0, now - updated) * limit.per_second)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / limit.per_second
+
+
+class MemoryBuckets:
+    """Buckets in this process's memory"""
+
+    def __init__(self, max_buckets=MEMORY_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key, limit):
+        with self.lock:
+            state, wait = _take(self.buckets.get(key), limit, time.monotonic())
+            self.buckets[key] = state
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class CacheBuckets:
+    """
+    Buckets in a cache shared by all workers
+
+    The read-modify-write is not atomic, so concurrent requests for the same
+    client may occasionally both get the last token.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    def take(self, key, limit):
+        cache = caches[self.alias]
+        state, wait = _take(cache.get(key), limit, time.time())
+        # Keep the bucket until it would be full again anyway
+        cache.set(key, state, math.ceil(limit.burst / limit.per_second) + 1)
+        return wait
+
+
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets():
+    """The configured bucket backend (one per process)"""
+    global _buckets
+    with _buckets_lock:
+        if _buckets is None:
+            if settings.RATELIMIT_BACKEND == 'cache':
+                _buckets = CacheBuckets(settings.RATELIMIT_CACHE)
+            else:
+                _buckets = MemoryBuckets()
+    return _buckets
+
+
+def check_limits(request, name, limits):
+    """
+    Take a token from each bucket of ``limits`` that applies to the request
+
+    Returns:
+        float: seconds until the request would be allowed, 0 if it is
+    """
+    buckets = get_buckets()
+    wait = 0
+    for index, limit in enumerate(limits):
+        if request.method not in limit.methods:
+            continue
+        key = client_key(request, limit)
+        if key is not None:
+            wait = max(wait, buckets.take(f'ratelimit:{name}:{index}:{key}', limit))
+    return wait
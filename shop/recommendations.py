@@ -0,0 +1,262 @@
+"""
+"Customers also bought" recommendations
+
+Co-purchases are counted from OrderItem in batches of orders: each order's
+distinct products contribute one to every ordered pair, the batch's counts
+are added to ProductPairCount, and the top neighbours of every product that
+changed are rewritten into ProductRecommendation. Progress is an order-id
+Watermark, so each run only reads orders placed since the last one.
+
+Orders cancelled (or refunded, which cancels them) after they were counted
+are taken out again: a second Watermark follows the OrderEvent ids, and
+every status event into or out of 'cancelled' for an order already counted
+subtracts or re-adds its pairs. New orders are counted with their status as
+of that same event id, so each cancellation is applied exactly once.
+"""
+from collections import Counter
+from datetime import timedelta
+from itertools import groupby, permutations
+from operator import itemgetter
+import logging
+
+from django.db import connections, router, transaction
+from django.db.models import F, Max, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import Order, OrderEvent, OrderItem, ProductPairCount, ProductRecommendation, Watermark
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATION_WATERMARK = 'recommendations'
+# Last OrderEvent id whose cancellations are reflected in the counts
+CANCELLATION_WATERMARK = 'recommendations_cancellations'
+
+# Neighbours kept per product
+TOP_N = 12
+
+# Orders counted per transaction
+ORDER_BATCH_SIZE = 5000
+
+# Products per query when reading or rewriting pair counts
+PRODUCT_CHUNK_SIZE = 500
+
+# Order ids per query when recounting cancelled orders
+CANCELLED_CHUNK_SIZE = 500
+
+# Very large baskets add n² pairs and little signal
+MAX_BASKET_PRODUCTS = 50
+
+# Orders younger than this are left for the next run, so an order whose
+# transaction commits after a higher id is not skipped by the watermark
+SETTLE_DELAY = timedelta(minutes=1)
+
+
+def _basket_pairs(items, counts, sign=1, skip=()):
+    # items: OrderItem rows filtered to the orders wanted
+    rows = items.order_by('order_id').values_list('order_id', 'product_id').distinct()
+    for order_id, order_items in groupby(rows.iterator(), key=itemgetter(0)):
+        if order_id in skip:
+            continue
+        products = sorted({product_id for _, product_id in order_items})
+        if 1 < len(products) <= MAX_BASKET_PRODUCTS:
+            for pair in permutations(products, 2):
+                counts[pair] += sign
+    return counts
+
+
+def cancelled_orders(first_order_id, last_order_id, event_id):
+    """
+    Ids of the orders with first_order_id < id <= last_order_id that were
+    cancelled as of OrderEvent event_id
+
+    Orders changed since then had the status of their first later event's
+    from_value; the rest still have the status they had.
+    """
+    status_then = {}
+    for order_id, from_value in OrderEvent.objects.filter(
+        order_id__gt=first_order_id, order_id__lte=last_order_id, field='status', id__gt=event_id,
+    ).order_by('-id').values_list('order_id', 'from_value'):
+        status_then[order_id] = from_value
+    cancelled_now = Order.objects.filter(
+        id__gt=first_order_id, id__lte=last_order_id, status='cancelled',
+    ).values_list('id', flat=True)
+    return (
+        {order_id for order_id in cancelled_now if order_id not in status_then}
+        | {order_id for order_id, status in status_then.items() if status == 'cancelled'}
+    )
+
+
+def count_pairs(first_order_id, last_order_id, event_id):
+    """
+    Co-purchase counts for orders with first_order_id < id <= last_order_id,
+    leaving out those cancelled as of OrderEvent event_id
+
+    Returns:
+        Counter of (product_id, other_product_id) -> number of orders
+    """
+    items = OrderItem.objects.filter(order_id__gt=first_order_id, order_id__lte=last_order_id)
+    cancelled = cancelled_orders(first_order_id, last_order_id, event_id)
+    return _basket_pairs(items, Counter(), skip=cancelled)
+
+
+def count_cancellations(first_event_id, last_event_id, last_order_id):
+    """
+    Pair count changes for the status events with first_event_id < id <=
+    last_event_id on orders up to last_order_id (the ones already counted)
+
+    Returns:
+        Counter of (product_id, other_product_id) -> change, negative for
+        cancelled orders and positive for orders taken out of 'cancelled'
+    """
+    net = Counter()
+    for order_id, from_value, to_value in OrderEvent.objects.filter(
+        Q(to_value='cancelled') | Q(from_value='cancelled'),
+        id__gt=first_event_id, id__lte=last_event_id, field='status', order_id__lte=last_order_id,
+    ).values_list('order_id', 'from_value', 'to_value'):
+        if from_value != to_value:
+            net[order_id] += -1 if to_value == 'cancelled' else 1
+
+    counts = Counter()
+    for sign in (-1, 1):
+        order_ids = [order_id for order_id, change in net.items() if change == sign]
+        for chunk in _chunks(order_ids, CANCELLED_CHUNK_SIZE):
+            _basket_pairs(OrderItem.objects.filter(order_id__in=chunk), counts, sign)
+    return counts
+
+
+def _chunks(values, size):
+    values = sorted(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def add_pair_counts(counts):
+    """
+    Add a batch of pair count changes to ProductPairCount
+
+    Pairs whose count drops to zero are deleted.
+    """
+    by_product = {}
+    for (product_id, other_id), count in counts.items():
+        if count:
+            by_product.setdefault(product_id, {})[other_id] = count
+
+    # MySQL upserts on any unique key and rejects unique_fields
+    connection = connections[router.db_for_write(ProductPairCount)]
+    conflict_target = ['product', 'other'] if connection.features.supports_update_conflicts_with_target else None
+
+    for product_ids in _chunks(by_product, PRODUCT_CHUNK_SIZE):
+        others = {other_id for product_id in product_ids for other_id in by_product[product_id]}
+        existing = {
+            (product_id, other_id): count
+            for product_id, other_id, count in ProductPairCount.objects.filter(
+                product_id__in=product_ids, other_id__in=others,
+            ).values_list('product_id', 'other_id', 'count')
+        }
+        totals = {
+            (product_id, other_id): max(existing.get((product_id, other_id), 0) + count, 0)
+            for product_id in product_ids
+            for other_id, count in by_product[product_id].items()
+        }
+        emptied = [pair for pair, total in totals.items() if not total and pair in existing]
+        for chunk in _chunks(emptied, PRODUCT_CHUNK_SIZE):
+            pairs = Q()
+            for product_id, other_id in chunk:
+                pairs |= Q(product_id=product_id, other_id=other_id)
+            ProductPairCount.objects.filter(pairs).delete()
+        ProductPairCount.objects.bulk_create(
+            [
+                ProductPairCount(product_id=product_id, other_id=other_id, count=total)
+                for (product_id, other_id), total in totals.items()
+                if total
+            ],
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=conflict_target,
+            update_fields=['count'],
+        )
+
+
+def rebuild_recommendations(product_ids):
+    """Rewrite the top TOP_N neighbours of the given products"""
+    for chunk in _chunks(product_ids, PRODUCT_CHUNK_SIZE):
+        ranked = (
+            ProductPairCount.objects.filter(product_id__in=chunk)
+            .annotate(rank=Window(
+                RowNumber(),
+                partition_by=[F('product_id')],
+                order_by=[F('count').desc(), F('other_id').asc()],
+            ))
+            .filter(rank__lte=TOP_N)
+            .values_list('product_id', 'other_id', 'count', 'rank')
+        )
+        recommendations = [
+            ProductRecommendation(product_id=product_id, recommended_id=other_id, score=count, rank=rank)
+            for product_id, other_id, count, rank in ranked
+        ]
+        ProductRecommendation.objects.filter(product_id__in=chunk).delete()
+        ProductRecommendation.objects.bulk_create(recommendations, batch_size=1000)
+
+
+def refresh_recommendations(batch_size=ORDER_BATCH_SIZE, rebuild=False):
+    """
+    Count the orders placed since the last run into the recommendations, and
+    take out the counted orders cancelled since then
+
+    Each batch of orders (pair counts, the affected top-N lists and the
+    watermark) is committed together, so an interrupted run resumes without
+    counting an order twice. Cancellations are applied the same way, in one
+    transaction before the new orders.
+
+    Args:
+        batch_size: Orders counted per transaction
+        rebuild: Start again from the first order
+
+    Returns:
+        int: number of order ids covered
+    """
+    if rebuild:
+        with transaction.atomic():
+            ProductRecommendation.objects.all().delete()
+            ProductPairCount.objects.all().delete()
+            Watermark.objects.filter(name__in=[RECOMMENDATION_WATERMARK, CANCELLATION_WATERMARK]).delete()
+
+    settled = timezone.now() - SETTLE_DELAY
+    until_id = Order.objects.filter(created_at__lt=settled).aggregate(Max('id'))['id__max'] or 0
+    until_event_id = OrderEvent.objects.filter(created_at__lt=settled).aggregate(Max('id'))['id__max'] or 0
+    watermark, _ = Watermark.objects.get_or_create(name=RECOMMENDATION_WATERMARK)
+    # Counts made before cancellations were tracked already left out the
+    # orders cancelled by then, so start from the current events
+    event_watermark, _ = Watermark.objects.get_or_create(
+        name=CANCELLATION_WATERMARK, defaults={'last_id': until_event_id},
+    )
+    start_id = watermark.last_id
+
+    if event_watermark.last_id < until_event_id:
+        counts = count_cancellations(event_watermark.last_id, until_event_id, watermark.last_id)
+        with transaction.atomic():
+            add_pair_counts(counts)
+            rebuild_recommendations({product_id for product_id, _ in counts})
+            event_watermark.last_id = until_event_id
+            event_watermark.save()
+        if counts:
+            logger.info(f"Recommendations: applied cancellations up to event #{until_event_id} ({len(counts)} pairs)")
+
+    while watermark.last_id < until_id:
+        # The id of the batch_size-th order, so gaps in the ids cost nothing
+        batch_end = (
+            Order.objects.filter(id__gt=watermark.last_id, id__lte=until_id)
+            .order_by('id')
+            .values_list('id', flat=True)[batch_size - 1:batch_size]
+            .first()
+        ) or until_id
+        counts = count_pairs(watermark.last_id, batch_end, event_watermark.last_id)
+        with transaction.atomic():
+            add_pair_counts(counts)
+            rebuild_recommendations({product_id for product_id, _ in counts})
+            watermark.last_id = batch_end
+            watermark.save()
+        logger.info(f"Recommendations: counted orders up to #{batch_end} ({len(counts)} pairs)")
+
+    return watermark.last_id - start_id
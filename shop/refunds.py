@@ -0,0 +1,255 @@
+"""
+Refund processing shared by the refund view, the bulk admin action and the
+processrefunds command
+
+Small admin selections are refunded within the request. Larger ones are
+only marked 'refund_requested' (``request_refunds``) and refunded by
+``python manage.py processrefunds`` (``process_requested_refunds``).
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import external_call
+from .models import Order, OrderEvent
+from .outbox import enqueue_emails
+from .payments import configure_stripe
+
+logger = logging.getLogger(__name__)
+
+# Keep the IN (...) lists of the status UPDATE to a manageable size
+UPDATE_BATCH_SIZE = 1000
+
+# Payment statuses from which an order can still be refunded
+REFUNDABLE_STATUSES = ('completed', 'refund_requested')
+
+
+def create_stripe_refund(order):
+    """
+    Refund the order's PaymentIntent in full
+
+    The idempotency key is derived from the order, so retrying a refund that
+    timed out (or refunding the same order from two places) never issues a
+    second refund.
+    """
+    stripe = configure_stripe()
+    with external_call('stripe', 'refund.create'):
+        return stripe.Refund.create(
+            payment_intent=order.payment_intent_id,
+            reason='requested_by_customer',
+            idempotency_key=f'refund-order-{order.id}',
+        )
+
+
+class BulkRefundResult:
+    """Outcome of a bulk refund, grouped by order"""
+
+    def __init__(self):
+        self.refunded = []
+        self.already_refunded = []
+        self.not_refundable = []
+        self.failed = []  # (order, error message)
+        self.queued = []
+
+    @property
+    def total(self):
+        return (
+            len(self.refunded) + len(self.already_refunded) + len(self.not_refundable)
+            + len(self.failed) + len(self.queued)
+        )
+
+
+def _refund_one(order):
+    if order.payment_intent_id:
+        refund = create_stripe_refund(order)
+        logger.info(f"Stripe refund created: {refund.id} for order #{order.id}")
+    return order
+
+
+def bulk_refund_orders(queryset, request=None, max_workers=None):
+    """
+    Refund every completed order in ``queryset``
+
+    Stripe refunds are submitted concurrently from a bounded worker pool.
+    Orders whose refund succeeded are then re-read under a row lock and
+    those still refundable are marked refunded/cancelled with batched
+    UPDATEs; their OrderEvents and confirmation emails are written in the
+    same transaction. Orders refunded or changed elsewhere in the meantime
+    are moved to ``already_refunded`` or ``not_refundable`` and get neither.
+
+    Args:
+        queryset: Order queryset to refund
+        request: HttpRequest instance (optional, for site URL in emails)
+        max_workers: Pool size (defaults to settings.REFUND_MAX_WORKERS)
+
+    Returns:
+        BulkRefundResult
+    """
+    stripe = configure_stripe()
+    max_workers = max_workers or settings.REFUND_MAX_WORKERS
+    result = BulkRefundResult()
+
+    orders = list(queryset)
+    eligible = []
+    for order in orders:
+        if order.payment_status in REFUNDABLE_STATUSES:
+            eligible.append(order)
+        elif order.payment_status == 'refunded':
+            result.already_refunded.append(order)
+        else:
+            result.not_refundable.append(order)
+
+    if not eligible:
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_refund_one, order): order for order in eligible}
+        for done, future in enumerate(as_completed(futures), start=1):
+            order = futures[future]
+            try:
+                future.result()
+                result.refunded.append(order)
+            except stripe.error.StripeError as e:
+                logger.error(f"Stripe refund failed for order #{order.id}: {str(e)}")
+                result.failed.append((order, str(e)))
+            except Exception as e:
+                logger.error(f"Refund processing error for order #{order.id}: {str(e)}")
+                result.failed.append((order, str(e)))
+            if done % 100 == 0:
+                logger.info(f"Bulk refund progress: {done}/{len(eligible)} orders submitted to Stripe")
+
+    if not result.refunded:
+        return result
+
+    refunded = {order.id: order for order in result.refunded}
+    refunded_ids = sorted(refunded)
+    now = timezone.now()
+    changes = []
+    changed_ids = []
+    with transaction.atomic():
+        for start in range(0, len(refunded_ids), UPDATE_BATCH_SIZE):
+            batch = refunded_ids[start:start + UPDATE_BATCH_SIZE]
+            current = {
+                order_id: (payment_status, status)
+                for order_id, payment_status, status in Order.objects.select_for_update()
+                .filter(id__in=batch).values_list('id', 'payment_status', 'status')
+            }
+            batch_changed = []
+            for order_id in batch:
+                order = refunded[order_id]
+                if order_id not in current:
+                    logger.warning(f"Order #{order_id} was deleted after its refund was created")
+                    continue
+                order.payment_status, order.status = current[order_id]
+                if order.payment_status not in REFUNDABLE_STATUSES:
+                    continue
+                batch_changed.append(order_id)
+                changes.append((order_id, 'payment_status', order.payment_status, 'refunded'))
+                if order.status != 'cancelled':
+                    changes.append((order_id, 'status', order.status, 'cancelled'))
+            Order.objects.filter(id__in=batch_changed).update(
+                payment_status='refunded', status='cancelled', updated_at=now
+            )
+            changed_ids.extend(batch_changed)
+        OrderEvent.objects.record_changes(changes, source='bulk_refund', at=now)
+        enqueue_emails('refund_confirmation', changed_ids, request)
+
+    changed = set(changed_ids)
+    result.refunded = []
+    for order_id in refunded_ids:
+        order = refunded[order_id]
+        if order_id in changed:
+            order.payment_status = 'refunded'
+            order.status = 'cancelled'
+            result.refunded.append(order)
+        elif order.payment_status == 'refunded':
+            result.already_refunded.append(order)
+        else:
+            result.not_refundable.append(order)
+
+    logger.info(
+        f"Bulk refund finished: {len(result.refunded)} refunded, {len(result.failed)} failed, "
+        f"{len(result.already_refunded) + len(result.not_refundable)} skipped"
+    )
+    return result
+
+
+def request_refunds(queryset):
+    """
+    Queue the completed orders in ``queryset`` for ``processrefunds``
+
+    Orders are moved from 'completed' to 'refund_requested' with a
+    conditional UPDATE, so only orders still completed when it runs are
+    queued and recorded in their OrderEvents.
+
+    Returns:
+        BulkRefundResult: with the queued orders in ``queued``
+    """
+    result = BulkRefundResult()
+    orders = list(queryset.select_related(None).only('id', 'payment_status'))
+    for order in orders:
+        if order.payment_status == 'refunded':
+            result.already_refunded.append(order)
+        elif order.payment_status not in REFUNDABLE_STATUSES:
+            result.not_refundable.append(order)
+
+    candidate_ids = [order.id for order in orders if order.payment_status == 'completed']
+    queued_ids = set()
+    now = timezone.now()
+    with transaction.atomic():
+        for start in range(0, len(candidate_ids), UPDATE_BATCH_SIZE):
+            batch = list(
+                Order.objects.select_for_update()
+                .filter(id__in=candidate_ids[start:start + UPDATE_BATCH_SIZE], payment_status='completed')
+                .values_list('id', flat=True)
+            )
+            Order.objects.filter(id__in=batch).update(payment_status='refund_requested', updated_at=now)
+            queued_ids.update(batch)
+        OrderEvent.objects.record_changes(
+            [(order_id, 'payment_status', 'completed', 'refund_requested') for order_id in sorted(queued_ids)],
+            source='admin',
+            at=now,
+        )
+
+    for order in orders:
+        if order.id in queued_ids:
+            order.payment_status = 'refund_requested'
+            result.queued.append(order)
+        elif order.payment_status in REFUNDABLE_STATUSES:
+            # Changed by someone else between the read and the UPDATE
+            result.not_refundable.append(order)
+    return result
+
+
+def process_requested_refunds(batch_size=100, max_workers=None, progress=None):
+    """
+    Refund every order queued by ``request_refunds``, in order id order
+
+    Orders whose Stripe refund fails stay queued for the next run; the
+    refund's idempotency key makes retrying safe.
+
+    Args:
+        batch_size: Orders refunded per batch
+        max_workers: Pool size (defaults to settings.REFUND_MAX_WORKERS)
+        progress: Called with the BulkRefundResult of each batch (optional)
+
+    Returns:
+        BulkRefundResult: the combined outcome
+    """
+    total = BulkRefundResult()
+    last_id = 0
+    while True:
+        batch = list(
+            Order.objects.filter(payment_status='refund_requested', id__gt=last_id).order_by('id')[:batch_size]
+        )
+        if not batch:
+            return total
+        last_id = batch[-1].id
+        result = bulk_refund_orders(batch, max_workers=max_workers)
+        for name in ('refunded', 'already_refunded', 'not_refundable', 'failed'):
+            getattr(total, name).extend(getattr(result, name))
+        if progress:
+            progress(result)
@@ -0,0 +1,132 @@
+"""
+Primary/replica database routing
+
+Writes always go to the primary ('default'). Reads made while serving a
+request go to a read replica (settings.DATABASE_REPLICAS), picked at random
+once per request so its reads see one consistent copy, unless:
+
+- the request, or one from the same browser in the last
+  REPLICA_PIN_SECONDS, wrote something (read-your-writes; see
+  shop.middleware.ReplicaPinningMiddleware and ``record_writes``),
+- the read happens inside a transaction on the primary,
+- the code runs under ``use_primary()`` (e.g. payment processing), or
+- the model belongs to an app whose data must never be stale (sessions).
+
+Outside a request (management commands, workers) everything uses the
+primary. Session saves do not pin, since every request saves its session.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Apps always read from the primary, and whose writes do not pin a browser
+PRIMARY_ONLY_APPS = {'sessions'}
+
+WRITE_STATEMENTS = {'INSERT', 'UPDATE', 'DELETE', 'REPLACE'}
+
+
+class RoutingState:
+    """Replica routing decisions for the request being served"""
+
+    def __init__(self, pinned=False, replica=DEFAULT_DB_ALIAS):
+        self.pinned = pinned
+        self.replica = replica
+        self.wrote = False
+
+
+_routing_state = ContextVar('shop_db_routing_state', default=None)
+
+
+def start_request_routing(pinned=False):
+    """Allow replica reads for the current request; returns a reset token"""
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    replica = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+    return _routing_state.set(RoutingState(pinned, replica))
+
+
+def current_request_routing():
+    """Routing state of the request being served, or None"""
+    return _routing_state.get()
+
+
+@contextmanager
+def resume_request_routing(state):
+    """
+    Route as for the request of ``state`` inside the block, e.g. while its
+    streaming response is consumed after the middleware returned
+    """
+    token = _routing_state.set(state)
+    try:
+        yield
+    finally:
+        _routing_state.reset(token)
+
+
+def end_request_routing(token):
+    """Stop replica routing; returns whether the request wrote to the primary"""
+    state = _routing_state.get()
+    _routing_state.reset(token)
+    return bool(state and state.wrote)
+
+
+def _is_pinning_write(sql):
+    verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    return verb in WRITE_STATEMENTS and 'django_session' not in sql
+
+
+def record_writes(execute, sql, params, many, context):
+    """
+    Execute wrapper for the primary connection that notes real writes
+
+    db_for_write() is not enough: it is also consulted for reads that may
+    write (get_or_create, select_for_update) even when nothing changes.
+    """
+    state = _routing_state.get()
+    if state is not None and not state.wrote and _is_pinning_write(sql):
+        state.wrote = True
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the block (usable as a decorator)"""
+    state = _routing_state.get()
+    if state is None:
+        # Not in a request: reads already use the primary
+        yield
+        return
+    previous, state.pinned = state.pinned, True
+    try:
+        yield
+    finally:
+        state.pinned = previous
+
+
+class PrimaryReplicaRouter:
+    """Send eligible reads to a replica and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _routing_state.get()
+        if (
+            state is None
+            or state.pinned
+            or state.wrote
+            or model._meta.app_label in PRIMARY_ONLY_APPS
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold copies of the primary's data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive schema changes through replication
+        return db == DEFAULT_DB_ALIAS
@@ -1,59 +1,104 @@
 """
 Django signals for automatic email notifications on order status changes
+
+Emails are queued in the outbox (see shop/outbox.py) rather than sent inline.
+Product and category changes also invalidate the cached catalog pages.
 """
-from django.db.models.signals import post_save, pre_save
-from django.dispatch import receiver
-from .models import Order
-from .emails import send_order_shipped_email, send_order_delivered_email
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from .cache import invalidate_group
+from .models import Category, Order, OrderEvent, Product
+from .outbox import enqueue_email, enqueue_emails
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Sent once per bulk status transition (see shop/transitions.py), inside its
+# transaction, with order_ids, to_status, previous_statuses ({order id: old
+# status}), source, request and at (the time of the change).
+orders_transitioned = Signal()
+
+# Email queued when an order reaches a status
+STATUS_EMAILS = {
+    'shipped': 'order_shipped',
+    'delivered': 'order_delivered',
+}
+
 
-@receiver(pre_save, sender=Order)
-def track_order_status_change(sender, instance, **kwargs):
+@receiver(post_save, sender=Order)
+def record_order_events(sender, instance, created, raw=False, **kwargs):
     """
-    Track when order status changes to trigger appropriate actions
+    Append an OrderEvent for each status / payment status change
     """
-    if instance.pk:  # Only for existing orders
-        try:
-            old_instance = Order.objects.get(pk=instance.pk)
-            instance._old_status = old_instance.status
-        except Order.DoesNotExist:
-            instance._old_status = None
-    else:
-        instance._old_status = None
+    if raw:
+        return
+    changes = [
+        (instance.pk, field, instance.get_loaded_value(field), getattr(instance, field))
+        for field in instance.tracked_fields
+        if created or instance.has_changed(field)
+    ]
+    if changes:
+        # Stamped now: with save(update_fields=...) updated_at may still
+        # hold the previous save's time
+        OrderEvent.objects.record_changes(changes, source=instance.change_source)
 
 
 @receiver(post_save, sender=Order)
 def send_status_change_email(sender, instance, created, **kwargs):
     """
-    Send email notification when order status changes to 'shipped' or 'delivered'
+    Queue email notification when order status changes to 'shipped' or 'delivered'
     """
     # Don't send emails for newly created orders (handled elsewhere)
     if created:
         return
     
-    # Get old status from the instance (set in pre_save)
-    old_status = getattr(instance, '_old_status', None)
+    # Status as loaded from the database (see DirtyFieldsMixin)
+    old_status = instance.get_loaded_value('status')
     new_status = instance.status
     
-    # Send shipped email
+    # Queue shipped email
     if old_status != 'shipped' and new_status == 'shipped':
-        logger.info(f"Order #{instance.id} status changed to shipped. Sending email...")
-        try:
-            send_order_shipped_email(
-                order=instance,
-                tracking_number=instance.tracking_number,
-                tracking_url=instance.tracking_url
-            )
-        except Exception as e:
-            logger.error(f"Failed to send shipped email for order #{instance.id}: {str(e)}")
+        logger.info(f"Order #{instance.id} status changed to shipped. Queueing email...")
+        enqueue_email('order_shipped', instance)
     
-    # Send delivered email
+    # Queue delivered email
     elif old_status != 'delivered' and new_status == 'delivered':
-        logger.info(f"Order #{instance.id} status changed to delivered. Sending email...")
-        try:
-            send_order_delivered_email(order=instance)
-        except Exception as e:
-            logger.error(f"Failed to send delivered email for order #{instance.id}: {str(e)}")
+        logger.info(f"Order #{instance.id} status changed to delivered. Queueing email...")
+        enqueue_email('order_delivered', instance)
+
+
+@receiver(orders_transitioned, sender=Order)
+def queue_transition_emails(sender, order_ids, to_status, request=None, **kwargs):
+    """
+    Queue one status email per order moved by a bulk transition
+    """
+    kind = STATUS_EMAILS.get(to_status)
+    if kind:
+        logger.info(f"{len(order_ids)} order(s) changed to {to_status}. Queueing emails...")
+        enqueue_emails(kind, order_ids, request)
+
+
+@receiver(orders_transitioned, sender=Order)
+def record_transition_events(sender, order_ids, to_status, previous_statuses, source, at=None, **kwargs):
+    """
+    Append one OrderEvent per order moved by a bulk transition
+    """
+    OrderEvent.objects.record_changes(
+        [(order_id, 'status', previous_statuses.get(order_id), to_status) for order_id in order_ids],
+        source=source,
+        at=at,
+    )
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_cache(sender, raw=False, **kwargs):
+    """
+    Drop the cached catalog pages (CATALOG_*_KEY in views) in every process
+    once the change is committed
+    """
+    if not raw:
+        transaction.on_commit(lambda: invalidate_group('catalog'))
@@ -1,3 +1,1232 @@
-from django.test import TestCase
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+import csv
+import gzip
+import json
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import resolve
+from django.utils import timezone
+
+from . import views
+from .analytics import refresh_sales_rollups
+from .compression import choose_encoding, compress_stream
+from .emails import build_order_email
+from .exports import export_lines
+from .fakestripe import FakeStripeServer
+from .metrics import REQUEST_QUERIES, render_metrics
+from .middleware import CompressionMiddleware, MetricsMiddleware
+from .models import (
+    Cart, CartItem, Category, Customer, DailyOrderStats, DailyProductSales, EmailOutbox, Order, OrderEvent, OrderItem,
+    Product, ProductPairCount, ProductRecommendation, Watermark,
+)
+from .outbox import claim_jobs, deliver_jobs, enqueue_email, retry_delay
+from .payments import configure_stripe
+from .profiling import RequestProfile, folded_stacks
+from .ratelimit import MemoryBuckets, RateLimit, check_limits, client_key
+from .recommendations import refresh_recommendations
+from .refunds import bulk_refund_orders, create_stripe_refund
+from .routers import PrimaryReplicaRouter, end_request_routing, start_request_routing, use_primary
+from .signals import orders_transitioned
+from .tracking import TrackingImportResult, import_tracking, parse_manifest
+from .transitions import transition_orders
+
+def create_order(user=None, **fields):
+    if user is None:
+        user = User.objects.create_user(f'customer{User.objects.count()}', password='secret-pass-1')
+    customer, _ = Customer.objects.get_or_create(user=user)
+    fields.setdefault('total_amount', Decimal('25.00'))
+    fields.setdefault('shipping_address', '1 Main St')
+    return Order.objects.create(customer=customer, **fields)
+
+
+class FakeStripeMixin:
+    """Serve a fresh fake Stripe account per test and point the client at it"""
+
+    def setUp(self):
+        super().setUp()
+        self.fake_stripe = FakeStripeServer(('127.0.0.1', 0)).start()
+        self.addCleanup(self.fake_stripe.stop)
+        settings_override = override_settings(
+            STRIPE_SECRET_KEY='sk_test_fake', STRIPE_API_BASE=self.fake_stripe.api_base,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        import stripe
+        self.addCleanup(setattr, stripe, 'api_base', stripe.api_base)
+        self.addCleanup(setattr, stripe, 'api_key', stripe.api_key)
+        self.stripe = configure_stripe()
+
+    def paid_intent(self, amount=2500):
+        intent = self.stripe.PaymentIntent.create(amount=amount, currency='usd')
+        return self.stripe.PaymentIntent.confirm(intent.id)
+
+
+class FakeStripeTests(FakeStripeMixin, SimpleTestCase):
+    def test_idempotent_refund_is_replayed(self):
+        intent = self.paid_intent()
+        first = self.stripe.Refund.create(payment_intent=intent.id, idempotency_key='k1')
+        second = self.stripe.Refund.create(payment_intent=intent.id, idempotency_key='k1')
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(len(self.fake_stripe.state.refunds), 1)
+
+    def test_idempotency_key_reused_with_other_params(self):
+        intent = self.paid_intent()
+        self.stripe.Refund.create(payment_intent=intent.id, amount=500, idempotency_key='k1')
+        with self.assertRaises(self.stripe.error.IdempotencyError):
+            self.stripe.Refund.create(payment_intent=intent.id, amount=600, idempotency_key='k1')
+
+    def test_refund_without_key_is_not_replayed(self):
+        intent = self.paid_intent()
+        self.stripe.Refund.create(payment_intent=intent.id)
+        with self.assertRaises(self.stripe.error.InvalidRequestError):
+            self.stripe.Refund.create(payment_intent=intent.id)
+
+    def test_partial_refunds_update_the_charge(self):
+        intent = self.paid_intent(amount=2500)
+        self.stripe.Refund.create(payment_intent=intent.id, amount=1000)
+        charge = self.stripe.Charge.retrieve(intent.latest_charge)
+        self.assertEqual(charge.amount_refunded, 1000)
+        self.assertFalse(charge.refunded)
+
+        self.stripe.Refund.create(payment_intent=intent.id, amount=1500)
+        charge = self.stripe.Charge.retrieve(intent.latest_charge)
+        self.assertEqual(charge.amount_refunded, 2500)
+        self.assertTrue(charge.refunded)
+
+    def test_refund_webhook_carries_the_charge(self):
+        delivered = []
+        self.fake_stripe.state.deliver_event = lambda event_type, obj: delivered.append((event_type, obj))
+        intent = self.paid_intent()
+        self.stripe.Refund.create(payment_intent=intent.id)
+        event_type, obj = delivered[-1]
+        self.assertEqual(event_type, 'charge.refunded')
+        self.assertEqual(obj['object'], 'charge')
+        self.assertEqual(obj['id'], intent.latest_charge)
+        self.assertTrue(obj['refunded'])
+
+    def test_malformed_integer_is_a_400(self):
+        with self.assertRaises(self.stripe.error.InvalidRequestError) as caught:
+            self.stripe.PaymentIntent.list(limit='ten')
+        self.assertEqual(caught.exception.http_status, 400)
+        self.assertEqual(caught.exception.code, 'parameter_invalid_integer')
+
+        intent = self.paid_intent()
+        with self.assertRaises(self.stripe.error.InvalidRequestError) as caught:
+            self.stripe.Refund.create(payment_intent=intent.id, amount='1.5')
+        self.assertEqual(caught.exception.http_status, 400)
+
+
+class ReconcilePaymentsTests(FakeStripeMixin, TestCase):
+    def reconcile(self, *args):
+        output = StringIO()
+        call_command('reconcilepayments', *args, stdout=output)
+        return output.getvalue()
+
+    def paid_order(self, **fields):
+        intent = self.paid_intent(amount=2500)
+        return create_order(payment_intent_id=intent.id, payment_status='completed', status='processing', **fields)
+
+    def test_since_and_until_dates(self):
+        output = self.reconcile('--since', '2026-10-01', '--until', '2026-10-03T12:00:00')
+        self.assertIn('PaymentIntents scanned: 0', output)
+
+    def test_resume_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'reconcile.json')
+            with open(checkpoint, 'w') as checkpoint_file:
+                json.dump({
+                    'since': 0, 'until': 4102444800, 'phase': 'refunds',
+                    'window_start': 0, 'starting_after': None, 'counts': {'payment_intents': 3},
+                }, checkpoint_file)
+            output = self.reconcile('--checkpoint', checkpoint, '--resume', '--window-hours', '876000')
+            self.assertIn('Resuming refunds from window starting 1970-01-01T00:00:00+00:00', output)
+            self.assertIn('PaymentIntents scanned: 3', output)
+            self.assertFalse(os.path.exists(checkpoint))
+
+    def test_partial_refunds_adding_up_to_the_total(self):
+        order = self.paid_order()
+        self.stripe.Refund.create(payment_intent=order.payment_intent_id, amount=1000)
+        self.stripe.Refund.create(payment_intent=order.payment_intent_id, amount=1500)
+
+        output = self.reconcile('--fix')
+        self.assertIn('refund_not_recorded: 1', output)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'refunded')
+        self.assertEqual(order.status, 'cancelled')
+
+    def test_partial_refund_is_reported_once(self):
+        order = self.paid_order()
+        self.stripe.Refund.create(payment_intent=order.payment_intent_id, amount=500)
+        self.stripe.Refund.create(payment_intent=order.payment_intent_id, amount=500)
+
+        output = self.reconcile('--fix')
+        self.assertIn('partial_refund: 1', output)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'completed')
+
+
+class RefundTests(FakeStripeMixin, TestCase):
+    def paid_order(self, **fields):
+        intent = self.paid_intent(amount=2500)
+        return create_order(payment_intent_id=intent.id, payment_status='completed', status='processing', **fields)
+
+    def test_refund_retry_returns_the_first_refund(self):
+        order = self.paid_order()
+        first = create_stripe_refund(order)
+        second = create_stripe_refund(order)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(len(self.fake_stripe.state.refunds), 1)
+
+    def test_bulk_refund(self):
+        orders = [self.paid_order(), self.paid_order()]
+        result = bulk_refund_orders(Order.objects.filter(id__in=[order.id for order in orders]))
+        self.assertEqual(len(result.refunded), 2)
+        self.assertEqual(Order.objects.filter(payment_status='refunded', status='cancelled').count(), 2)
+        self.assertEqual(OrderEvent.objects.filter(source='bulk_refund').count(), 4)
+        self.assertEqual(EmailOutbox.objects.filter(kind='refund_confirmation').count(), 2)
+
+    def test_order_refunded_concurrently_gets_no_second_event_or_email(self):
+        order = self.paid_order()
+        stale = Order.objects.get(id=order.id)
+        # Refunded from the order page while the bulk refund was running
+        create_stripe_refund(order)
+        order.payment_status = 'refunded'
+        order.status = 'cancelled'
+        order.save()
+        events = OrderEvent.objects.count()
+
+        result = bulk_refund_orders([stale])
+        self.assertEqual(result.refunded, [])
+        self.assertEqual(result.already_refunded, [stale])
+        self.assertEqual(OrderEvent.objects.count(), events)
+        self.assertFalse(EmailOutbox.objects.filter(kind='refund_confirmation').exists())
+
+
+class RefundAdminActionTests(FakeStripeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret-pass-1')
+        self.client.force_login(admin)
+        self.orders = []
+        for _ in range(3):
+            intent = self.paid_intent()
+            self.orders.append(create_order(payment_intent_id=intent.id, payment_status='completed', status='processing'))
+
+    def post_action(self, **extra):
+        data = {'action': 'refund_order_action', '_selected_action': [order.id for order in self.orders], **extra}
+        return self.client.post('/admin/shop/order/', data, follow=True)
+
+    def test_confirmation_page_refunds_nothing(self):
+        response = self.post_action()
+        self.assertTemplateUsed(response, 'admin/shop/order/refund_confirmation.html')
+        self.assertContains(response, '3 order(s) totalling $75.00')
+        self.assertFalse(self.fake_stripe.state.refunds)
+        self.assertEqual(Order.objects.filter(payment_status='completed').count(), 3)
+
+    def test_confirmed_refund_reports_each_order(self):
+        response = self.post_action(post='yes')
+        self.assertEqual(Order.objects.filter(payment_status='refunded').count(), 3)
+        messages = [str(message) for message in response.context['messages']]
+        self.assertTrue(any(f'#{self.orders[0].id}' in message for message in messages))
+
+    def test_select_across_refunds_the_whole_list(self):
+        data = {'action': 'refund_order_action', '_selected_action': [self.orders[0].id], 'select_across': '1'}
+        response = self.client.post('/admin/shop/order/', data)
+        self.assertContains(response, 'name="select_across" value="1"')
+        self.client.post('/admin/shop/order/', {**data, 'post': 'yes'})
+        self.assertEqual(Order.objects.filter(payment_status='refunded').count(), 3)
+
+    @override_settings(REFUND_ADMIN_INLINE_LIMIT=2)
+    def test_large_selection_is_queued_for_the_command(self):
+        response = self.post_action()
+        self.assertContains(response, 'processrefunds')
+        self.post_action(post='yes')
+        self.assertFalse(self.fake_stripe.state.refunds)
+        self.assertEqual(Order.objects.filter(payment_status='refund_requested').count(), 3)
+
+        call_command('processrefunds', stdout=StringIO())
+        self.assertEqual(len(self.fake_stripe.state.refunds), 3)
+        self.assertEqual(Order.objects.filter(payment_status='refunded').count(), 3)
+        self.assertEqual(EmailOutbox.objects.filter(kind='refund_confirmation').count(), 3)
+
+
+def locmem_templates(templates):
+    return [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', templates)]},
+    }]
+
+
+class OrderEmailTests(TestCase):
+    def test_edited_template_is_used_after_the_engine_reloads(self):
+        user = User.objects.create_user('shopper', 'shopper@example.com', 'secret-pass-1')
+        order = create_order(user)
+        templates = {
+            'shop/emails/order_confirmation.txt': 'first {{ order.id }}',
+            'shop/emails/order_confirmation.html': '<p>first</p>',
+        }
+        with override_settings(TEMPLATES=locmem_templates(templates)):
+            email = build_order_email('order_confirmation', order, site_url='http://shop.test')
+        self.assertEqual(email.body, f'first {order.id}')
+
+        templates['shop/emails/order_confirmation.txt'] = 'second {{ order.id }}'
+        with override_settings(TEMPLATES=locmem_templates(templates)):
+            email = build_order_email('order_confirmation', order, site_url='http://shop.test')
+        self.assertEqual(email.body, f'second {order.id}')
+
+
+class OrderEventTests(TestCase):
+    def test_event_is_stamped_when_recorded(self):
+        order = create_order()
+        Order.objects.filter(id=order.id).update(updated_at=timezone.now() - timedelta(days=3))
+        order = Order.objects.get(id=order.id)
+        before = timezone.now()
+        order.status = 'processing'
+        order.save(update_fields=['status'])
+
+        event = OrderEvent.objects.get(order=order, field='status', to_value='processing')
+        self.assertEqual(event.from_value, 'pending')
+        self.assertGreaterEqual(event.created_at, before)
+
+
+class TransitionTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('bulk', 'bulk@example.com', 'secret-pass-1')
+        self.orders = {
+            status: create_order(user, status=status)
+            for status in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+        }
+        self.ids = [order.pk for order in self.orders.values()]
+        self.signals = []
+        orders_transitioned.connect(self.on_transitioned, sender=Order)
+        self.addCleanup(orders_transitioned.disconnect, self.on_transitioned, sender=Order)
+
+    def on_transitioned(self, **kwargs):
+        self.signals.append(kwargs)
+
+    def statuses(self):
+        return dict(Order.objects.filter(pk__in=self.ids).values_list('pk', 'status'))
+
+    def transition_events(self):
+        return list(
+            OrderEvent.objects.filter(source='admin').order_by('order_id')
+            .values_list('order_id', 'field', 'from_value', 'to_value')
+        )
+
+    def test_moves_eligible_orders_and_skips_the_rest(self):
+        pending, processing = self.orders['pending'].pk, self.orders['processing'].pk
+        result = transition_orders(Order.objects.filter(pk__in=self.ids), 'shipped')
+
+        self.assertEqual(result.updated_ids, [pending, processing])
+        self.assertEqual(result.skipped_ids, [
+            self.orders[status].pk for status in ['shipped', 'delivered', 'cancelled']
+        ])
+        self.assertEqual(self.statuses(), {
+            pending: 'shipped', processing: 'shipped',
+            **{self.orders[status].pk: status for status in ['shipped', 'delivered', 'cancelled']},
+        })
+        self.assertEqual(self.transition_events(), [
+            (pending, 'status', 'pending', 'shipped'),
+            (processing, 'status', 'processing', 'shipped'),
+        ])
+        self.assertEqual(
+            sorted(EmailOutbox.objects.values_list('order_id', 'kind')),
+            [(pending, 'order_shipped'), (processing, 'order_shipped')],
+        )
+
+    def test_signal_is_sent_once_for_the_whole_set(self):
+        result = transition_orders(Order.objects.filter(pk__in=self.ids), 'delivered', source='tracking')
+        shipped = self.orders['shipped'].pk
+        self.assertEqual(result.updated_ids, [shipped])
+        self.assertEqual(len(self.signals), 1)
+        self.assertEqual(self.signals[0]['order_ids'], [shipped])
+        self.assertEqual(self.signals[0]['to_status'], 'delivered')
+        self.assertEqual(self.signals[0]['previous_statuses'], {shipped: 'shipped'})
+        self.assertEqual(self.signals[0]['source'], 'tracking')
+        self.assertEqual(list(EmailOutbox.objects.values_list('order_id', 'kind')), [(shipped, 'order_delivered')])
+        self.assertEqual(OrderEvent.objects.filter(source='tracking').count(), 1)
+
+    def test_nothing_eligible_sends_no_signal(self):
+        queryset = Order.objects.filter(pk__in=[self.orders['delivered'].pk, self.orders['cancelled'].pk])
+        result = transition_orders(queryset, 'shipped')
+        self.assertEqual(result.updated_ids, [])
+        self.assertEqual(len(result.skipped_ids), 2)
+        self.assertEqual(self.signals, [])
+        self.assertEqual(self.transition_events(), [])
+
+    def test_updates_in_batches(self):
+        extra = [create_order(status='pending').pk for _ in range(3)]
+        with mock.patch('shop.transitions.UPDATE_BATCH_SIZE', 2):
+            with CaptureQueriesContext(connection) as queries:
+                result = transition_orders(Order.objects.filter(status='pending'), 'shipped')
+        self.assertEqual(result.updated_ids, [self.orders['pending'].pk] + extra)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "shop_order"')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('"shop_order"."status" IN' in sql for sql in updates))
+
+    def test_concurrent_change_is_skipped_not_overwritten(self):
+        pending, processing = self.orders['pending'].pk, self.orders['processing'].pk
+        cancelled = []
+
+        def cancel_before_update(execute, sql, params, many, context):
+            # Another request cancels the order between the SELECT and the
+            # UPDATE (SQLite takes no row locks)
+            if sql.startswith('UPDATE "shop_order"') and not cancelled:
+                cancelled.append(processing)
+                Order.objects.filter(pk=processing).update(status='cancelled')
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(cancel_before_update):
+            result = transition_orders(Order.objects.filter(pk__in=self.ids), 'shipped')
+
+        self.assertEqual(cancelled, [processing])
+        self.assertEqual(self.statuses()[processing], 'cancelled')
+        self.assertEqual(result.updated_ids, [pending])
+        self.assertIn(processing, result.skipped_ids)
+        self.assertEqual(self.signals[0]['previous_statuses'], {pending: 'pending'})
+        self.assertEqual(self.transition_events(), [(pending, 'status', 'pending', 'shipped')])
+        self.assertEqual(list(EmailOutbox.objects.values_list('order_id', flat=True)), [pending])
+
+
+class TrackingImportTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('tracked', 'tracked@example.com', 'secret-pass-1')
+        self.orders = {
+            status: create_order(user, status=status)
+            for status in ['pending', 'processing', 'shipped', 'cancelled']
+        }
+        self.unknown_id = max(order.pk for order in self.orders.values()) + 100
+
+    def ids(self, *statuses):
+        return [self.orders[status].pk for status in statuses]
+
+    def csv_manifest(self):
+        pending, processing, shipped, cancelled = self.ids('pending', 'processing', 'shipped', 'cancelled')
+        return [
+            'order_id,tracking_number,tracking_url\n',
+            f'{pending},1Z001,https://carrier.example.com/1Z001\n',
+            f'#{processing},1Z002,\n',
+            f'{shipped},1Z003,\n',
+            f'{cancelled},1Z004,\n',
+            f'{self.unknown_id},1Z005,\n',
+            'abc,1Z006,\n',
+            f'{pending},,\n',
+            f'{processing},1Z007,not a url\n',
+        ]
+
+    def run_import(self, lines, manifest_format='csv', **kwargs):
+        result = TrackingImportResult()
+        return import_tracking(parse_manifest(lines, manifest_format, result.errors), result=result, **kwargs)
+
+    def shipped_emails(self):
+        return sorted(EmailOutbox.objects.filter(kind='order_shipped').values_list('order_id', flat=True))
+
+    def test_csv_manifest(self):
+        result = self.run_import(self.csv_manifest())
+
+        self.assertEqual(sorted(result.updated_ids), self.ids('pending', 'processing', 'shipped'))
+        self.assertEqual(sorted(result.shipped_ids), self.ids('pending', 'processing'))
+        self.assertEqual(result.unknown_ids, [self.unknown_id])
+        self.assertEqual(result.cancelled_ids, self.ids('cancelled'))
+        self.assertEqual(result.errors, [
+            (7, "invalid order_id 'abc'"),
+            (8, 'missing tracking_number'),
+            (9, "invalid tracking_url 'not a url'"),
+        ])
+
+        ids = self.ids('pending', 'processing', 'shipped', 'cancelled')
+        orders = Order.objects.in_bulk(ids)
+        pending, processing, shipped, cancelled = (orders[pk] for pk in ids)
+        self.assertEqual(
+            (pending.status, pending.tracking_number, pending.tracking_url),
+            ('shipped', '1Z001', 'https://carrier.example.com/1Z001'),
+        )
+        self.assertEqual((processing.status, processing.tracking_number), ('shipped', '1Z002'))
+        self.assertEqual((shipped.status, shipped.tracking_number), ('shipped', '1Z003'))
+        self.assertEqual((cancelled.status, cancelled.tracking_number), ('cancelled', None))
+        # Already shipped: tracking corrected, no second email
+        self.assertEqual(self.shipped_emails(), self.ids('pending', 'processing'))
+        self.assertEqual(
+            sorted(OrderEvent.objects.filter(source='tracking_import').values_list('order_id', flat=True)),
+            self.ids('pending', 'processing'),
+        )
+
+    def test_jsonl_manifest(self):
+        pending, cancelled = self.ids('pending', 'cancelled')
+        lines = [
+            json.dumps({'order_id': pending, 'tracking_number': 'JD01'}) + '\n',
+            '\n',
+            '{"order_id": \n',
+            '[1, 2]\n',
+            json.dumps({'order_id': str(cancelled), 'tracking_number': 'JD02'}) + '\n',
+            json.dumps({'order_id': self.unknown_id, 'tracking_number': 'JD03'}) + '\n',
+            json.dumps({'order_id': pending, 'tracking_number': 'x' * 256}) + '\n',
+        ]
+        result = self.run_import(lines, 'jsonl')
+
+        self.assertEqual(result.shipped_ids, [pending])
+        self.assertEqual(result.unknown_ids, [self.unknown_id])
+        self.assertEqual(result.cancelled_ids, [cancelled])
+        self.assertEqual(result.errors, [
+            (3, 'invalid JSON'), (4, 'expected a JSON object'), (7, 'tracking_number is too long'),
+        ])
+        self.assertEqual(Order.objects.get(pk=pending).tracking_number, 'JD01')
+        self.assertEqual(self.shipped_emails(), [pending])
+
+    def test_missing_columns_are_reported(self):
+        result = self.run_import(['order,tracking_number\n', f"{self.ids('pending')[0]},1Z001\n"])
+        self.assertEqual(result.errors, [(1, 'missing column(s): order_id')])
+        self.assertEqual(result.updated_ids, [])
+
+    def test_reuploaded_manifest_sends_no_second_email(self):
+        self.run_import(self.csv_manifest())
+        emails = self.shipped_emails()
+        events = OrderEvent.objects.count()
+
+        result = self.run_import(self.csv_manifest(), chunk_size=2)
+        self.assertEqual(result.shipped_ids, [])
+        self.assertEqual(sorted(result.updated_ids), self.ids('pending', 'processing', 'shipped'))
+        self.assertEqual(self.shipped_emails(), emails)
+        self.assertEqual(OrderEvent.objects.count(), events)
+
+        # A corrected tracking number is stored, still without an email
+        pending = self.ids('pending')[0]
+        self.run_import(['order_id,tracking_number\n', f'{pending},1Z999\n'])
+        self.assertEqual(Order.objects.get(pk=pending).tracking_number, '1Z999')
+        self.assertEqual(self.shipped_emails(), emails)
+
+    def test_admin_upload(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret-pass-1')
+        self.client.force_login(admin)
+        url = '/admin/shop/order/import-tracking/'
+        self.assertTemplateUsed(self.client.get(url), 'admin/shop/order/import_tracking.html')
+
+        manifest = SimpleUploadedFile('manifest.csv', ''.join(self.csv_manifest()).encode('utf-8-sig'))
+        response = self.client.post(url, {'manifest': manifest}, follow=True)
+        self.assertRedirects(response, '/admin/shop/order/')
+        messages = [str(message) for message in response.context['messages']]
+        self.assertIn(
+            'Tracking stored for 3 order(s); 2 marked as shipped. Customers will receive email notifications.',
+            messages,
+        )
+        self.assertIn(f'Unknown orders: #{self.unknown_id}.', messages)
+        self.assertIn(f"Cancelled orders were skipped: #{self.ids('cancelled')[0]}.", messages)
+        self.assertTrue(any(message.startswith('3 row(s) could not be read: line 7:') for message in messages))
+        self.assertEqual(self.shipped_emails(), self.ids('pending', 'processing'))
+
+        # Same manifest again, as JSON lines picked by the form
+        lines = [json.dumps({'order_id': pk, 'tracking_number': 'JD01'}) for pk in self.ids('pending', 'processing')]
+        manifest = SimpleUploadedFile('manifest.txt', '\n'.join(lines).encode())
+        response = self.client.post(url, {'manifest': manifest, 'format': 'jsonl'}, follow=True)
+        messages = [str(message) for message in response.context['messages']]
+        self.assertIn('Tracking stored for 2 order(s); 0 marked as shipped.', messages)
+        self.assertEqual(self.shipped_emails(), self.ids('pending', 'processing'))
+
+
+class MyOrdersPagingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('paging', 'paging@example.com', 'secret-pass-1')
+        self.client.force_login(self.user)
+        base = timezone.now() - timedelta(days=30)
+        orders = [create_order(self.user) for _ in range(25)]
+        for index, order in enumerate(orders):
+            # Five orders share each timestamp, so the id has to break ties
+            Order.objects.filter(id=order.id).update(created_at=base + timedelta(hours=index // 5))
+        self.expected = list(
+            Order.objects.filter(customer__user=self.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+
+    def get_page(self, cursor=None):
+        params = {'format': 'json'}
+        if cursor:
+            params['before'] = cursor
+        return self.client.get('/my-orders/', params).json()
+
+    def test_cursor_pages_cover_every_order_once(self):
+        first = self.get_page()
+        self.assertEqual(len(first['orders']), 20)
+        self.assertIsNotNone(first['next_cursor'])
+        second = self.get_page(first['next_cursor'])
+        self.assertIsNone(second['next_cursor'])
+        ids = [order['id'] for order in first['orders'] + second['orders']]
+        self.assertEqual(ids, self.expected)
+
+    def test_cursor_survives_new_orders(self):
+        first = self.get_page()
+        create_order(self.user)
+        second = self.get_page(first['next_cursor'])
+        self.assertEqual([order['id'] for order in second['orders']], self.expected[20:])
+
+    def test_invalid_cursor_starts_from_the_newest(self):
+        for cursor in ('not-a-cursor', '99999999999999999999-1', '999999999999999999-1', '1-99999999999999999999'):
+            self.assertEqual(self.get_page(cursor)['orders'][0]['id'], self.expected[0])
+        response = self.client.get('/my-orders/', {'before': '999999999999999999-1'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_html_page_links_to_the_next_page(self):
+        response = self.client.get('/my-orders/')
+        body = b''.join(response.streaming_content).decode()
+        self.assertEqual(body.count('class="order-card"'), 20)
+        self.assertIn('?before=', body)
+        self.assertIn(f'Order #{self.expected[0]}<', body)
+        self.assertNotIn(f'Order #{self.expected[20]}<', body)
+
+
+class OrderExportTests(TestCase):
+    def test_csv_cells_cannot_start_formulas(self):
+        user = User.objects.create_user('exporter', 'exporter@example.com', 'secret-pass-1', first_name='+Eve')
+        category = Category.objects.create(name='Tees', slug='tees')
+        product = Product.objects.create(
+            name='@SUM(A1)', slug='sum-tee', description='', price=Decimal('10.00'), category=category,
+        )
+        order = create_order(user, shipping_address='=HYPERLINK("http://evil.example")', total_amount=Decimal('10.00'))
+        Customer.objects.filter(user=user).update(phone='-1+1')
+        OrderItem.objects.create(order=order, product=product, size='M', quantity=1, price=Decimal('10.00'))
+
+        rows = list(csv.DictReader(''.join(export_lines(Order.objects.all(), 'csv')).splitlines()))
+        self.assertEqual(rows[0]['shipping_address'], '\'=HYPERLINK("http://evil.example")')
+        self.assertEqual(rows[0]['customer_name'], "'+Eve")
+        self.assertEqual(rows[0]['customer_phone'], "'-1+1")
+        self.assertEqual(rows[0]['product_name'], "'@SUM(A1)")
+        self.assertEqual(rows[0]['total_amount'], '10.00')
+        self.assertEqual(rows[0]['customer_email'], 'exporter@example.com')
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rolled', 'rolled@example.com', 'secret-pass-1')
+        category = Category.objects.create(name='Tees', slug='tees')
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=Decimal('10.00'), category=category,
+        )
+        self.now = timezone.now()
+
+    def day(self, days_ago):
+        return timezone.localdate(self.now - timedelta(days=days_ago))
+
+    def make_order(self, days_ago, status='pending', total='10.00', quantity=1, updated_at=None):
+        order = create_order(self.user, status=status, total_amount=Decimal(total))
+        OrderItem.objects.create(
+            order=order, product=self.product, size='M', quantity=quantity, price=Decimal(total) / quantity,
+        )
+        created_at = self.now - timedelta(days=days_ago)
+        Order.objects.filter(pk=order.pk).update(created_at=created_at, updated_at=updated_at or created_at)
+        return Order.objects.get(pk=order.pk)
+
+    def stats(self, days_ago):
+        return {
+            row.status: (row.order_count, row.item_count, row.revenue)
+            for row in DailyOrderStats.objects.filter(day=self.day(days_ago))
+        }
+
+    def watermark(self):
+        return Watermark.objects.get(name='sales_rollup').timestamp
+
+    def test_changed_order_rebuilds_only_its_day(self):
+        old = self.make_order(10, 'pending', '20.00', quantity=2)
+        self.make_order(10, 'processing', '30.00')
+        self.make_order(3, 'pending', '40.00')
+        latest = self.make_order(1, 'pending', '50.00')
+
+        self.assertEqual(refresh_sales_rollups(), [self.day(10), self.day(3), self.day(1)])
+        self.assertEqual(self.stats(10), {
+            'pending': (1, 2, Decimal('20.00')), 'processing': (1, 1, Decimal('30.00')),
+        })
+        self.assertEqual(self.watermark(), latest.updated_at)
+
+        # Rows of a day that is rebuilt would lose this
+        DailyOrderStats.objects.filter(day=self.day(3)).update(order_count=99)
+        old.status = 'cancelled'
+        old.save()
+
+        # The day of the watermark order is read again through the overlap
+        self.assertEqual(refresh_sales_rollups(), [self.day(10), self.day(1)])
+        self.assertEqual(self.stats(10), {
+            'cancelled': (1, 2, Decimal('20.00')), 'processing': (1, 1, Decimal('30.00')),
+        })
+        self.assertEqual(
+            list(DailyProductSales.objects.filter(day=self.day(10)).values_list('status', 'quantity', 'revenue')),
+            [('cancelled', 2, Decimal('20.00')), ('processing', 1, Decimal('30.00'))],
+        )
+        self.assertEqual(self.stats(3), {'pending': (99, 1, Decimal('40.00'))})
+        old.refresh_from_db()
+        self.assertEqual(self.watermark(), old.updated_at)
+
+    def test_overlap_catches_orders_committed_late(self):
+        self.make_order(1)
+        refresh_sales_rollups()
+        watermark = self.watermark()
+
+        # Stamped before the watermark, committed after the run
+        self.make_order(5, updated_at=watermark - timedelta(minutes=2))
+        self.make_order(6, updated_at=watermark - timedelta(minutes=10))
+
+        self.assertEqual(refresh_sales_rollups(), [self.day(5), self.day(1)])
+        self.assertEqual(self.stats(5), {'pending': (1, 1, Decimal('10.00'))})
+        self.assertEqual(self.stats(6), {})
+        self.assertEqual(self.watermark(), watermark)
+
+        # Beyond the overlap: only a rebuild picks it up
+        refresh_sales_rollups(rebuild_since=self.day(6))
+        self.assertEqual(self.stats(6), {'pending': (1, 1, Decimal('10.00'))})
+
+    def test_rebuild_since_clears_days_whose_orders_are_gone(self):
+        self.make_order(8)
+        gone = self.make_order(4, 'processing')
+        self.make_order(2)
+        refresh_sales_rollups()
+        DailyOrderStats.objects.filter(day=self.day(8)).update(order_count=99)
+
+        gone.delete()
+        # Deleting leaves no updated_at behind
+        refresh_sales_rollups()
+        self.assertEqual(self.stats(4), {'processing': (1, 1, Decimal('10.00'))})
+
+        self.assertEqual(refresh_sales_rollups(rebuild_since=self.day(5)), [self.day(4), self.day(2)])
+        self.assertEqual(self.stats(4), {})
+        self.assertFalse(DailyProductSales.objects.filter(day=self.day(4)).exists())
+        self.assertEqual(self.stats(2), {'pending': (1, 1, Decimal('10.00'))})
+        self.assertEqual(self.stats(8), {'pending': (99, 1, Decimal('10.00'))})
+
+    def test_command(self):
+        out = StringIO()
+        call_command('rollupsales', stdout=out)
+        self.assertIn('Sales rollups are up to date.', out.getvalue())
+
+        self.make_order(3)
+        self.make_order(2)
+        out = StringIO()
+        call_command('rollupsales', f'--rebuild-since={self.day(3)}', stdout=out)
+        self.assertIn(f'Recomputed 2 day(s): {self.day(3)} to {self.day(2)}.', out.getvalue())
+
+        with self.assertRaisesMessage(CommandError, 'Invalid --rebuild-since'):
+            call_command('rollupsales', '--rebuild-since=yesterday')
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees', slug='tees')
+        self.a, self.b, self.c = (
+            Product.objects.create(name=name, slug=name, description='', price=Decimal('10.00'), category=category)
+            for name in ('a', 'b', 'c')
+        )
+        self.user = User.objects.create_user('buyer', password='secret-pass-1')
+
+    def order(self, *products, **fields):
+        order = create_order(self.user, **fields)
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, size='M', quantity=1, price=product.price)
+        return order
+
+    def refresh(self):
+        # Past SETTLE_DELAY, so the run picks everything up
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        Order.objects.update(created_at=an_hour_ago)
+        OrderEvent.objects.update(created_at=an_hour_ago)
+        refresh_recommendations()
+
+    def pair_counts(self):
+        return dict(ProductPairCount.objects.filter(product=self.a).values_list('other__name', 'count'))
+
+    def test_cancelled_orders_are_taken_out_again(self):
+        first = self.order(self.a, self.b)
+        self.order(self.a, self.b, self.c)
+        self.order(self.a, self.c, status='cancelled')
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 2, 'c': 1})
+
+        first.status = 'cancelled'
+        first.save()
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 1, 'c': 1})
+        # Applied once only
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 1, 'c': 1})
+
+        first.status = 'processing'
+        first.save()
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 2, 'c': 1})
+
+    def test_pairs_whose_orders_are_all_cancelled_drop_out(self):
+        only = self.order(self.a, self.c)
+        self.order(self.a, self.b)
+        self.refresh()
+        only.status = 'cancelled'
+        only.save()
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 1})
+        self.assertEqual(
+            list(ProductRecommendation.objects.filter(product=self.a).values_list('recommended__name', flat=True)),
+            ['b'],
+        )
+
+    def test_cancellation_after_the_event_cutoff_is_applied_by_the_next_run(self):
+        order = self.order(self.a, self.b)
+        self.refresh()
+        late = self.order(self.a, self.b)
+        # Cancellation not settled yet: counted with the status it had before
+        late.status = 'cancelled'
+        late.save()
+        Order.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        refresh_recommendations()
+        self.assertEqual(self.pair_counts(), {'b': 2})
+        self.refresh()
+        self.assertEqual(self.pair_counts(), {'b': 1})
+        self.assertEqual(order.status, 'pending')
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2', 'replica3'])
+class ReplicaRoutingTests(SimpleTestCase):
+    def test_one_replica_per_request(self):
+        router = PrimaryReplicaRouter()
+        picked = set()
+        for _ in range(20):
+            token = start_request_routing()
+            try:
+                reads = {router.db_for_read(Product) for _ in range(10)}
+            finally:
+                end_request_routing(token)
+            self.assertEqual(len(reads), 1)
+            picked |= reads
+        self.assertTrue(picked <= {'replica1', 'replica2', 'replica3'})
+        self.assertGreater(len(picked), 1)
+
+    def test_primary_outside_requests_and_when_pinned(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')
+        token = start_request_routing()
+        try:
+            with use_primary():
+                self.assertEqual(router.db_for_read(Product), 'default')
+        finally:
+            end_request_routing(token)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.category = Category.objects.create(name='Tees', slug='tees')
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=300)
+    def test_unknown_slugs_are_not_cached(self):
+        self.assertEqual(self.client.get('/product/later/').status_code, 404)
+        self.assertNotIn('catalog:product:later', cache)
+        Product.objects.create(name='Later', slug='later', description='', price=Decimal('10.00'), category=self.category)
+        self.assertEqual(self.client.get('/product/later/').status_code, 200)
+        self.assertIn('catalog:product:later', cache)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_nothing_cached_when_off(self):
+        Product.objects.create(name='Tee', slug='tee', description='', price=Decimal('10.00'), category=self.category)
+        self.assertEqual(self.client.get('/product/tee/').status_code, 200)
+        self.assertEqual(self.client.get('/').status_code, 200)
+        self.assertNotIn('catalog:product:tee', cache)
+        self.assertNotIn('catalog:index', cache)
+
+
+def _outer_frame():
+    return _inner_frame()
+
+
+def _inner_frame():
+    return sys._getframe()
+
+
+class ProfilingTests(SimpleTestCase):
+    def test_folded_stacks_name_frames_at_write_time(self):
+        inner = _outer_frame()
+        stacks = Counter({(inner.f_back.f_code, inner.f_code): 3, (inner.f_code,): 1})
+        self.assertEqual(list(folded_stacks(stacks)), [
+            'shop/tests.py:_outer_frame;shop/tests.py:_inner_frame 3\n',
+            'shop/tests.py:_inner_frame 1\n',
+        ])
+
+    def test_samples_keep_code_objects_not_names(self):
+        profile = RequestProfile(threading.get_ident(), 0.001)
+        deadline = time.monotonic() + 0.05
+        while time.monotonic() < deadline:
+            pass
+        profile.stop()
+        self.assertTrue(profile.stacks)
+        for stack in profile.stacks:
+            self.assertTrue(all(isinstance(code, types.CodeType) for code in stack))
+
+
+class RateLimitKeyTests(TestCase):
+    def setUp(self):
+        self.limit = RateLimit('3/m', key='user')
+
+    def anonymous_post(self, session_key):
+        request = RequestFactory().post('/cart/add/', REMOTE_ADDR='203.0.113.7')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        return request
+
+    def test_user_limits_skip_anonymous_clients(self):
+        self.assertIsNone(client_key(self.anonymous_post('made-up-1'), self.limit))
+        self.assertIsNone(client_key(self.anonymous_post(''), self.limit))
+        self.assertEqual(client_key(self.anonymous_post(''), RateLimit('3/m', key='ip')), 'ip:203.0.113.7')
+
+    def test_logged_in_clients_are_keyed_on_the_user(self):
+        user = User.objects.create_user('limited', password='secret-pass-1')
+        self.client.force_login(user)
+        request = RequestFactory().post('/cart/add/', REMOTE_ADDR='203.0.113.7')
+        request.COOKIES = {name: cookie.value for name, cookie in self.client.cookies.items()}
+        self.assertEqual(client_key(request, self.limit), f'user:{user.pk}')
+
+    def test_anonymous_clients_get_the_address_limit_only(self):
+        limits = [self.limit, RateLimit('5/m', key='ip')]
+        with mock.patch('shop.ratelimit._buckets', MemoryBuckets()):
+            waits = [check_limits(self.anonymous_post(f'fresh-{n}'), 'shop:add_to_cart', limits) for n in range(6)]
+        self.assertEqual(waits[:5], [0] * 5)
+        self.assertGreater(waits[5], 0)
+
+
+@override_settings(COMPRESSION_ENABLED=True, COMPRESSION_MIN_SIZE=100)
+class CompressionTests(SimpleTestCase):
+    rows = [f'{n},order {n},2026-10-01,completed,25.00\n'.encode() for n in range(2000)]
+
+    def compress(self, response):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, br')
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_streams_are_not_flushed_per_chunk(self):
+        compressed = list(compress_stream(iter(self.rows), 'gzip'))
+        flushed = list(compress_stream(iter(self.rows), 'gzip', flush=True))
+        self.assertEqual(gzip.decompress(b''.join(compressed)), b''.join(self.rows))
+        self.assertEqual(gzip.decompress(b''.join(flushed)), b''.join(self.rows))
+        self.assertLess(len(b''.join(compressed)) * 1.5, len(b''.join(flushed)))
+        self.assertLess(len(compressed), len(self.rows) // 10)
+
+    def test_progressive_pages_are_flushed_per_chunk(self):
+        chunks = [b'<p>' + b'card ' * 100 + b'</p>' for _ in range(5)]
+        response = StreamingHttpResponse(iter(chunks), content_type='text/html; charset=utf-8')
+        response['X-Accel-Buffering'] = 'no'
+        response = self.compress(response)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        parts = list(response.streaming_content)
+        self.assertGreaterEqual(len(parts), len(chunks))
+        self.assertEqual(gzip.decompress(b''.join(parts)), b''.join(chunks))
+
+    def test_no_brotli_for_pages_with_a_csrf_token(self):
+        with mock.patch('shop.compression.brotli', mock.Mock()):
+            self.assertEqual(choose_encoding('gzip, br'), 'br')
+            self.assertEqual(choose_encoding('gzip, br', allow_brotli=False), 'gzip')
+            response = HttpResponse(b'<form>' + b'x' * 500 + b'</form>', content_type='text/html')
+            response.set_cookie(settings.CSRF_COOKIE_NAME, 'secret')
+            self.assertEqual(self.compress(response)['Content-Encoding'], 'gzip')
+
+
+@override_settings(RATELIMIT_ENABLED=False)
+class PaymentConfirmationTests(FakeStripeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('payer', 'payer@example.com', 'secret-pass-1')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Tees', slug='tees')
+        product = Product.objects.create(name='Tee', slug='tee', description='', price=Decimal('25.00'), category=category)
+        cart = Cart.objects.create(session_key=self.client.session.session_key)
+        CartItem.objects.create(cart=cart, product=product, size='M', quantity=1)
+        self.intent = self.paid_intent()
+
+    def confirm(self):
+        return self.client.post(
+            '/process-payment/',
+            json.dumps({'payment_intent_id': self.intent.id, 'shipping_address': '1 Main St'}),
+            content_type='application/json',
+        ).json()
+
+    def test_repeated_confirmations_place_one_order(self):
+        answers = [self.confirm() for _ in range(3)]
+        order = Order.objects.get()
+        self.assertEqual([answer['order_id'] for answer in answers], [order.id] * 3)
+        self.assertTrue(all(answer['success'] for answer in answers))
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(EmailOutbox.objects.filter(order=order).count(), 1)
+
+    def test_concurrent_confirmation_returns_the_other_order(self):
+        real_get_cart = views.get_cart
+
+        def get_cart_after_other_request(request):
+            # The other request inserts its order between our check and insert
+            create_order(self.user, payment_intent_id=self.intent.id, status='processing')
+            return real_get_cart(request)
+
+        with mock.patch('shop.views.get_cart', side_effect=get_cart_after_other_request):
+            answer = self.confirm()
+        order = Order.objects.get()
+        self.assertEqual(answer, {'success': True, 'order_id': order.id, 'message': f'Order #{order.id} placed successfully!'})
+        self.assertFalse(EmailOutbox.objects.exists())
+        # Our cart was not consumed by the rolled-back attempt
+        self.assertEqual(CartItem.objects.count(), 1)
+
+
+class DuplicatePaymentIntentMigrationTests(TransactionTestCase):
+    before = [('shop', '0003_order_tracking_number_order_tracking_url')]
+    after = [('shop', '0004_order_payment_intent_id_unique')]
+
+    def tearDown(self):
+        MigrationExecutor(connection).migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_duplicates_stop_the_migration_with_their_order_ids(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        old_apps = executor.loader.project_state(self.before).apps
+        user = old_apps.get_model('auth', 'User').objects.create(username='double')
+        customer = old_apps.get_model('shop', 'Customer').objects.create(user=user)
+        Order = old_apps.get_model('shop', 'Order')
+        orders = [
+            Order.objects.create(customer=customer, total_amount=25, shipping_address='x', payment_intent_id='pi_double')
+            for _ in range(2)
+        ]
+        Order.objects.create(customer=customer, total_amount=25, shipping_address='x', payment_intent_id='pi_single')
+
+        executor = MigrationExecutor(connection)
+        with self.assertRaisesMessage(RuntimeError, f'pi_double: orders #{orders[0].id}, #{orders[1].id}'):
+            executor.migrate(self.after)
+
+        Order.objects.filter(id=orders[1].id).update(payment_intent_id=None)
+        MigrationExecutor(connection).migrate(self.after)
+
+
+def parse_metrics(text):
+    """{'name{labels}': value} of a Prometheus text exposition"""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(TestCase):
+    def test_request_is_recorded_and_large_values_rendered_in_full(self):
+        def view(request):
+            request.resolver_match = resolve('/')
+            list(Category.objects.all())
+            return HttpResponse('ok')
+
+        key = 'shop_http_db_queries_total{view="shop:index"}'
+        before = parse_metrics(render_metrics()).get(key, 0)
+        MetricsMiddleware(view)(RequestFactory().get('/'))
+        samples = parse_metrics(render_metrics())
+        self.assertEqual(samples[key], before + 1)
+        self.assertGreaterEqual(
+            samples['shop_http_request_duration_seconds_count{view="shop:index",method="GET",status="200"}'], 1,
+        )
+
+        REQUEST_QUERIES.inc(('shop:index',), 1234567)
+        REQUEST_QUERIES.inc(('metrics-test',), 1234567.25)
+        text = render_metrics()
+        self.assertIn(f'{key} {int(before) + 1234568}\n', text)
+        self.assertIn('shop_http_db_queries_total{view="metrics-test"} 1234567.25\n', text)
+        self.assertNotIn('e+06', text)
+
+
+class WorkerCrash(BaseException):
+    pass
+
+
+class CrashingEmailBackend(LocmemEmailBackend):
+    """Delivers one message, then the worker dies"""
+
+    def send_messages(self, messages):
+        if mail.outbox:
+            raise WorkerCrash()
+        return super().send_messages(messages)
+
+
+class FailingEmailBackend(LocmemEmailBackend):
+    """Every message is rejected"""
+
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('mailed', 'mailed@example.com', 'secret-pass-1')
+
+    def queue(self, count=1):
+        return [enqueue_email('order_confirmation', create_order(self.user)) for _ in range(count)]
+
+    @override_settings(EMAIL_BACKEND='shop.tests.CrashingEmailBackend')
+    def test_sent_jobs_are_recorded_before_the_batch_ends(self):
+        self.queue(3)
+        with self.assertRaises(WorkerCrash):
+            deliver_jobs(claim_jobs(10))
+        self.assertEqual(len(mail.outbox), 1)
+        statuses = list(EmailOutbox.objects.order_by('id').values_list('status', 'attempts'))
+        self.assertEqual(statuses, [('sent', 1), ('sending', 0), ('sending', 0)])
+
+    @override_settings(EMAIL_TIMEOUT=10)
+    def test_lease_covers_the_whole_batch(self):
+        self.queue(2)
+        before = timezone.now()
+        claim_jobs(50)
+        for job in EmailOutbox.objects.all():
+            self.assertGreaterEqual(job.next_attempt_at, before + timedelta(seconds=1500))
+
+    def make_due(self):
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+
+    @override_settings(
+        EMAIL_BACKEND='shop.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=8,
+        EMAIL_OUTBOX_RETRY_SECONDS=30, EMAIL_OUTBOX_MAX_RETRY_SECONDS=100,
+    )
+    def test_failed_sends_are_retried_with_backoff(self):
+        job = self.queue()[0]
+        self.assertEqual([retry_delay(n).total_seconds() for n in range(1, 5)], [30, 60, 100, 100])
+        for attempts in range(1, 5):
+            before = timezone.now()
+            with self.assertLogs('shop', 'WARNING'):
+                self.assertEqual(deliver_jobs(claim_jobs(10)), ['pending'])
+            after = timezone.now()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('pending', attempts))
+            self.assertIn('Connection unexpectedly closed', job.last_error)
+            self.assertGreaterEqual(job.next_attempt_at, before + retry_delay(attempts))
+            self.assertLessEqual(job.next_attempt_at, after + retry_delay(attempts))
+            # Not due again before the delay has passed
+            self.assertEqual(claim_jobs(10), [])
+            self.make_due()
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(EMAIL_BACKEND='shop.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=3)
+    def test_jobs_are_dead_after_the_last_attempt(self):
+        job = self.queue()[0]
+        statuses = []
+        with self.assertLogs('shop', 'WARNING') as logs:
+            for _ in range(3):
+                statuses += deliver_jobs(claim_jobs(10))
+                self.make_due()
+        self.assertEqual(statuses, ['pending', 'pending', 'dead'])
+        self.assertIn('Giving up on order_confirmation email', logs.output[-1])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('dead', 3))
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_retried_job_is_sent(self):
+        job = self.queue()[0]
+        with self.settings(EMAIL_BACKEND='shop.tests.FailingEmailBackend'), self.assertLogs('shop', 'WARNING'):
+            deliver_jobs(claim_jobs(10))
+        self.make_due()
+        self.assertEqual(deliver_jobs(claim_jobs(10)), ['sent'])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), ('sent', 2, ''))
+        self.assertIsNotNone(job.sent_at)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_expired_lease_is_claimed_again(self):
+        job = self.queue()[0]
+        self.assertEqual([claimed.pk for claimed in claim_jobs(10)], [job.pk])
+        # Claimed by a worker that died before recording a result
+        self.assertEqual(claim_jobs(10), [])
+        EmailOutbox.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([claimed.pk for claimed in claim_jobs(10)], [job.pk])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('sending', 0))
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        self.assertEqual(deliver_jobs([job]), ['sent'])
+
+
+class SendEmailsCommandTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user('mailed', 'mailed@example.com', 'secret-pass-1')
+        self.jobs = [enqueue_email('order_confirmation', create_order(user)) for _ in range(3)]
+
+    def run_command(self):
+        out = StringIO()
+        call_command('sendemails', '--once', '--concurrency=1', '--batch-size=2', stdout=out)
+        return out.getvalue()
+
+    def test_drains_the_outbox(self):
+        self.assertIn('Sent 3, retrying 0, dead 0.', self.run_command())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(set(EmailOutbox.objects.values_list('status', 'attempts')), {('sent', 1)})
+
+    @override_settings(EMAIL_BACKEND='shop.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failures_are_retried_then_dead_lettered(self):
+        with self.assertLogs('shop', 'WARNING'):
+            self.assertIn('Sent 0, retrying 3, dead 0.', self.run_command())
+            # Nothing is due until the backoff has passed
+            self.assertIn('Sent 0, retrying 0, dead 0.', self.run_command())
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            self.assertIn('Sent 0, retrying 0, dead 3.', self.run_command())
+        self.assertEqual(set(EmailOutbox.objects.values_list('status', 'attempts')), {('dead', 2)})
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica1'], METRICS_ENABLED=True, RATELIMIT_ENABLED=False,
+    PROFILE_ENABLED=True, PROFILE_SAMPLE_RATE=1,
+)
+class MyOrdersStreamingTests(TransactionTestCase):
+    def setUp(self):
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        settings_override = override_settings(PROFILE_DIR=profile_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.profile_dir = profile_dir.name
+        self.user = User.objects.create_user('streamed', 'streamed@example.com', 'secret-pass-1')
+        category = Category.objects.create(name='Tees', slug='tees')
+        product = Product.objects.create(name='Tee', slug='tee', description='', price=Decimal('25.00'), category=category)
+        for _ in range(3):
+            order = create_order(self.user)
+            OrderItem.objects.create(order=order, product=product, size='M', quantity=1, price=product.price)
+        self.client.force_login(self.user)
+
+    def test_streamed_queries_keep_the_request_routing_and_metrics(self):
+        decisions = []
+        real_db_for_read = PrimaryReplicaRouter.db_for_read
+
+        def db_for_read(router, model, **hints):
+            decisions.append((model.__name__, real_db_for_read(router, model, **hints)))
+            # There is no replica database here; run the query on the primary
+            return 'default'
+
+        key = 'shop_http_db_queries_total{view="shop:my_orders"}'
+        before = parse_metrics(render_metrics()).get(key, 0)
+        with mock.patch.object(PrimaryReplicaRouter, 'db_for_read', db_for_read), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/my-orders/')
+            self.assertTrue(response.streaming)
+            decisions.clear()
+            body = b''.join(response.streaming_content)
+
+        self.assertIn(b'Tee', body)
+        self.assertIn(('OrderItem', 'replica1'), decisions)
+        self.assertIn(('Product', 'replica1'), decisions)
+        # Every statement of the request, streamed ones included (how
+        # transaction control is counted differs between backends)
+        statements = [query for query in queries.captured_queries if query['sql'] not in ('BEGIN', 'COMMIT')]
+        self.assertGreaterEqual(parse_metrics(render_metrics())[key] - before, len(statements))
+        # Profiled until the stream was sent
+        [sql_file] = [name for name in os.listdir(self.profile_dir) if name.endswith('.sql')]
+        with open(os.path.join(self.profile_dir, sql_file)) as profile:
+            self.assertIn('"shop_orderitem"', profile.read())
@@ -0,0 +1,194 @@
+"""
+Bulk import of carrier tracking numbers
+
+Carrier manifests (CSV with a header row, or JSON lines) list an order id,
+a tracking number and optionally a tracking URL. They are applied in chunks:
+each chunk stores the tracking details with one bulk UPDATE and moves the
+orders to shipped through ``transition_orders``, which records their events
+and queues the shipped emails in the same transaction.
+"""
+import csv
+import json
+import logging
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+from .transitions import transition_orders
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 1000
+
+# Rows per bulk_update statement. Each one is a CASE over its rows, which
+# the database evaluates row by row, so keep them short.
+BULK_UPDATE_BATCH_SIZE = 250
+
+_validate_url = URLValidator()
+
+
+class ManifestRow:
+    """One tracking entry read from a manifest"""
+
+    def __init__(self, line, order_id, tracking_number, tracking_url):
+        self.line = line
+        self.order_id = order_id
+        self.tracking_number = tracking_number
+        self.tracking_url = tracking_url
+
+
+class TrackingImportResult:
+    """Outcome of a tracking import"""
+
+    def __init__(self):
+        self.updated_ids = []   # tracking details stored
+        self.shipped_ids = []   # additionally moved to shipped
+        self.unknown_ids = []   # no such order
+        self.cancelled_ids = []  # cancelled orders are left alone
+        self.errors = []        # (line, message) for rows that could not be read
+
+
+def _clean_row(line, record):
+    """Validate one manifest record and return a ManifestRow"""
+    try:
+        order_id = int(str(record.get('order_id') or '').strip().lstrip('#'))
+    except ValueError:
+        raise ValueError(f"invalid order_id {record.get('order_id')!r}")
+    tracking_number = str(record.get('tracking_number') or '').strip()
+    if not tracking_number:
+        raise ValueError('missing tracking_number')
+    if len(tracking_number) > Order._meta.get_field('tracking_number').max_length:
+        raise ValueError('tracking_number is too long')
+    tracking_url = str(record.get('tracking_url') or '').strip() or None
+    if tracking_url:
+        try:
+            _validate_url(tracking_url)
+        except ValidationError:
+            raise ValueError(f'invalid tracking_url {tracking_url!r}')
+    return ManifestRow(line, order_id, tracking_number, tracking_url)
+
+
+def parse_manifest(lines, manifest_format, errors):
+    """
+    Read a carrier manifest
+
+    Args:
+        lines: Iterable of text lines (an open text file)
+        manifest_format: 'csv' (header row with order_id, tracking_number and
+            optionally tracking_url) or 'jsonl' (one object per line)
+        errors: List that (line number, message) is appended to for bad rows
+
+    Yields:
+        ManifestRow for each valid row
+    """
+    if manifest_format == 'csv':
+        reader = csv.DictReader(lines)
+        missing = {'order_id', 'tracking_number'} - set(reader.fieldnames or [])
+        if missing:
+            errors.append((1, f"missing column(s): {', '.join(sorted(missing))}"))
+            return
+        records = ((reader.line_num, record) for record in reader)
+    elif manifest_format == 'jsonl':
+        records = _jsonl_records(lines, errors)
+    else:
+        raise ValueError(f'Unknown manifest format: {manifest_format}')
+
+    for line, record in records:
+        try:
+            yield _clean_row(line, record)
+        except ValueError as e:
+            errors.append((line, str(e)))
+
+
+def _jsonl_records(lines, errors):
+    for line, text in enumerate(lines, start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            errors.append((line, 'invalid JSON'))
+            continue
+        if not isinstance(record, dict):
+            errors.append((line, 'expected a JSON object'))
+            continue
+        yield line, record
+
+
+def manifest_format_for(filename):
+    """Guess the manifest format from a file name"""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def import_tracking(rows, request=None, chunk_size=IMPORT_CHUNK_SIZE, result=None):
+    """
+    Store tracking details and mark the orders as shipped
+
+    Each chunk is applied in its own transaction, so a large manifest does
+    not hold row locks for its whole duration. Orders already shipped or
+    delivered get their tracking details corrected without a new email.
+
+    Args:
+        rows: Iterable of ManifestRow (e.g. from parse_manifest)
+        request: HttpRequest instance (optional, for site URL in emails)
+        chunk_size: Orders per transaction
+        result: TrackingImportResult to add to (optional)
+
+    Returns:
+        TrackingImportResult
+    """
+    result = result or TrackingImportResult()
+    chunk = {}
+    for row in rows:
+        # A later row for the same order wins
+        chunk[row.order_id] = row
+        if len(chunk) >= chunk_size:
+            _import_chunk(chunk, request, result)
+            chunk = {}
+    if chunk:
+        _import_chunk(chunk, request, result)
+
+    logger.info(
+        f"Tracking import finished: {len(result.updated_ids)} updated, {len(result.shipped_ids)} shipped, "
+        f"{len(result.unknown_ids)} unknown, {len(result.cancelled_ids)} cancelled, {len(result.errors)} invalid rows"
+    )
+    return result
+
+
+def _import_chunk(rows_by_order, request, result):
+    now = timezone.now()
+    with transaction.atomic():
+        orders = list(
+            Order.objects.filter(id__in=list(rows_by_order))
+            .only('id', 'status', 'tracking_number', 'tracking_url')
+        )
+        result.unknown_ids.extend(sorted(set(rows_by_order) - {order.id for order in orders}))
+
+        accepted_ids = []
+        changed = []
+        for order in orders:
+            if order.status == 'cancelled':
+                result.cancelled_ids.append(order.id)
+                continue
+            accepted_ids.append(order.id)
+            row = rows_by_order[order.id]
+            # Re-uploading a manifest only rewrites rows whose details differ
+            if (order.tracking_number, order.tracking_url) != (row.tracking_number, row.tracking_url):
+                order.tracking_number = row.tracking_number
+                order.tracking_url = row.tracking_url
+                changed.append(order)
+        if not accepted_ids:
+            return
+
+        if changed:
+            Order.objects.bulk_update(changed, ['tracking_number', 'tracking_url'], batch_size=BULK_UPDATE_BATCH_SIZE)
+            Order.objects.filter(id__in=[order.id for order in changed]).update(updated_at=now)
+        result.updated_ids.extend(accepted_ids)
+
+        transition = transition_orders(
+            Order.objects.filter(id__in=accepted_ids), 'shipped', request=request, source='tracking_import'
+        )
+        result.shipped_ids.extend(transition.updated_ids)
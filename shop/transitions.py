@@ -0,0 +1,94 @@
+"""
+Bulk order status transitions
+
+Moves many orders to a new status with one locking SELECT and one
+conditional UPDATE per batch, instead of loading and saving each row.
+Side effects are triggered once for the whole set of affected orders through
+the ``orders_transitioned`` signal, sent inside the same transaction.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+from .signals import orders_transitioned
+
+# Statuses an order may be moved to, and the statuses it may come from
+ORDER_TRANSITIONS = {
+    'shipped': ('pending', 'processing'),
+    'delivered': ('shipped',),
+}
+
+# Keep the IN (...) lists of the UPDATE to a manageable size
+UPDATE_BATCH_SIZE = 1000
+
+
+class TransitionResult:
+    """Ids of the orders that were moved and of those left untouched"""
+
+    def __init__(self, to_status, updated_ids, skipped_ids):
+        self.to_status = to_status
+        self.updated_ids = updated_ids
+        self.skipped_ids = skipped_ids
+
+
+def transition_orders(queryset, to_status, request=None, source='admin'):
+    """
+    Move every order in ``queryset`` whose current status allows it to ``to_status``
+
+    Args:
+        queryset: Order queryset to transition
+        to_status: Target status, a key of ORDER_TRANSITIONS
+        request: HttpRequest instance (optional, passed on to receivers)
+        source: Short label of what triggered the change
+
+    Returns:
+        TransitionResult
+    """
+    allowed = ORDER_TRANSITIONS[to_status]
+    now = timezone.now()
+
+    with transaction.atomic():
+        # Lock the eligible rows so a concurrent change cannot slip between
+        # reading their ids and updating them
+        previous_statuses = dict(
+            queryset.filter(status__in=allowed)
+            .select_for_update()
+            .order_by('pk')
+            .values_list('pk', 'status')
+        )
+        locked_ids = list(previous_statuses)
+        updated_ids = []
+        for start in range(0, len(locked_ids), UPDATE_BATCH_SIZE):
+            batch = locked_ids[start:start + UPDATE_BATCH_SIZE]
+            moved = Order.objects.filter(pk__in=batch, status__in=allowed).update(
+                status=to_status, updated_at=now
+            )
+            if moved < len(batch):
+                # Where SELECT ... FOR UPDATE does not lock (SQLite) a row may
+                # have changed since; keep only the ones this UPDATE moved
+                batch = list(
+                    Order.objects.filter(pk__in=batch, status=to_status, updated_at=now)
+                    .order_by('pk')
+                    .values_list('pk', flat=True)
+                )
+            updated_ids.extend(batch)
+        if len(updated_ids) < len(locked_ids):
+            previous_statuses = {pk: previous_statuses[pk] for pk in updated_ids}
+
+        if updated_ids:
+            orders_transitioned.send(
+                sender=Order,
+                order_ids=updated_ids,
+                to_status=to_status,
+                previous_statuses=previous_statuses,
+                source=source,
+                request=request,
+                at=now,
+            )
+
+    updated = set(updated_ids)
+    skipped_ids = [
+        pk for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator()
+        if pk not in updated
+    ]
+    return TransitionResult(to_status, updated_ids, skipped_ids)
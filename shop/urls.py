@@ -1,8 +1,18 @@
 from django.urls import path
 from . import views
+from .ratelimit import RateLimit
 
 app_name = 'shop'
 
+# Token-bucket limits per URL name, checked before the request is handled (see
+# shop/ratelimit.py); only POSTs count unless a limit lists other methods
+RATE_LIMITS = {
+    'add_to_cart': [RateLimit('30/m', key='user', burst=10), RateLimit('120/m', key='ip')],
+    'update_cart_item': [RateLimit('60/m', key='user', burst=20), RateLimit('240/m', key='ip')],
+    'process_payment': [RateLimit('6/m', key='user', burst=3), RateLimit('30/m', key='ip')],
+    'signup': [RateLimit('5/h', key='ip', burst=3)],
+}
+
 urlpatterns = [
     path('', views.index, name='index'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
@@ -18,4 +28,9 @@ urlpatterns = [
     path('order/<int:order_id>/refund/', views.refund_order, name='refund_order'),
     path('signup/', views.signup, name='signup'),
     path('webhook/stripe/', views.stripe_webhook, name='stripe_webhook'),
+    path('staff/db-connections/', views.db_connection_stats, name='db_connection_stats'),
+    path('staff/cache/', views.cache_stats, name='cache_stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path('staff/profiles/', views.profile_list, name='profile_list'),
+    path('staff/profiles/<str:profile_id>.<str:kind>', views.profile_download, name='profile_download'),
 ]
\ No newline at end of file
@@ -2,34 +2,70 @@
 
 # Create your views here.
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, Http404, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import PasswordResetView
 from django.core.exceptions import ValidationError
 from django.views.decorators.csrf import csrf_exempt
+from django.db import IntegrityError, connections, transaction
 from django.conf import settings
+from django.core.cache import cache, caches
+from django.db.models import Q, prefetch_related_objects
+from django.template.loader import get_template, render_to_string
+from django.utils.crypto import constant_time_compare
+from django.utils.safestring import mark_safe
+from datetime import datetime, timedelta, timezone as dt_timezone
 import json
 import logging
-import stripe
+import os
 
-from .models import Product, Category, Cart, CartItem, Order, OrderItem, Customer
+from .models import Product, Category, Cart, CartItem, Order, OrderItem, Customer, ProductRecommendation
 from .forms import SignUpForm
-from .emails import (
-    send_order_confirmation_email, 
-    send_refund_confirmation_email,
-    send_order_shipped_email,
-    send_order_delivered_email
-)
-
-# Configure Stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from .dbconnections import connection_metrics
+from .metrics import external_call, render_metrics
+from .profiling import list_profiles
+from .payments import configure_stripe
+from .refunds import REFUNDABLE_STATUSES, create_stripe_refund
+from .outbox import enqueue_email
+from .routers import use_primary
+
 logger = logging.getLogger(__name__)
 
+# Catalog cache keys; the "catalog" group is invalidated when products or
+# categories change (see shop/signals.py)
+CATALOG_INDEX_KEY = 'catalog:index'
+CATALOG_PRODUCT_KEY = 'catalog:product:{}'
+
+def _cached_catalog(key, load):
+    """
+    Catalog data from the cache, filled by calling ``load``
+
+    Misses (``load`` returning None, e.g. an unknown slug) are not cached,
+    so requests for made-up slugs cannot push real pages out of the cache.
+    Nothing is cached when CATALOG_CACHE_TIMEOUT is 0.
+    """
+    timeout = settings.CATALOG_CACHE_TIMEOUT
+    if not timeout:
+        return load()
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        if value is not None:
+            cache.add(key, value, timeout)
+    return value
+
+@use_primary()
+def _load_index_catalog():
+    # Fills read the primary so a fill right after an edit never caches
+    # rows a lagging replica has not caught up with
+    products = list(Product.objects.filter(active=True).select_related('category')[:12])
+    return products, list(Category.objects.all())
+
 def index(request):
-    products = Product.objects.filter(active=True)[:12]
-    categories = Category.objects.all()
+    products, categories = _cached_catalog(CATALOG_INDEX_KEY, _load_index_catalog)
     
     context = {
         'products': products,
@@ -37,13 +73,31 @@ def index(request):
     }
     return render(request, 'shop/index.html', context)
 
+# "Customers also bought" products shown on the product page
+PRODUCT_RECOMMENDATIONS = 4
+
+@use_primary()
+def _load_product(slug):
+    return Product.objects.filter(slug=slug, active=True).select_related('category').first()
+
 def product_detail(request, slug):
-    product = get_object_or_404(Product, slug=slug, active=True)
+    product = _cached_catalog(CATALOG_PRODUCT_KEY.format(slug), lambda: _load_product(slug))
+    if product is None:
+        raise Http404('No product matches the given query.')
     sizes = product.get_sizes_list()
     
+    # Precomputed by refreshrecommendations; one query on (product, rank)
+    also_bought = [
+        recommendation.recommended
+        for recommendation in ProductRecommendation.objects.filter(
+            product=product, recommended__active=True,
+        ).select_related('recommended__category').order_by('rank')[:PRODUCT_RECOMMENDATIONS]
+    ]
+    
     context = {
         'product': product,
         'sizes': sizes,
+        'also_bought': also_bought,
     }
     return render(request, 'shop/product_detail.html', context)
 
@@ -175,6 +229,7 @@ def remove_from_cart(request):
 
 @login_required
 def checkout(request):
+    stripe = configure_stripe()
     cart = get_cart(request)
     cart_items = cart.items.all()
     
@@ -196,14 +251,15 @@ def checkout(request):
             messages.error(request, 'Invalid cart total. Please check your cart.')
             return redirect('shop:cart')
         
-        intent = stripe.PaymentIntent.create(
-            amount=total_cents,
-            currency='usd',
-            metadata={
-                'user_id': request.user.id,
-                'customer_id': customer.id,
-            }
-        )
+        with external_call('stripe', 'payment_intent.create'):
+            intent = stripe.PaymentIntent.create(
+                amount=total_cents,
+                currency='usd',
+                metadata={
+                    'user_id': request.user.id,
+                    'customer_id': customer.id,
+                }
+            )
     except stripe.error.StripeError as e:
         logger.error(f"Stripe error: {str(e)}")
         messages.error(request, f'Payment system error: {str(e)}')
@@ -222,18 +278,46 @@ def checkout(request):
     }
     return render(request, 'shop/checkout.html', context)
 
+def _order_placed_response(order):
+    return JsonResponse({
+        'success': True,
+        'order_id': order.id,
+        'message': f'Order #{order.id} placed successfully!'
+    })
+
 @login_required
+@use_primary()
 def process_payment(request):
-    """Handle payment confirmation and create order"""
+    """
+    Handle payment confirmation and create order.
+
+    Order placement is idempotent per PaymentIntent: a retried or
+    double-submitted request is answered with the order already created for
+    that intent, without contacting Stripe or re-sending the confirmation.
+    """
+    stripe = configure_stripe()
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
             payment_intent_id = data.get('payment_intent_id')
             shipping_address = data.get('shipping_address', '')
             
+            if not payment_intent_id:
+                return JsonResponse({'success': False, 'message': 'Missing payment intent'})
+            
+            # Answer repeats from the existing order
+            existing_order = Order.objects.filter(
+                payment_intent_id=payment_intent_id,
+                customer__user=request.user,
+            ).first()
+            if existing_order:
+                logger.info(f"Repeated payment confirmation for order #{existing_order.id}")
+                return _order_placed_response(existing_order)
+            
             # Verify payment intent with Stripe
             try:
-                intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+                with external_call('stripe', 'payment_intent.retrieve'):
+                    intent = stripe.PaymentIntent.retrieve(payment_intent_id)
             except stripe.error.StripeError as e:
                 logger.error(f"Stripe retrieve error: {str(e)}")
                 return JsonResponse({'success': False, 'message': 'Payment verification failed'})
@@ -253,42 +337,49 @@ def process_payment(request):
                 if charges_data and len(charges_data) > 0:
                     charge_id = charges_data[0].get('id', '')
             
-            # Create order
-            order = Order.objects.create(
-                customer=customer,
-                total_amount=cart.get_total_price(),
-                shipping_address=shipping_address,
-                payment_status='completed',
-                payment_intent_id=payment_intent_id,
-                stripe_charge_id=charge_id,
-                status='processing'
-            )
-            
-            # Create order items
-            for cart_item in cart_items:
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    size=cart_item.size,
-                    quantity=cart_item.quantity,
-                    price=cart_item.product.price,
-                )
-            
-            # Clear cart
-            cart_items.delete()
-            
-            # Send order confirmation email
             try:
-                send_order_confirmation_email(order, request)
-            except Exception as e:
-                logger.error(f"Failed to send order confirmation email: {str(e)}")
-                # Don't fail the order if email fails
+                with transaction.atomic():
+                    # Create order; the unique index on payment_intent_id
+                    # rejects a concurrent duplicate
+                    order = Order(
+                        customer=customer,
+                        total_amount=cart.get_total_price(),
+                        shipping_address=shipping_address,
+                        payment_status='completed',
+                        payment_intent_id=payment_intent_id,
+                        stripe_charge_id=charge_id,
+                        status='processing'
+                    )
+                    order.change_source = 'checkout'
+                    order.save(force_insert=True)
+                    
+                    # Create order items
+                    for cart_item in cart_items:
+                        OrderItem.objects.create(
+                            order=order,
+                            product=cart_item.product,
+                            size=cart_item.size,
+                            quantity=cart_item.quantity,
+                            price=cart_item.product.price,
+                        )
+                    
+                    # Clear cart
+                    cart_items.delete()
+                    
+                    # Queue order confirmation email
+                    enqueue_email('order_confirmation', order, request)
+            except IntegrityError:
+                # Another request placed the order for this intent first
+                order = Order.objects.filter(
+                    payment_intent_id=payment_intent_id,
+                    customer=customer,
+                ).first()
+                if order is None:
+                    raise
+                logger.info(f"Concurrent payment confirmation for order #{order.id}")
+                return _order_placed_response(order)
             
-            return JsonResponse({
-                'success': True,
-                'order_id': order.id,
-                'message': f'Order #{order.id} placed successfully!'
-            })
+            return _order_placed_response(order)
             
         except Exception as e:
             logger.error(f"Payment processing error: {str(e)}")
@@ -302,10 +393,12 @@ def order_success(request, order_id):
 
 
 @login_required
+@use_primary()
 def refund_order(request, order_id):
     """
     Process refund for an order (Admin or customer-initiated)
     """
+    stripe = configure_stripe()
     # Get the order
     order = get_object_or_404(Order, id=order_id)
     
@@ -320,7 +413,7 @@ def refund_order(request, order_id):
         return redirect('admin:shop_order_change', order.id) if request.user.is_staff else redirect('shop:my_orders')
     
     # Check if payment was completed
-    if order.payment_status != 'completed':
+    if order.payment_status not in REFUNDABLE_STATUSES:
         messages.error(request, f'Order #{order.id} cannot be refunded. Payment status: {order.get_payment_status_display()}')
         return redirect('admin:shop_order_change', order.id) if request.user.is_staff else redirect('shop:my_orders')
     
@@ -328,26 +421,20 @@ def refund_order(request, order_id):
         # Process refund with Stripe
         if order.payment_intent_id:
             try:
-                refund = stripe.Refund.create(
-                    payment_intent=order.payment_intent_id,
-                    reason='requested_by_customer',
-                )
+                refund = create_stripe_refund(order)
                 logger.info(f"Stripe refund created: {refund.id} for order #{order.id}")
             except stripe.error.StripeError as e:
                 logger.error(f"Stripe refund failed for order #{order.id}: {str(e)}")
                 messages.error(request, f'Refund failed: {str(e)}')
                 return redirect('admin:shop_order_change', order.id) if request.user.is_staff else redirect('shop:my_orders')
         
-        # Update order status
-        order.payment_status = 'refunded'
-        order.status = 'cancelled'
-        order.save()
-        
-        # Send refund confirmation email
-        try:
-            send_refund_confirmation_email(order, request)
-        except Exception as e:
-            logger.error(f"Failed to send refund confirmation email: {str(e)}")
+        # Update order status and queue the refund confirmation email
+        with transaction.atomic():
+            order.payment_status = 'refunded'
+            order.status = 'cancelled'
+            order.change_source = 'refund'
+            order.save()
+            enqueue_email('refund_confirmation', order, request)
         
         messages.success(request, f'Order #{order.id} has been refunded successfully. The customer will receive a confirmation email.')
         
@@ -375,19 +462,117 @@ def signup(request):
     else:
         form = SignUpForm()
     return render(request, 'registration/signup.html', {'form': form})
+
+MY_ORDERS_PAGE_SIZE = 20
+_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Orders rendered (and their items fetched) per streamed chunk of My Orders
+MY_ORDERS_STREAM_CHUNK = 10
+
+# Stands in for the order cards when rendering the rest of the page
+_STREAM_MARKER = '<!-- order-cards -->'
+
+
+def _encode_order_cursor(order):
+    """Opaque, URL-safe position after ``order`` in (-created_at, -id) order"""
+    micros = (order.created_at - _CURSOR_EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{order.id}"
+
+
+def _decode_order_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        micros, order_id = cursor.split('-', 1)
+        created_at, order_id = _CURSOR_EPOCH + timedelta(microseconds=int(micros)), int(order_id)
+    except (ValueError, OverflowError):
+        # Malformed, or a date or id out of range
+        return None
+    if not 0 < order_id < 2 ** 63:
+        return None
+    return created_at, order_id
+
+
+def _order_as_json(order):
+    return {
+        'id': order.id,
+        'created_at': order.created_at.isoformat(),
+        'status': order.status,
+        'status_display': order.get_status_display(),
+        'total_amount': str(order.total_amount),
+        'tracking_number': order.tracking_number,
+        'tracking_url': order.tracking_url,
+        'items': [
+            {
+                'product_name': item.product.name,
+                'product_image': item.product.image.url if item.product.image else '',
+                'size': item.size,
+                'quantity': item.quantity,
+                'price': str(item.price),
+            }
+            for item in order.items.all()
+        ],
+    }
+
 
 @login_required
 def my_orders(request):
-    try:
-        customer = Customer.objects.get(user=request.user)
-        orders = Order.objects.filter(customer=customer).order_by('-created_at')
-    except Customer.DoesNotExist:
-        orders = []
+    """
+    Customer's orders, newest first, one page at a time
+
+    Pages are addressed by a keyset cursor (?before=...) on (created_at, id)
+    rather than an offset, so deep pages cost the same as the first one.
+    Line items and products are prefetched for the visible page only.
+    ?format=json returns a compact variant for infinite scroll.
+
+    The HTML page is streamed: the header (and the stylesheets it links) go
+    out before any line item is fetched, then the order cards follow
+    MY_ORDERS_STREAM_CHUNK at a time.
+    """
+    orders = Order.objects.filter(customer__user=request.user).order_by('-created_at', '-id')
+    
+    cursor = _decode_order_cursor(request.GET.get('before'))
+    if cursor:
+        created_at, order_id = cursor
+        orders = orders.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id)
+        )
+    
+    # Fetch one extra row to know whether another page follows
+    page = list(orders[:MY_ORDERS_PAGE_SIZE + 1])
+    next_cursor = None
+    if len(page) > MY_ORDERS_PAGE_SIZE:
+        page = page[:MY_ORDERS_PAGE_SIZE]
+        next_cursor = _encode_order_cursor(page[-1])
+    
+    if request.GET.get('format') == 'json':
+        prefetch_related_objects(page, 'items__product')
+        return JsonResponse({
+            'orders': [_order_as_json(order) for order in page],
+            'next_cursor': next_cursor,
+        })
 
     context = {
-        'orders': orders,
+        'orders': page,
+        'order_cards': mark_safe(_STREAM_MARKER),
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
     }
-    return render(request, 'shop/my_orders.html', context)
+    head, _, tail = render_to_string('shop/my_orders.html', context, request).partition(_STREAM_MARKER)
+    response = StreamingHttpResponse(_stream_order_cards(head, page, tail), content_type='text/html; charset=utf-8')
+    # Ask nginx to pass the chunks on as they come instead of buffering them
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _stream_order_cards(head, page, tail):
+    yield head
+    template = get_template('shop/includes/order_cards.html')
+    for start in range(0, len(page), MY_ORDERS_STREAM_CHUNK):
+        chunk = page[start:start + MY_ORDERS_STREAM_CHUNK]
+        prefetch_related_objects(chunk, 'items__product')
+        yield template.render({'orders': chunk})
+    yield tail
 
 
 class PlainTextPasswordResetView(PasswordResetView):
@@ -395,8 +580,10 @@ class PlainTextPasswordResetView(PasswordResetView):
 
 
 @csrf_exempt
+@use_primary()
 def stripe_webhook(request):
     """Handle Stripe webhook events"""
+    stripe = configure_stripe()
     payload = request.body
     sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
     
@@ -423,6 +610,7 @@ def stripe_webhook(request):
             order = Order.objects.get(payment_intent_id=payment_intent['id'])
             order.payment_status = 'completed'
             order.status = 'processing'
+            order.change_source = 'stripe_webhook'
             order.save()
         except Order.DoesNotExist:
             logger.warning(f"Order not found for payment_intent: {payment_intent['id']}")
@@ -435,8 +623,71 @@ def stripe_webhook(request):
         try:
             order = Order.objects.get(payment_intent_id=payment_intent['id'])
             order.payment_status = 'failed'
+            order.change_source = 'stripe_webhook'
             order.save()
         except Order.DoesNotExist:
             pass
     
     return HttpResponse(status=200)
+
+
+@staff_member_required
+def db_connection_stats(request):
+    """
+    Connection reuse counters for this worker process, as JSON
+
+    Each web worker keeps its own connections and counters, so compare
+    several samples (or workers) before drawing conclusions.
+    """
+    return JsonResponse({
+        'settings': {
+            alias: {
+                'conn_max_age': connections.settings[alias]['CONN_MAX_AGE'],
+                'conn_health_checks': connections.settings[alias]['CONN_HEALTH_CHECKS'],
+            }
+            for alias in connections
+        },
+        'connections': connection_metrics.snapshot(),
+    })
+
+
+@staff_member_required
+def cache_stats(request):
+    """
+    Hit, miss and eviction counters of this worker's cache tiers, as JSON
+    """
+    return JsonResponse({
+        alias: caches[alias].stats()
+        for alias in settings.CACHES
+        if hasattr(caches[alias], 'stats')
+    })
+
+
+def metrics(request):
+    """
+    This worker's request metrics in the Prometheus text format
+
+    Only served with METRICS_ENABLED; when METRICS_TOKEN is set, scrapers
+    must send it as a bearer token.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404('Metrics are disabled.')
+    token = settings.METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profile_list(request):
+    """Ids of the stored request profiles, newest first (see shop/profiling.py)"""
+    return JsonResponse({'profiles': list_profiles(settings.PROFILE_DIR)})
+
+
+@staff_member_required
+def profile_download(request, profile_id, kind):
+    """Download a stored profile's .folded stacks or .sql log"""
+    if kind not in ('folded', 'sql') or profile_id not in list_profiles(settings.PROFILE_DIR):
+        raise Http404('No such profile.')
+    path = os.path.join(settings.PROFILE_DIR, f'{profile_id}.{kind}')
+    return FileResponse(open(path, 'rb'), as_attachment=True, content_type='text/plain; charset=utf-8')
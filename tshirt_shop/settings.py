@@ -67,11 +67,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it times everything below it; removes itself unless METRICS_ENABLED
+    "shop.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "shop.middleware.RateLimitMiddleware",
+    # Before anything that reads or changes response bodies
+    "shop.middleware.CompressionMiddleware",
+    "shop.middleware.ReplicaPinningMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "shop.middleware.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -101,18 +108,113 @@ WSGI_APPLICATION = "tshirt_shop.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.mysql",
+        # Django's MySQL backend plus connection reuse metrics (shop/dbconnections.py)
+        "ENGINE": "shop.db_backends.mysql",
         "NAME": os.getenv("DB_NAME", "tshirt_shop_db"),
         "USER": os.getenv("DB_USER", "tshirt_user"),
         "PASSWORD": os.getenv("DB_PASSWORD", ""),
         "HOST": os.getenv("DB_HOST", "localhost"),
         "PORT": os.getenv("DB_PORT", "3306"),
+        # Keep connections open across requests for up to this many seconds
+        # (0 = reconnect for every request); keep it below MySQL's wait_timeout
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),
+        # Ping a kept connection before its first use in a request
+        "CONN_HEALTH_CHECKS": os.getenv("DB_CONN_HEALTH_CHECKS", "True").lower() in ('true', '1', 'yes'),
         "OPTIONS": {
             "init_command": "SET sql_mode='STRICT_TRANS_TABLES'",
         },
     }
 }
 
+# Read replicas: comma-separated host[:port] list (e.g. "db-replica-1,db-replica-2:3307").
+# Storefront and admin reads are spread over them; see shop/routers.py.
+DATABASE_REPLICAS = []
+for _index, _replica in enumerate(filter(None, (h.strip() for h in os.getenv('DB_REPLICA_HOSTS', '').split(','))), start=1):
+    _host, _, _port = _replica.partition(':')
+    DATABASES[f'replica{_index}'] = {
+        **DATABASES['default'],
+        'HOST': _host,
+        'PORT': _port or DATABASES['default']['PORT'],
+        'USER': os.getenv('DB_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv('DB_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        # Tests use the primary's test database for the replicas
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{_index}')
+
+DATABASE_ROUTERS = ['shop.routers.PrimaryReplicaRouter']
+
+# Seconds a browser keeps reading from the primary after it wrote something
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+
+
+# Caching: a per-process LRU in front of a shared cache (shop/cache.py).
+# Set CACHE_REDIS_URL (e.g. "redis://localhost:6379/1") in production; without
+# it the shared tier is a per-process stand-in, fine for development and tests
+# but not shared between workers.
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', '')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'shop.cache.TwoTierCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'LOCAL_MAX_ENTRIES': int(os.getenv('CACHE_LOCAL_MAX_ENTRIES', '1000')),
+            'LOCAL_TIMEOUT': int(os.getenv('CACHE_LOCAL_TIMEOUT', '30')),
+            'SYNC_INTERVAL': float(os.getenv('CACHE_SYNC_INTERVAL', '1')),
+        },
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    } if CACHE_REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shop-shared-standin',
+    },
+}
+
+# Seconds catalog pages (home page products, product details) stay cached;
+# product and category edits invalidate them immediately. Off (0) by default
+# without CACHE_REDIS_URL: the stand-in shared tier is per process, so other
+# workers would miss the invalidation and show old prices until the timeout.
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', '300' if CACHE_REDIS_URL else '0'))
+
+# Per-view latency, query, cache and Stripe/SMTP metrics served in the
+# Prometheus text format at /metrics (shop/metrics.py). Scrapers send
+# METRICS_TOKEN as a bearer token when it is set.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False').lower() in ('true', '1', 'yes')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Request profiler (shop/profiling.py): staff send the PROFILE_HEADER header
+# to profile a request; PROFILE_SAMPLE_RATE (0-1) also profiles a random
+# fraction of all requests. Profiles are stored as flamegraph-ready files.
+PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_MAX_CONCURRENT = int(os.getenv('PROFILE_MAX_CONCURRENT', '1'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', str(BASE_DIR / 'profiles'))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '200'))
+PROFILE_MAX_AGE_DAYS = int(os.getenv('PROFILE_MAX_AGE_DAYS', '7'))
+
+# Rate limits for the cart, payment and signup endpoints (RATE_LIMITS in
+# shop/urls.py). Buckets live in the shared cache ('cache') so limits hold
+# across workers, or per process ('memory'). Behind a proxy that appends the
+# client address to a header (e.g. X-Forwarded-For), name it in
+# RATELIMIT_IP_HEADER; otherwise leave it empty so clients cannot spoof it.
+RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'True').lower() in ('true', '1', 'yes')
+RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'cache')
+RATELIMIT_CACHE = 'shared'
+RATELIMIT_IP_HEADER = os.getenv('RATELIMIT_IP_HEADER', '')
+
+# Response compression (shop/compression.py): brotli when the brotli package
+# is installed and the client accepts it, gzip otherwise. Responses smaller
+# than COMPRESSION_MIN_SIZE bytes are sent as is. Turn it off when a proxy
+# in front of the app already compresses.
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'True').lower() in ('true', '1', 'yes')
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '5'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -187,7 +289,24 @@ EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', 'False').lower() in ('true', '1', 'ye
 EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', '10'))
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', EMAIL_HOST_USER or 'webmaster@localhost')
 
+# Messages delivered over one SMTP connection before it is recycled
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '50'))
+
+# Email outbox drained by `python manage.py sendemails`
+EMAIL_OUTBOX_CONCURRENCY = int(os.getenv('EMAIL_OUTBOX_CONCURRENCY', '4'))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '8'))
+EMAIL_OUTBOX_RETRY_SECONDS = int(os.getenv('EMAIL_OUTBOX_RETRY_SECONDS', '30'))
+EMAIL_OUTBOX_MAX_RETRY_SECONDS = int(os.getenv('EMAIL_OUTBOX_MAX_RETRY_SECONDS', '3600'))
+
 # Stripe Payment Settings
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+# Point the Stripe client at another API host, e.g. the local stand-in started
+# with `python manage.py runfakestripe` (http://127.0.0.1:12111).
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', '')
+# Concurrent Stripe calls made by the bulk refund admin action.
+REFUND_MAX_WORKERS = int(os.getenv('REFUND_MAX_WORKERS', '8'))
+# Larger admin refund selections are queued for `python manage.py
+# processrefunds` instead of being refunded within the admin request.
+REFUND_ADMIN_INLINE_LIMIT = int(os.getenv('REFUND_ADMIN_INLINE_LIMIT', '50'))